@@ -9,20 +9,47 @@ rstudio_home_path = "/mnt/r_files_home"          # Mount home folder. See step 1
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC The scripts below are rendered with `render_template` (see the `templating` notebook) and collected in `artefacts`. They are uploaded together with `publish_artefacts` at the end of step 3, which skips files whose content did not change, retries failed writes and verifies every file after writing it (see the `publishing` notebook).
+# MAGIC * To provision more than one workspace in the same run, add a `DbfsRestBackend(host, token)` per workspace to `publish_backends`.
+
+# COMMAND ----------
+
+# MAGIC %run ./templating
+
+# COMMAND ----------
+
+# MAGIC %run ./publishing
+
+# COMMAND ----------
+
+artefacts = {}                                   # dbfs:/ path -> content, published at the end of step 3
+publish_backends = [DbfsBackend()]               # e.g. + [DbfsRestBackend("https://<workspace>", "<token>")]
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC #### 1. R library utility functions
 # MAGIC The script below contains:
 # MAGIC * R functions that help users automatically install libraries in a "central" library location in the mounted folder (see step 1). 
 # MAGIC   * e.g. instead of using `install.packages`, users should use `databricks.install.packages` which then automatically moves the installed packages to the centralised library folder.
 # MAGIC * Secondly it automatically adds this centralised library folder to everyone's library paths.
+# MAGIC * Installed packages are published to the central library with `syncUserLib`. Only packages whose files (sizes and md5 hashes) changed are copied from the install, several at a time.
+# MAGIC   * Every install publishes a new generation of the library: a fresh directory `rlib/<R version>/gen-<id>` with the changed packages and a copy of the unchanged ones. Only when it is complete, the small `CURRENT` pointer next to it is switched to the new generation, and `setUserLibPath()` puts the generation the pointer names on `.libPaths()`. Sessions therefore see the previous or the new library, never a half-published one, also on a DBFS mount backed by object storage, where a directory rename copies every file and is not atomic.
+# MAGIC   * The previous generation is kept for the sessions that still load from it, older ones are removed.
+# MAGIC * Finally, `databricks.install.packages` keeps a cache of built binary packages in the mounted folder (`pkg_cache`). Packages are keyed by name, version, R version and OS/ABI, so a package that was compiled once on any cluster is simply extracted the next time it is needed.
+# MAGIC * `databricks.spark_apply` runs `sparklyr::spark_apply` with a bundle of only the packages the function references (`pkg::fun`, `library(pkg)`, `require(pkg)`) and their dependencies, instead of everything on `.libPaths()`. Bundles are cached in `pkg_cache/bundles`, keyed by the hash of the packages and their versions.
 
 # COMMAND ----------
 
 rlib_install_path = rstudio_home_path + "/helper_functions/libs_install.r"
+local_rlib_install_path = "/local_disk0/r_helpers/libs_install.r"   # Local disk copy of libs_install.r, made by the init scripts
+rpkg_cache_path = rstudio_home_path + "/pkg_cache"   # Binary package cache, shared by all clusters
+local_rlib_path = "/local_disk0/rlib"                # Local disk mirror of the central library. See step 5!
 
 # COMMAND ----------
 
-script ="""
+rlib_path_script = render_template("""
 ############################################################################
 #  R Library Management
 #  Functions for command-line R library installation, setting search
@@ -30,34 +57,102 @@ script ="""
 ############################################################################
 
 
-setUserLibPath <- function(usrLibPath = "{0}/{1}"){{
-  # Sets up user libraty path with DBFS fusion mount "{0}/{1}"
-  #  and add into the R library search path
+isLocalLibFresh <- function(usrLibPathVer, localLibPathVer){
+  # Checks whether the local disk mirror of a library was hydrated from the
+  # current generation of the library (see syncUserLib())
+  #
+  # Args:
+  #   usrLibPathVer:  Library on the DBFS fusion mount
+  #   localLibPathVer:  Local disk mirror of the library
+  #
+  # Return:
+  #   TRUE if the mirror can be used instead of the library
+  localGenFile = file.path(localLibPathVer, ".generation")
+  if (file.exists(localGenFile)==F) {
+    return(FALSE)
+  }
+  usrGenFile = file.path(usrLibPathVer, ".generation")
+  usrGen = if (file.exists(usrGenFile)) readLines(usrGenFile, warn=FALSE) else "none"
+  identical(readLines(localGenFile, warn=FALSE), usrGen)
+}
+
+resolveUserLib <- function(usrLibPathVer){
+  # Returns the directory of the current generation of a library, which its
+  # CURRENT pointer names (see syncUserLib()). A library without a pointer,
+  # e.g. one published before generations existed, holds the packages itself
+  #
+  # Args:
+  #   usrLibPathVer:  Library of an R version, e.g. getUserLibPath()
+  #
+  # Return:
+  #   Directory of the packages
+  pointer = file.path(usrLibPathVer, "CURRENT")
+  if (file.exists(pointer)) {
+    generation = readLines(pointer, warn=FALSE)
+    if (length(generation) == 1 && nzchar(generation)) {
+      return(file.path(usrLibPathVer, generation))
+    }
+  }
+  usrLibPathVer
+}
+
+timeStartupStep <- function(step, expr){
+  # Times a step of the R session startup, when startup profiling is enabled in config.r
+  #
+  # Args:
+  #   step:  Name of the step
+  #   expr:  Expression to evaluate
+  #
+  # Return:
+  #   The value of expr
+  if (exists(".dbStartupTime", mode="function")) {
+    return(.dbStartupTime(step, expr))
+  }
+  expr
+}
+
+setUserLibPath <- function(usrLibPath = "{{ dbfs_home }}/{{ rlib_dir }}", localLibPath = "{{ local_rlib_path }}", create = TRUE){
+  # Sets up user libraty path with DBFS fusion mount "{{ dbfs_home }}/{{ rlib_dir }}"
+  #  and add the current generation of it (see resolveUserLib()) into the R library
+  #  search path. When the local disk mirror "{{ local_rlib_path }}" is fresh, it is put in front of it
   #
   # Args:
   #   usrLibPath 
+  #   localLibPath:  Optional. Local disk mirror of usrLibPath, NULL to not use a mirror
+  #   create:  Optional. Create usrLibPath if it does not exist yet
   #
   # Return:
-  #   "{0}/{1}"
+  #   "{{ dbfs_home }}/{{ rlib_dir }}" + R_runtime
   usrLibPathVer = file.path(usrLibPath, getRversion())  #set the path matching R version
-  if (file.exists(usrLibPathVer)==F) {{
-    dir.create(usrLibPathVer, recursive=TRUE)
-  }}
+  if (create && timeStartupStep("setUserLibPath: file.exists", file.exists(usrLibPathVer))==F) {
+    timeStartupStep("setUserLibPath: dir.create", dir.create(usrLibPathVer, recursive=TRUE))
+  }
    
+  usrLibDir = timeStartupStep("setUserLibPath: resolveUserLib", resolveUserLib(usrLibPathVer))
    
+  # removing the library and earlier generations of it from search paths
   search.path = .libPaths()
-  if (usrLibPathVer %in% search.path) {{
-    search.path = setdiff(search.path, usrLibPathVer)
-  }}
+  search.path = search.path[search.path != usrLibPathVer & !startsWith(search.path, paste0(usrLibPathVer, "/gen-"))]
    
   # adding user specified library path into search paths
-  search.path = c(usrLibPathVer, search.path)
+  search.path = c(usrLibDir, search.path)
+   
+  if (!is.null(localLibPath)) {
+    localLibPathVer = file.path(localLibPath, getRversion())
+    search.path = setdiff(search.path, localLibPathVer)
+    if (timeStartupStep("setUserLibPath: isLocalLibFresh", isLocalLibFresh(usrLibDir, localLibPathVer))) {
+      search.path = c(localLibPathVer, search.path)
+    } else if (file.exists(file.path(localLibPath, "hydrate.sh"))) {
+      # stale mirror: keep loading from DBFS and refresh the mirror in the background
+      system2(file.path(localLibPath, "hydrate.sh"), wait=FALSE, stdout=FALSE, stderr=FALSE)
+    }
+  }
   .libPaths(search.path) 
    
   return(usrLibPathVer)
-}}
+}
 
-removeUserLibPath <- function(usrLibPath){{
+removeUserLibPath <- function(usrLibPath){
   # Remove user library path
   #  and add into the R library search path
   #
@@ -68,28 +163,269 @@ removeUserLibPath <- function(usrLibPath){{
   #   search paths
    
   search.path = .libPaths()
-  if (usrLibPath %in% search.path) {{
+  if (usrLibPath %in% search.path) {
     search.path = setdiff(search.path, usrLibPath)
     .libPaths(search.path) 
-  }}
+  }
   return(search.path)
-}}
+}
  
-getUserLibPath <- function(){{
-  #  Get user libraty path with DBFS fusion mount "{0}"
+getUserLibPath <- function(){
+  #  Get user libraty path with DBFS fusion mount "{{ dbfs_home }}"
   # Args:
   #   None
   #
   # Return:
-  #   "{0}/{1}" + R_runtime
-  usrLibPath = "{0}/{1}"   
+  #   "{{ dbfs_home }}/{{ rlib_dir }}" + R_runtime
+  usrLibPath = "{{ dbfs_home }}/{{ rlib_dir }}"   
  
   return(file.path(usrLibPath, getRversion()) )
-}}
+}
  
  
-databricks.install.packages <- function(pkgName, repo="http://cloud.r-project.org") {{
+""", dbfs_home="/dbfs" + rstudio_home_path, rlib_dir="rlib", pkg_cache_path="/dbfs" + rpkg_cache_path, local_rlib_path=local_rlib_path)
+
+rlib_helpers_script = render_template("""
+getPkgCachePath <- function(){
+  #  Get the binary package cache path with DBFS fusion mount "{{ pkg_cache_path }}"
+  # Args:
+  #   None
+  #
+  # Return:
+  #   "{{ pkg_cache_path }}"
+  return("{{ pkg_cache_path }}")
+}
+
+getPkgCacheKey <- function(pkgName, version){
+  # Builds the cache key of a binary package. Compiled packages can only be
+  # reused on the same R version and OS/ABI, so both are part of the key
+  #
+  # Args:
+  #   pkgName:  Name of the R package
+  #   version:  Version of the R package
+  #
+  # Return:
+  #   "<pkgName>_<version>_R<major.minor>_<platform>_<os><os version>"
+  rVer = paste(R.version$major, strsplit(R.version$minor, ".", fixed=TRUE)[[1]][1], sep=".")
+  osName = ""
+  if (file.exists("/etc/os-release")) {
+    osRelease = readLines("/etc/os-release")
+    osId = gsub('"', "", sub("^ID=", "", grep("^ID=", osRelease, value=TRUE)))
+    osVer = gsub('"', "", sub("^VERSION_ID=", "", grep("^VERSION_ID=", osRelease, value=TRUE)))
+    osName = paste0(osId, osVer)
+  }
+  paste(pkgName, version, paste0("R", rVer), R.version$platform, osName, sep="_")
+}
+
+getPkgCacheFile <- function(pkgName, version){
+  # Get the location of a binary package tarball in the package cache
+  #
+  # Args:
+  #   pkgName:  Name of the R package
+  #   version:  Version of the R package
+  #
+  # Return:
+  #   "{{ pkg_cache_path }}/<cache key>.tar.gz"
+  file.path(getPkgCachePath(), paste0(getPkgCacheKey(pkgName, version), ".tar.gz"))
+}
+
+restorePkgBinary <- function(pkgName, version, libPath){
+  # Extracts a cached binary package into a library
+  #
+  # Args:
+  #   pkgName:  Name of the R package
+  #   version:  Version of the R package
+  #   libPath:  Library to extract the package into
+  #
+  # Return:
+  #   TRUE if the package was found in the cache and extracted
+  cacheFile = getPkgCacheFile(pkgName, version)
+  if (file.exists(cacheFile)==F) {
+    return(FALSE)
+  }
+  tryCatch({
+    untar(cacheFile, exdir = libPath)
+    file.exists(file.path(libPath, pkgName, "DESCRIPTION"))
+  }, error = function(e) FALSE)
+}
+
+cachePkgBinary <- function(pkgName, libPath){
+  # Adds an installed package to the binary package cache
+  #
+  # Args:
+  #   pkgName:  Name of the installed R package
+  #   libPath:  Library that holds the installed package
+  #
+  # Return:
+  #   cacheFile:  The cached binary package tarball
+  version = as.character(packageVersion(pkgName, lib.loc = libPath))
+  cacheFile = getPkgCacheFile(pkgName, version)
+  if (file.exists(cacheFile)) {
+    return(cacheFile)
+  }
+  if (file.exists(getPkgCachePath())==F) {
+    dir.create(getPkgCachePath(), recursive=TRUE)
+  }
+   
+  tmpFile = tempfile(fileext = ".tar.gz")
+  owd = setwd(libPath)
+  on.exit(setwd(owd))
+  tar(tmpFile, files = pkgName, compression = "gzip")
+   
+  # publish under a temporary name first, so other clusters never extract a partial tarball
+  partFile = paste0(cacheFile, ".part", Sys.getpid())
+  file.copy(tmpFile, partFile)
+  file.rename(partFile, cacheFile)
+  unlink(tmpFile)
+  cacheFile
+}
+
+resolvePkgDependencies <- function(pkgName, avail){
+  # Resolves the packages that install.packages(pkgName, dependencies=T) would install
+  #
+  # Args:
+  #   pkgName:  Name of the R pacakges to be installed (case sensitive)
+  #   avail:  Matrix of available packages, see available.packages()
+  #
+  # Return:
+  #   pkgName and all its dependencies that are not installed yet
+  direct = unlist(tools::package_dependencies(pkgName, db = avail,
+                                              which = c("Depends", "Imports", "LinkingTo", "Suggests")))
+  strong = unlist(tools::package_dependencies(unique(c(pkgName, direct)), db = avail,
+                                              which = c("Depends", "Imports", "LinkingTo"), recursive = TRUE))
+  deps = setdiff(unique(c(direct, strong)), rownames(installed.packages()))
+  pkgs = unique(c(pkgName, deps))
+  pkgs[pkgs %in% rownames(avail)]
+}
+ 
+getPkgManifest <- function(pkgDir){
+  # Builds the file manifest of an installed package
+  #
+  # Args:
+  #   pkgDir:  Directory of the installed package
+  #
+  # Return:
+  #   data.frame with the relative path, size and md5 hash of every file
+  files = sort(setdiff(list.files(pkgDir, recursive=TRUE, all.files=TRUE), ".manifest.tsv"))
+  data.frame(file = files,
+             size = file.size(file.path(pkgDir, files)),
+             md5 = unname(tools::md5sum(file.path(pkgDir, files))),
+             stringsAsFactors = FALSE)
+}
+
+readPkgManifest <- function(pkgDir){
+  # Reads the manifest that syncUserLib() stored with a published package.
+  # Packages published before manifests existed are hashed instead
+  #
+  # Args:
+  #   pkgDir:  Directory of the installed package
+  #
+  # Return:
+  #   data.frame with the relative path, size and md5 hash of every file, NULL if there is no package
+  manifestFile = file.path(pkgDir, ".manifest.tsv")
+  if (file.exists(manifestFile)) {
+    return(read.delim(manifestFile, colClasses = c("character", "numeric", "character")))
+  }
+  if (dir.exists(pkgDir)) {
+    return(getPkgManifest(pkgDir))
+  }
+  NULL
+}
+
+publishPkg <- function(pkgName, srcLib, genDir, manifest){
+  # Copies one package, together with its manifest, into the directory of a
+  # new generation of the user library, which no session reads yet (see syncUserLib())
+  #
+  # Args:
+  #   pkgName:  Name of the installed R package
+  #   srcLib:  Library that holds the freshly installed package
+  #   genDir:  Directory of the new generation
+  #   manifest:  File manifest of the package, see getPkgManifest()
+  #
+  # Return:
+  #   TRUE if the package was copied
+  pkgDir = file.path(genDir, pkgName)
+  dir.create(pkgDir)
+  srcFiles = list.files(file.path(srcLib, pkgName), full.names=TRUE, all.files=TRUE, no..=TRUE)
+  if (!all(file.copy(srcFiles, pkgDir, recursive=TRUE))) {
+    return(FALSE)
+  }
+  write.table(manifest, file.path(pkgDir, ".manifest.tsv"), sep="\\t", quote=FALSE, row.names=FALSE)
+  TRUE
+}
+
+syncUserLib <- function(srcLib, usrLibPath = getUserLibPath(), workers = 8){
+  # Syncs the packages installed in srcLib to the user library. Packages whose
+  # manifest (file sizes and md5 hashes) matches the published one are skipped.
+  # The others are published into a new generation of the library: a fresh
+  # directory gen-<id> with the changed packages and a copy of the unchanged ones
+  # of the current generation. The CURRENT pointer is switched to it last, so
+  # sessions resolve the previous or the new generation, never a half-published
+  # one, also on DBFS where directory renames are not atomic
+  #
+  # Args:
+  #   srcLib:  Library that holds the freshly installed packages
+  #   usrLibPath:  Optional. Library to sync the packages into
+  #   workers:  Optional. Number of packages copied at the same time
+  #
+  # Return:
+  #   Named logical vector, TRUE for every package that was published
+  currentLib = resolveUserLib(usrLibPath)
+  pkgs = list.files(srcLib)
+  manifests = lapply(file.path(srcLib, pkgs), getPkgManifest)
+  changed = vapply(seq_along(pkgs), function(i) {
+    published = readPkgManifest(file.path(currentLib, pkgs[i]))
+    is.null(published) ||
+      !identical(manifests[[i]]$file, published$file) ||
+      !identical(manifests[[i]]$size, published$size) ||
+      !identical(manifests[[i]]$md5, published$md5)
+  }, logical(1))
+  result = setNames(rep(FALSE, length(pkgs)), pkgs)
+   
+  if (any(changed)) {
+    # generation ids sort by time, and the .generation marker marks local disk mirrors as stale
+    generation = paste0("gen-", format(Sys.time(), "%Y%m%d%H%M%OS6"), "-", Sys.getpid())
+    genDir = file.path(usrLibPath, generation)
+    dir.create(genDir, recursive=TRUE)
+    kept = setdiff(list.files(currentLib), pkgs[changed])
+    kept = kept[file.exists(file.path(currentLib, kept, "DESCRIPTION"))]
+    copied = parallel::mclapply(kept, function(pkg) {
+      all(file.copy(file.path(currentLib, pkg), genDir, recursive=TRUE))
+    }, mc.cores = workers)
+    published = parallel::mclapply(which(changed), function(i) {
+      publishPkg(pkgs[i], srcLib, genDir, manifests[[i]])
+    }, mc.cores = workers)
+     
+    if (all(vapply(copied, isTRUE, logical(1))) && all(vapply(published, isTRUE, logical(1)))) {
+      writeLines(generation, file.path(genDir, ".generation"))
+      # the pointer is a single small file, written last: readers see the old or the new one
+      pointerPart = file.path(usrLibPath, paste0(".CURRENT.", Sys.getpid()))
+      writeLines(generation, pointerPart)
+      file.rename(pointerPart, file.path(usrLibPath, "CURRENT"))
+      result[changed] = TRUE
+       
+      # keep the previous generation for sessions that still load from it, and
+      # leave newer ones alone, which another sync may be publishing right now
+      old = list.files(usrLibPath, pattern="^gen-")
+      unlink(file.path(usrLibPath, old[old < basename(currentLib)]), recursive=TRUE)
+      if (usrLibPath == getUserLibPath()) {
+        setUserLibPath()
+      }
+    } else {
+      unlink(genDir, recursive=TRUE)
+    }
+  }
+  message(sprintf("Published %d package(s), %d unchanged", sum(result), sum(!changed)))
+  if (any(changed & !result)) {
+    warning("Failed to publish: ", paste(pkgs[changed & !result], collapse=", "))
+  }
+  result
+}
+ 
+databricks.install.packages <- function(pkgName, repo="http://cloud.r-project.org") {
   # Install standard R packages into user library repo which is specified by function setUserLibPath()
+  # Packages found in the binary package cache (see getPkgCachePath()) are extracted
+  # instead of compiled, and every package that does get compiled is added to the cache
   #
   # Args:
   #   pkgName:  Name of the R pacakges to be installed (case sensitive)
@@ -99,15 +435,28 @@ databricks.install.packages <- function(pkgName, repo="http://cloud.r-project.or
   #   tmpDir:  The temperary directory that holds the installed pacakge
    
   usrLibPath = setUserLibPath()
-  tmpDir <- tempfile(pattern = "{1}")
+  tmpDir <- tempfile(pattern = "{{ rlib_dir }}")
   dir.create(tmpDir)
-  install.packages(pkgName,repos=repo, dependencies=T, lib = tmpDir)
-  system(paste0("cp -r ", tmpDir, "/* ", usrLibPath))
+   
+  avail = available.packages(repos=repo)
+  pkgs = resolvePkgDependencies(pkgName, avail)
+  cached = vapply(pkgs, function(pkg) restorePkgBinary(pkg, avail[pkg, "Version"], tmpDir), logical(1))
+  toBuild = pkgs[!cached]
+   
+  if (length(toBuild) > 0) {
+    # cached dependencies in tmpDir must be visible while the others are compiled
+    .libPaths(c(tmpDir, .libPaths()))
+    install.packages(toBuild, repos=repo, dependencies=F, lib = tmpDir)
+    for (pkg in intersect(toBuild, list.files(tmpDir))) {
+      cachePkgBinary(pkg, tmpDir)
+    }
+  }
+  syncUserLib(tmpDir, usrLibPath)
   removeUserLibPath(tmpDir)
   tmpDir
-}}
+}
 
-databricks.install.github <- function(repo) {{
+databricks.install.github <- function(repo) {
   # Install standard R packages into user library repo which is specified by function setUserLibPath()
   #
   # Args:
@@ -116,18 +465,18 @@ databricks.install.github <- function(repo) {{
   # Return:
   #   tmpDir:  The temperary directory that holds the installed pacakge
   
-  tmpDir <- tempfile(pattern = "{1}")
+  tmpDir <- tempfile(pattern = "{{ rlib_dir }}")
   dir.create(tmpDir)
-  tmpPath = setUserLibPath(tmpDir)
+  tmpPath = setUserLibPath(tmpDir, localLibPath = NULL)
   require('devtools')
   install_github(repo)
   usrLibPath = setUserLibPath()
-  system(paste0("cp -r ", tmpPath, "/* ", usrLibPath))
+  syncUserLib(tmpPath, usrLibPath)
   removeUserLibPath(tmpPath)
   tmpDir
-}}
+}
  
-databricks.install_version <- function(pkgName, what.version, repo='http://cran.us.r-project.org') {{
+databricks.install_version <- function(pkgName, what.version, repo='http://cran.us.r-project.org') {
   # Install a specific version of standard R packages into user library repo
   # which is specified by function setUserLibPath()
   #
@@ -139,26 +488,153 @@ databricks.install_version <- function(pkgName, what.version, repo='http://cran.
   # Return:
   #   tmpDir:  The temperary directory that holds the installed pacakge
   usrLibPath = setUserLibPath()
-  tmpDir <- tempfile(pattern = "{1}")
+  tmpDir <- tempfile(pattern = "{{ rlib_dir }}")
   dir.create(tmpDir)
    
-  if (!suppressWarnings(library('devtools',logical.return=TRUE))){{
+  if (!suppressWarnings(library('devtools',logical.return=TRUE))){
       databricks.install.packages('devtools', repos=repo)
       require(devtools)
-  }}
+  }
    
-  if (!suppressWarnings(library('devtools',logical.return=TRUE))){{
+  if (!suppressWarnings(library('devtools',logical.return=TRUE))){
       databricks.install.packages('withr', repos=repo)
       require(withr)
-  }}
+  }
    
   withr::with_libpaths(new=tmpDir, install_version(pkgName, version=what.version, repos=repo, dependencies=TRUE))
-  system(paste0("cp -r ", tmpDir, "/* ", usrLibPath))
+  syncUserLib(tmpDir, usrLibPath)
   tmpDir
-}}
-setUserLibPath()   # add {0}/{1} into library search path
-""".format("/dbfs" + rstudio_home_path,"rlib")
-dbutils.fs.put("dbfs:" + rlib_install_path, script, True)
+}
+
+getUdfPackages <- function(f){
+  # Finds the packages a UDF references with pkg::fun, pkg:::fun, library(pkg),
+  # require(pkg) or requireNamespace("pkg"), including in nested functions
+  #
+  # Args:
+  #   f:  Function to be applied on the workers
+  #
+  # Return:
+  #   Character vector of package names
+  pkgs = character(0)
+  walk = function(e) {
+    if (!is.call(e)) {
+      return(invisible())
+    }
+    fn = if (is.name(e[[1]])) as.character(e[[1]]) else ""
+    if (fn %in% c("::", ":::")) {
+      pkgs <<- c(pkgs, as.character(e[[2]]))
+      return(invisible())
+    }
+    if (fn %in% c("library", "require", "requireNamespace", "loadNamespace") && length(e) > 1 &&
+        !isTRUE(e$character.only)) {
+      arg = if (!is.null(e$package)) e$package else e[[2]]
+      # library() and require() take a bare name, the others only a string
+      if (is.character(arg) || (is.name(arg) && fn %in% c("library", "require"))) {
+        pkgs <<- c(pkgs, as.character(arg))
+      }
+    }
+    for (a in as.list(e)) if (!missing(a)) walk(a)
+  }
+  walk(body(f))
+  unique(pkgs)
+}
+
+getPkgClosure <- function(pkgs, libPaths = .libPaths()){
+  # Resolves the installed packages that pkgs need at run time (Depends, Imports
+  # and LinkingTo, recursively). Base packages are on every worker, so they are left out
+  #
+  # Args:
+  #   pkgs:  Names of the R packages
+  #   libPaths:  Optional. Libraries to look the packages up in
+  #
+  # Return:
+  #   Named character vector with the version of every package in the closure
+  basePkgs = rownames(installed.packages(lib.loc = .Library, priority = "base"))
+  closure = character(0)
+  queue = setdiff(unique(pkgs), basePkgs)
+  while (length(queue) > 0) {
+    pkg = queue[1]
+    queue = queue[-1]
+    if (pkg %in% names(closure)) {
+      next
+    }
+    desc = suppressWarnings(packageDescription(pkg, lib.loc = libPaths, fields = c("Version", "Depends", "Imports", "LinkingTo")))
+    if (!is.list(desc)) {
+      stop("Package ", pkg, " is not installed")
+    }
+    closure[pkg] = desc$Version
+    deps = unlist(strsplit(unlist(desc[c("Depends", "Imports", "LinkingTo")]), ","))
+    deps = trimws(sub("[(].*$", "", deps[!is.na(deps)]))
+    queue = c(queue, setdiff(deps, c("R", "", basePkgs, names(closure))))
+  }
+  closure
+}
+
+getUdfBundle <- function(f, packages = character(0), libPaths = .libPaths()){
+  # Builds a bundle of just the packages a UDF needs, for spark_apply(packages = ...).
+  # Bundles are cached in the package cache, keyed by the hash of the package
+  # closure with versions, R version and OS/ABI, so they are built only once
+  #
+  # Args:
+  #   f:  Function to be applied on the workers
+  #   packages:  Optional. Packages f needs that getUdfPackages() cannot find
+  #   libPaths:  Optional. Libraries to take the packages from
+  #
+  # Return:
+  #   bundleFile:  The bundle tarball, FALSE if f needs no packages
+  closure = getPkgClosure(c(getUdfPackages(f), packages), libPaths)
+  if (length(closure) == 0) {
+    return(FALSE)
+  }
+  keyFile = tempfile()
+  writeLines(sort(paste(names(closure), closure)), keyFile)
+  closureHash = unname(tools::md5sum(keyFile))
+  unlink(keyFile)
+  bundleFile = file.path(getPkgCachePath(), "bundles", paste0(getPkgCacheKey("bundle", closureHash), ".tar"))
+  if (file.exists(bundleFile)) {
+    return(bundleFile)
+  }
+  dir.create(dirname(bundleFile), recursive=TRUE, showWarnings=FALSE)
+   
+  # link the packages into one directory, tar follows the links with -h
+  stagingDir = tempfile(pattern = "bundle")
+  dir.create(stagingDir)
+  on.exit(unlink(stagingDir, recursive=TRUE))
+  file.symlink(find.package(names(closure), lib.loc = libPaths), file.path(stagingDir, names(closure)))
+  tmpFile = tempfile(fileext = ".tar")
+  if (system2("tar", c("-chf", tmpFile, "-C", stagingDir, names(closure))) != 0) {
+    stop("Failed to build the package bundle ", bundleFile)
+  }
+   
+  # publish under a temporary name first, so other clusters never ship a partial bundle
+  partFile = paste0(bundleFile, ".part", Sys.getpid())
+  file.copy(tmpFile, partFile)
+  file.rename(partFile, bundleFile)
+  unlink(tmpFile)
+  message(sprintf("Bundled %d package(s) for the UDF: %s", length(closure), paste(names(closure), collapse=", ")))
+  bundleFile
+}
+
+databricks.spark_apply <- function(x, f, ..., packages = character(0)){
+  # Runs sparklyr::spark_apply() with a bundle of only the packages f needs,
+  # instead of all packages on .libPaths()
+  #
+  # Args:
+  #   x:  tbl_spark to apply f to
+  #   f:  Function to be applied on the workers
+  #   ...:  Other arguments of sparklyr::spark_apply()
+  #   packages:  Optional. Packages f needs that getUdfPackages() cannot find
+  #
+  # Return:
+  #   The tbl_spark returned by sparklyr::spark_apply()
+  sparklyr::spark_apply(x, f, ..., packages = getUdfBundle(f, packages))
+}
+""", dbfs_home="/dbfs" + rstudio_home_path, rlib_dir="rlib", pkg_cache_path="/dbfs" + rpkg_cache_path, local_rlib_path=local_rlib_path)
+
+script = rlib_path_script + rlib_helpers_script + render_template("""
+setUserLibPath()   # add {{ dbfs_home }}/{{ rlib_dir }} into library search path
+""", dbfs_home="/dbfs" + rstudio_home_path, rlib_dir="rlib")
+artefacts["dbfs:" + rlib_install_path] = script
 
 # COMMAND ----------
 
@@ -168,74 +644,225 @@ dbutils.fs.put("dbfs:" + rlib_install_path, script, True)
 # MAGIC 
 # MAGIC The most important parts that are added to the below `.Rprofile`
 # MAGIC * Setting a default working directory to `dbfs`. This will ensure that RStudio users do not save their files on the cluster driver, which could cause the loss of files.
-# MAGIC * Running the library script that contains the R library utility functions
+# MAGIC * Running the library script that contains the R library utility functions. Only the functions that set the library search path are part of the profile itself. The install helpers (`databricks.install.packages` etc.) are stubs, which source a local disk copy of the library script the first time one of them is used, so sessions that never install a package do not pay for them.
+# MAGIC 
+# MAGIC The script can also profile the session startup. Set `r_startup_profile = True` below, or the environment variable `DATABRICKS_R_STARTUP_PROFILE=TRUE` on the cluster, and every step (including the DBFS `file.exists`/`dir.create` calls in `setUserLibPath()`) is timed. Each session writes its timings as JSON lines to `startup_logs/<user>` in the mounted folder.
 
 # COMMAND ----------
 
+import re
+
 r_config_path = rstudio_home_path + "/init/config.r"
+r_startup_log_path = rstudio_home_path + "/startup_logs"   # Per-user logs of the startup profiler
+r_startup_profile = False                                  # Profile every session, or only when DATABRICKS_R_STARTUP_PROFILE=TRUE
 
 # COMMAND ----------
 
-script = """
+script = render_template("""
 print('Executing custom site Rprofile...')
+
+# startup profiling (opt-in): times every step below and appends the timings
+# to a per-user log in {{ startup_log_path }}
+.dbStartup = new.env()
+.dbStartup$enabled = {{ startup_profile }} || identical(toupper(Sys.getenv("DATABRICKS_R_STARTUP_PROFILE")), "TRUE")
+.dbStartup$started = Sys.time()
+.dbStartup$records = character()
+
+.dbStartupTime <- function(step, expr) {
+  if (!.dbStartup$enabled) {
+    return(invisible(expr))
+  }
+  started = Sys.time()
+  result = expr
+  .dbStartup$records = c(.dbStartup$records,
+                         sprintf('"step":"%s","started":"%s","elapsed_ms":%.2f', step,
+                                 format(started, "%Y-%m-%dT%H:%M:%OS3%z"),
+                                 1000 * as.numeric(difftime(Sys.time(), started, units = "secs"))))
+  invisible(result)
+}
+
+.dbStartupFlush <- function() {
+  if (!.dbStartup$enabled) {
+    return(invisible())
+  }
+  user = Sys.getenv("USER", Sys.info()[["user"]])
+  host = Sys.info()[["nodename"]]
+  session = sprintf('"user":"%s","cluster_id":"%s","host":"%s","pid":%d,"r_version":"%s"',
+                    user, Sys.getenv("DB_CLUSTER_ID"), host, Sys.getpid(), as.character(getRversion()))
+  total = sprintf('"step":"total","started":"%s","elapsed_ms":%.2f',
+                  format(.dbStartup$started, "%Y-%m-%dT%H:%M:%OS3%z"),
+                  1000 * as.numeric(difftime(Sys.time(), .dbStartup$started, units = "secs")))
+  logDir = file.path("{{ startup_log_path }}", user)
+  logFile = file.path(logDir, sprintf("%s_%s_%d.jsonl", format(.dbStartup$started, "%Y%m%d%H%M%S"), host, Sys.getpid()))
+  # a failing profiler must never break the session startup
+  tryCatch({
+    dir.create(logDir, recursive = TRUE, showWarnings = FALSE)
+    writeLines(paste0("{", session, ",", c(.dbStartup$records, total), "}"), logFile)
+  }, error = function(e) message("Could not write the startup profile: ", conditionMessage(e)))
+  # later calls of setUserLibPath() are not part of the startup
+  .dbStartup$enabled = FALSE
+}
+
 # setup environment variables
-Sys.setenv("GITHUB_PAT" = "MY_PAT")
+.dbStartupTime("Sys.setenv", Sys.setenv("GITHUB_PAT" = "MY_PAT"))
 
 # warn on partial matches
-options(warnPartialMatchAttr = TRUE,
-        warnPartialMatchDollar = TRUE,
-        warnPartialMatchArgs = TRUE)
+.dbStartupTime("options: warnPartialMatch", options(warnPartialMatchAttr = TRUE,
+                                                     warnPartialMatchDollar = TRUE,
+                                                     warnPartialMatchArgs = TRUE))
 
 # enable autocompletions for package names in
 # `require()`, `library()`
-utils::rc.settings(ipck = TRUE)
+.dbStartupTime("utils::rc.settings", utils::rc.settings(ipck = TRUE))
 
 # set working directory
-setwd("{0}")
+.dbStartupTime("setwd", setwd("{{ dbfs_home }}"))
 
 # warnings are errors
-options(warn = 2)
+.dbStartupTime("options: warn", options(warn = 2))
 
 # fancy quotes are annoying and lead to
 # 'copy + paste' bugs / frustrations
-options(useFancyQuotes = FALSE)
+.dbStartupTime("options: useFancyQuotes", options(useFancyQuotes = FALSE))
+
+# add the library to the search path. This is the only part of the library
+# install code that runs eagerly, the directory is created on the first install
+{{ rlib_path_script }}
+.dbStartupTime("setUserLibPath", setUserLibPath(create = FALSE))
+
+# library install code: stubs that source the local disk copy of libs_install.r
+# the first time one of the helpers is used
+.dbHelpers = new.env()
+.dbLoadHelpers <- function() {
+  if (is.null(.dbHelpers$env)) {
+    helpersFile = if (file.exists("{{ local_rlib_install_path }}")) "{{ local_rlib_install_path }}" else "{{ rlib_install_path }}"
+    env = new.env(parent = globalenv())
+    sys.source(helpersFile, envir = env)
+    .dbHelpers$env = env
+  }
+  .dbHelpers$env
+}
+for (.dbHelper in c({{ lazy_helpers }})) {
+  local({
+    helper = .dbHelper
+    delayedAssign(helper, get(helper, envir = .dbLoadHelpers()), assign.env = globalenv())
+  })
+}
+rm(.dbHelper)
+
+.dbStartupFlush()
+""", dbfs_home="/dbfs" + rstudio_home_path, rlib_install_path="/dbfs" + rlib_install_path,
+   startup_profile="TRUE" if r_startup_profile else "FALSE", startup_log_path="/dbfs" + r_startup_log_path,
+   rlib_path_script=rlib_path_script, local_rlib_install_path=local_rlib_install_path,
+   lazy_helpers=", ".join('"{0}"'.format(name) for name in re.findall(r"^([\w.]+) <- function", rlib_helpers_script, re.M)))
+artefacts["dbfs:" + r_config_path] = script
+
+# COMMAND ----------
+
+# Session startup latency per step and cluster, from the startup profiler logs (none before a session was profiled)
+import glob
 
-# source library install code 
-source('{1}')
-""".format("/dbfs" + rstudio_home_path, "/dbfs" + rlib_install_path)
-dbutils.fs.put("dbfs:" + r_config_path, script, True)
+if glob.glob("/dbfs" + r_startup_log_path + "/*/*.jsonl"):
+    startup_logs = spark.read.json("dbfs:" + r_startup_log_path + "/*/*.jsonl")
+    display(startup_logs.groupBy("cluster_id", "step").agg({"elapsed_ms": "avg", "pid": "count"}).orderBy("cluster_id", "step"))
+else:
+    print("No startup profiles in {0} yet".format(r_startup_log_path))
 
 # COMMAND ----------
 
 # MAGIC %md
 # MAGIC #### 3. Using bash init scripts to configure .Rprofile/Rprofile.site
 # MAGIC Now that we defined the R initialisation script in step 2, we must add this to either `.Rprofile` or `Rprofile.site` to make sure R initialises this script. We do this by making use of cluster init scripts, which are defined below. There are two cluster init scripts: One is used to set up the `.Rprofile` the other for `Rprofile.site` . It is left to the user to choose which one is most appropriate. For R configurations that should apply to all users, going with `Rprofile.site` is recommended.
+# MAGIC
+# MAGIC Both init scripts write `config.r` into a block between two marker lines, and replace that block in place instead of appending to the file. The first marker line holds the sha256 hash of `config.r`, so when the block is already up to date the file is not touched at all. However often a cluster restarts, R sources `config.r` exactly once per session.
+
+# COMMAND ----------
+
+rprofile_block_function = render_template("""
+write_rprofile_block() {
+  # Writes config.r into the block between the marker lines of an R profile, unless it is already there
+  local target="$1" config="$2"
+  local hash=$(sha256sum "$config" | cut -d' ' -f1)
+  if [[ -f "$target" ]] && grep -qxF "{{ begin_marker }} $hash" "$target"; then
+    return 0
+  fi
+  touch "$target"
+  {
+    sed '/^{{ begin_marker }}/,/^{{ end_marker }}$/d' "$target"
+    echo "{{ begin_marker }} $hash"
+    cat "$config"
+    echo "{{ end_marker }}"
+  } > "$target.tmp"
+  chmod --reference="$target" "$target.tmp"
+  mv "$target.tmp" "$target"
+}
+""", begin_marker="# >>> databricks r setup >>>", end_marker="# <<< databricks r setup <<<").strip().replace("\n", "\n  ")  # indented for the init scripts
 
 # COMMAND ----------
 
 # MAGIC %md
 # MAGIC ##### option 1: Init script for .Rprofile
-# MAGIC The first one is for creating the `.Rprofile` R initialisation script, which is tied to a specific user. As such, it must be added to the `/home/<user_email/.Rprofile` directory in the driver. Note that a for loop could be used in the init script to add the `.Rprofile` script to multiple user directories.
+# MAGIC The first one is for creating the `.Rprofile` R initialisation script, which is tied to a specific user. As such, it must be added to the `/home/<user_email/.Rprofile` directory in the driver.
+# MAGIC * One init script provisions all users of the cluster. The users are read from `rprofile_users_path` (one user per line), which is published next to `config.r`, so adding a user does not change the init script.
+# MAGIC * The init script copies `config.r` to local disk once, and then sets up the home folders of the users several at a time, so the boot time of the driver hardly grows with the number of users.
+# MAGIC * To provision a list of users from a file, use `rprofile_users = read_rprofile_users("/dbfs/<path>/users.txt")`.
 
 # COMMAND ----------
 
-rprofile_init_script_location = "dbfs:/tmp/{0}/init/rstudio_init_script.sh".format(username) # Must be located in root bucket
+def read_rprofile_users(path):
+    """Reads user names from a file with one user per line. Blank lines and lines starting with # are skipped."""
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith("#")]
+
+
+def render_rprofile_users(users):
+    """Renders the list of users for the init script. Raises a ValueError for names that are not safe as a home folder."""
+    invalid = [user for user in users if not re.fullmatch(r"[\w.@+-]+", user) or user.startswith(".")]
+    if invalid:
+        raise ValueError("Invalid user names: " + ", ".join(invalid))
+    return "".join(user + "\n" for user in dict.fromkeys(users))
 
 # COMMAND ----------
 
-rprofile_init_script = """
+rprofile_users = [username]                      # Users to set up .Rprofile for, or read_rprofile_users(<file>)
+rprofile_users_path = rstudio_home_path + "/init/rprofile_users.txt"
+rprofile_workers = 16                            # Number of home folders set up at the same time
+local_r_config_path = "/local_disk0/r_helpers/config.r"
+local_rprofile_users_path = "/local_disk0/r_helpers/rprofile_users.txt"
+rprofile_init_script_location = "dbfs:/databricks/init/rstudio/rstudio_init_script.sh" # Must be located in root bucket
+
+# COMMAND ----------
+
+rprofile_init_script = render_template("""
 #!/bin/bash
 set -euxo pipefail
 
 if [[ $DB_IS_DRIVER = "TRUE" ]]; then  
   
-  USER="{0}"
-  mkdir -p /home/$USER
-  chmod 777 /home/$USER
-  echo "$(cat {1})" >> /home/$USER/.Rprofile
+  mkdir -p $(dirname {{ local_rlib_install_path }}) $(dirname {{ local_r_config_path }})
+  cp {{ rlib_install_path }} {{ local_rlib_install_path }}
+  chmod 644 {{ local_rlib_install_path }}
+  cp {{ r_config_path }} {{ local_r_config_path }}
+  cp {{ rprofile_users_path }} {{ local_rprofile_users_path }}
+
+  {{ rprofile_block_function }}
+
+  provision_user() {
+    local home="/home/$1"
+    mkdir -p "$home"
+    chmod 777 "$home"
+    write_rprofile_block "$home/.Rprofile" {{ local_r_config_path }}
+  }
+  export -f write_rprofile_block provision_user
+
+  xargs -P {{ workers }} -I USER bash -c 'provision_user "$1"' _ USER < {{ local_rprofile_users_path }}
 fi
-""".format(username, "/dbfs" + r_config_path)
-dbutils.fs.put(rprofile_init_script_location,rprofile_init_script, True)
+""", r_config_path="/dbfs" + r_config_path, rlib_install_path="/dbfs" + rlib_install_path,
+   local_rlib_install_path=local_rlib_install_path, local_r_config_path=local_r_config_path,
+   rprofile_users_path="/dbfs" + rprofile_users_path, local_rprofile_users_path=local_rprofile_users_path,
+   workers=rprofile_workers, rprofile_block_function=rprofile_block_function)
+artefacts[rprofile_init_script_location] = rprofile_init_script
+artefacts["dbfs:" + rprofile_users_path] = render_rprofile_users(rprofile_users)
 
 # COMMAND ----------
 
@@ -253,19 +880,567 @@ rprofilesite_init_script_location = "dbfs:/tmp/{0}/init/rprofilesite_init_script
 
 # COMMAND ----------
 
-rprofile_site_init_script = """
+rprofile_site_init_script = render_template("""
 #!/bin/bash
 set -euxo pipefail
 
 if [[ $DB_IS_DRIVER = "TRUE" ]]; then  
   
+  {{ rprofile_block_function }}
+
   chmod 777 /usr/lib/R/etc/Rprofile.site
-  echo "$(cat {1})" >> /usr/lib/R/etc/Rprofile.site
+  write_rprofile_block /usr/lib/R/etc/Rprofile.site {{ r_config_path }}
+
+  mkdir -p $(dirname {{ local_rlib_install_path }})
+  cp {{ rlib_install_path }} {{ local_rlib_install_path }}
+  chmod 644 {{ local_rlib_install_path }}
 fi
-""".format(username, "/dbfs" + r_config_path)
-dbutils.fs.put(rprofilesite_init_script_location,rprofile_site_init_script, True)
+""", r_config_path="/dbfs" + r_config_path, rlib_install_path="/dbfs" + rlib_install_path,
+   local_rlib_install_path=local_rlib_install_path,
+   rprofile_block_function=rprofile_block_function)
+artefacts[rprofilesite_init_script_location] = rprofile_site_init_script
 
 # COMMAND ----------
 
 # Add below path to init scripts when configuring your RStudio cluster!
-rprofilesite_init_script_location
\ No newline at end of file
+rprofilesite_init_script_location
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ##### Publishing the scripts
+# MAGIC Uploads `libs_install.r`, `config.r` and both init scripts in one batch. Steps 4 and 6 use `libs_install.r`, so run this cell before them.
+
+# COMMAND ----------
+
+publish_artefacts(artefacts, publish_backends)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC #### 4. Bootstrapping the central library in parallel
+# MAGIC `databricks.install.packages(pkgName)` installs the whole dependency closure of a package in one serial `install.packages` call. When a fresh R runtime needs a large set of packages, the planner below is much faster:
+# MAGIC * It resolves the dependency graph (`Depends`, `Imports`, `LinkingTo`) from a local copy of the CRAN `PACKAGES` index, which is downloaded again once it is older than `packages_index_max_age`. Packages installed in any library of R, including the recommended packages and those preinstalled on the runtime, are not built again.
+# MAGIC * It builds the packages on a bounded pool of workers in topological order, so independent packages are compiled at the same time. Every build goes through the binary package cache of step 1.
+# MAGIC * Once all builds are done, the packages are synced to the central library with `syncUserLib`, and the critical path and the wall-clock time saved are reported.
+# MAGIC * Nothing is built unless you list packages in `r_bootstrap_packages`, or call `install_packages_parallel` yourself.
+
+# COMMAND ----------
+
+import gzip
+import os
+import subprocess
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+cran_repo = "https://cloud.r-project.org"
+packages_index_path = "/dbfs" + rstudio_home_path + "/pkg_cache/PACKAGES.gz"   # Local copy of the CRAN PACKAGES index
+packages_index_max_age = 24 * 3600               # Seconds after which the local copy of the index is downloaded again
+r_bootstrap_packages = []                        # Packages to install when this notebook runs, e.g. ["tidyverse", "forecast", "prophet"]
+
+# Packages that ship with R itself and are never installed from CRAN
+r_base_packages = {"R", "base", "compiler", "datasets", "graphics", "grDevices", "grid", "methods",
+                   "parallel", "splines", "stats", "stats4", "tcltk", "tools", "utils"}
+
+# COMMAND ----------
+
+def read_packages_index(path):
+    """Parses a CRAN `PACKAGES` index into {package: {"Version": version, "deps": set of dependencies}}."""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt") as f:
+        blocks = f.read().strip().split("\n\n")
+
+    index = {}
+    for block in blocks:
+        fields, field = {}, None
+        for line in block.splitlines():
+            if line[:1] in (" ", "\t") and field:
+                fields[field] += " " + line.strip()   # continuation line
+            else:
+                field, _, value = line.partition(":")
+                fields[field] = value.strip()
+        deps = set()
+        for dep_field in ("Depends", "Imports", "LinkingTo"):
+            for dep in fields.get(dep_field, "").split(","):
+                name = dep.split("(")[0].strip()
+                if name and name not in r_base_packages:
+                    deps.add(name)
+        index[fields["Package"]] = {"Version": fields["Version"], "deps": deps}
+    return index
+
+
+def resolve_install_graph(index, packages, installed=()):
+    """Returns {package: dependencies to build first} for the packages and all dependencies that are not installed yet."""
+    graph, todo = {}, list(packages)
+    while todo:
+        pkg = todo.pop()
+        if pkg in graph:
+            continue
+        if pkg not in index:
+            raise ValueError("Package '{0}' is not in the PACKAGES index".format(pkg))
+        graph[pkg] = {dep for dep in index[pkg]["deps"] if dep not in installed}
+        todo.extend(graph[pkg])
+    return graph
+
+
+def critical_path(graph, durations):
+    """Returns (seconds, [packages]) of the longest chain of builds that depend on each other."""
+    longest = {}
+    def visit(pkg):
+        if pkg not in longest:
+            chains = [visit(dep) for dep in graph[pkg]]
+            seconds, path = max(chains, default=(0.0, []))
+            longest[pkg] = (seconds + durations[pkg], path + [pkg])
+        return longest[pkg]
+    return max((visit(pkg) for pkg in graph), default=(0.0, []))
+
+
+def refresh_packages_index(path=packages_index_path, repo=cran_repo, max_age=packages_index_max_age):
+    """Downloads the CRAN PACKAGES index to path, unless the local copy is younger than max_age seconds."""
+    if os.path.exists(path) and time.time() - os.path.getmtime(path) < max_age:
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    urllib.request.urlretrieve(repo + "/src/contrib/PACKAGES.gz", path + ".part")
+    os.replace(path + ".part", path)
+    return path
+
+
+def current_rlib_path(r_version):
+    """Returns the directory of the current generation of the central library of an R version, see resolveUserLib."""
+    usr_lib_path = "/dbfs" + rstudio_home_path + "/rlib/" + r_version
+    pointer = os.path.join(usr_lib_path, "CURRENT")
+    if os.path.exists(pointer):
+        with open(pointer) as f:
+            return os.path.join(usr_lib_path, f.read().strip())
+    return usr_lib_path
+
+
+def installed_r_packages(lib_paths=()):
+    """Returns the packages installed in any library of R (site, recommended and base packages) and in lib_paths."""
+    expr = "cat(rownames(installed.packages(lib.loc = c(.libPaths(), {0}))), sep = '\\n')".format(
+        ", ".join("'{0}'".format(path) for path in lib_paths if os.path.exists(path)) or "NULL")
+    output = subprocess.run(["Rscript", "--vanilla", "-e", expr], check=True, capture_output=True, text=True).stdout
+    return set(output.split())
+
+
+def build_r_package(pkg, version, lib_path, repo):
+    """Builds a single package into lib_path, using the binary package cache. Returns the build time in seconds."""
+    started = time.time()
+    # A package whose version was superseded after the index was downloaded moved to the CRAN archive
+    expr = ("source('{0}'); "
+            "if (!restorePkgBinary('{1}', '{2}', '{3}')) {{ "
+            "src = tempfile(fileext = '.tar.gz'); "
+            "urls = c('{4}/src/contrib/{1}_{2}.tar.gz', '{4}/src/contrib/Archive/{1}/{1}_{2}.tar.gz'); "
+            "ok = FALSE; "
+            "for (url in urls) {{ ok = tryCatch(download.file(url, src, quiet = TRUE) == 0, condition = function(e) FALSE); if (ok) break }}; "
+            "if (!ok) stop('Could not download {1} {2} from {4}'); "
+            "install.packages(src, repos = NULL, type = 'source', lib = '{3}'); "
+            "cachePkgBinary('{1}', '{3}') }}").format("/dbfs" + rlib_install_path, pkg, version, lib_path, repo)
+    # --vanilla keeps Rprofile.site (and with it config.r) out of the build processes
+    env = dict(os.environ, R_LIBS=lib_path)
+    subprocess.run(["Rscript", "--vanilla", "-e", expr], env=env, check=True, capture_output=True, text=True)
+    return time.time() - started
+
+
+def install_packages_parallel(packages, index, repo=cran_repo, max_workers=8):
+    """Installs packages and their dependency closure into the central library, building independent packages concurrently."""
+    r_version = subprocess.run(["Rscript", "--vanilla", "-e", "cat(as.character(getRversion()))"],
+                               check=True, capture_output=True, text=True).stdout.strip()
+    usr_lib_path = "/dbfs" + rstudio_home_path + "/rlib/" + r_version
+    installed = installed_r_packages([current_rlib_path(r_version)])
+    graph = resolve_install_graph(index, packages, installed - set(packages))
+
+    waiting_on = {pkg: set(deps) for pkg, deps in graph.items()}
+    dependents = {pkg: set() for pkg in graph}
+    for pkg, deps in graph.items():
+        for dep in deps:
+            dependents[dep].add(pkg)
+
+    tmp_dir = tempfile.mkdtemp(prefix="rlib")
+    durations, failed = {}, {}
+    ready = [pkg for pkg, deps in waiting_on.items() if not deps]
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        running = {}
+        while ready or running:
+            for pkg in ready:
+                running[pool.submit(build_r_package, pkg, index[pkg]["Version"], tmp_dir, repo)] = pkg
+            ready = []
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                pkg = running.pop(future)
+                try:
+                    durations[pkg] = future.result()
+                except subprocess.CalledProcessError as e:
+                    failed[pkg] = e.stderr
+                    continue
+                for dependent in dependents[pkg]:
+                    waiting_on[dependent].discard(pkg)
+                    if not waiting_on[dependent]:
+                        ready.append(dependent)
+    wall_time = time.time() - started
+
+    if durations:
+        os.makedirs(usr_lib_path, exist_ok=True)
+        sync_expr = "source('{0}'); syncUserLib('{1}', '{2}')".format("/dbfs" + rlib_install_path, tmp_dir, usr_lib_path)
+        subprocess.run(["Rscript", "--vanilla", "-e", sync_expr], check=True)
+
+    skipped = set(graph) - set(durations) - set(failed)
+    serial_time = sum(durations.values())
+    path_time, path = critical_path({pkg: graph[pkg] & set(durations) for pkg in durations}, durations)
+    print("Built {0} packages in {1:.0f}s on {2} workers (serial: {3:.0f}s, saved: {4:.0f}s)".format(
+        len(durations), wall_time, max_workers, serial_time, serial_time - wall_time))
+    print("Critical path ({0:.0f}s): {1}".format(path_time, " -> ".join(path)))
+    if failed:
+        print("Failed: {0}; skipped because a dependency failed: {1}".format(sorted(failed), sorted(skipped)))
+
+    return {"durations": durations, "failed": failed, "skipped": skipped, "wall_time": wall_time,
+            "serial_time": serial_time, "critical_path": path, "critical_path_time": path_time}
+
+# COMMAND ----------
+
+# Install the packages your users need, see r_bootstrap_packages above. Building them can take a long time
+if r_bootstrap_packages:
+    cran_index = read_packages_index(refresh_packages_index())
+    install_report = install_packages_parallel(r_bootstrap_packages, cran_index)
+
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC #### 5. Mirroring the central library to local disk
+# MAGIC With the central library first on `.libPaths()`, every `library()` call reads its files through the DBFS fusion mount, which makes loading large packages slow on a cold session. The init script below mirrors the central library to the local disk of the driver, and `setUserLibPath()` puts that mirror in front of the central library as long as it is fresh.
+# MAGIC * The init script writes `hydrate.sh` to the local disk. It copies every package whose `.manifest.tsv` differs from the central one, several at a time, and swaps it in with a rename.
+# MAGIC * Every generation of the central library that `syncUserLib` publishes has its own `.generation` marker. `hydrate.sh` records the generation it copied, and `setUserLibPath()` only uses the mirror when both generations match. Otherwise R keeps loading from DBFS and `hydrate.sh` is started in the background.
+# MAGIC * With `rlib_mirror_mode = "full"` the init script hydrates the mirror before the cluster is up. With `"lazy"` it runs in the background, so the cluster starts right away and sessions switch to the mirror as soon as it is complete.
+
+# COMMAND ----------
+
+rlib_mirror_mode = "lazy"                       # "full" or "lazy"
+rlib_mirror_workers = 8                         # Number of packages copied at the same time
+rlib_mirror_init_script_location = "dbfs:/tmp/{0}/init/rlib_mirror_init_script.sh".format(username)
+
+# COMMAND ----------
+
+rlib_hydrate_script = render_template("""#!/bin/bash
+# Copies the packages of the central library that changed to the local disk mirror
+set -euo pipefail
+
+R_VERSION=$(Rscript --vanilla -e 'cat(as.character(getRversion()))')
+CENTRAL_LIB="{{ central_rlib_path }}/$R_VERSION"
+if [[ -f "$CENTRAL_LIB/CURRENT" ]]; then
+  # the packages are in the generation the pointer names, see syncUserLib()
+  CENTRAL_LIB="$CENTRAL_LIB/$(cat "$CENTRAL_LIB/CURRENT")"
+fi
+export CENTRAL_LIB
+export LOCAL_LIB="{{ local_rlib_path }}/$R_VERSION"
+mkdir -p "$LOCAL_LIB"
+
+exec 9>"$LOCAL_LIB/.lock"
+flock -n 9 || exit 0   # a hydration is already running
+
+GENERATION=$(cat "$CENTRAL_LIB/.generation" 2>/dev/null || echo "none")
+
+hydrate_pkg() {
+  local pkg="$1"
+  if [[ -f "$LOCAL_LIB/$pkg/.manifest.tsv" ]] && cmp -s "$CENTRAL_LIB/$pkg/.manifest.tsv" "$LOCAL_LIB/$pkg/.manifest.tsv"; then
+    return 0
+  fi
+  rm -rf "$LOCAL_LIB/.$pkg.staging" "$LOCAL_LIB/.$pkg.old"
+  cp -r "$CENTRAL_LIB/$pkg" "$LOCAL_LIB/.$pkg.staging"
+  if [[ -d "$LOCAL_LIB/$pkg" ]]; then
+    mv "$LOCAL_LIB/$pkg" "$LOCAL_LIB/.$pkg.old"
+  fi
+  mv "$LOCAL_LIB/.$pkg.staging" "$LOCAL_LIB/$pkg"
+  rm -rf "$LOCAL_LIB/.$pkg.old"
+}
+export -f hydrate_pkg
+
+ls "$CENTRAL_LIB" | xargs -P {{ workers }} -I PKG bash -c 'hydrate_pkg "$1"' _ PKG
+echo "$GENERATION" > "$LOCAL_LIB/.generation"
+chmod -R a+rwX "$LOCAL_LIB"   # R sessions re-run this script when the mirror is stale
+""", central_rlib_path="/dbfs" + rstudio_home_path + "/rlib", local_rlib_path=local_rlib_path,
+   workers=rlib_mirror_workers)
+
+# COMMAND ----------
+
+rlib_mirror_init_script = render_template("""
+#!/bin/bash
+set -euxo pipefail
+
+if [[ $DB_IS_DRIVER = "TRUE" ]]; then
+  mkdir -p {{ local_rlib_path }}
+  chmod 777 {{ local_rlib_path }}
+
+  cat > {{ local_rlib_path }}/hydrate.sh <<'EOF'
+{{ hydrate_script }}EOF
+  chmod 755 {{ local_rlib_path }}/hydrate.sh
+
+  if [[ "{{ mode }}" = "full" ]]; then
+    {{ local_rlib_path }}/hydrate.sh
+  else
+    nohup {{ local_rlib_path }}/hydrate.sh > {{ local_rlib_path }}/hydrate.log 2>&1 &
+  fi
+fi
+""", local_rlib_path=local_rlib_path, hydrate_script=rlib_hydrate_script,
+   mode=rlib_mirror_mode)
+publish_artefacts({rlib_mirror_init_script_location: rlib_mirror_init_script}, publish_backends)
+
+# COMMAND ----------
+
+# Add below path to init scripts when configuring your RStudio cluster, next to the .Rprofile or Rprofile.site init script!
+rlib_mirror_init_script_location
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC #### 6. Prebuilt library snapshots
+# MAGIC Hydrating the local mirror package by package still reads thousands of small files through the DBFS fusion mount. For fast cluster startup, the central library can be packed into a snapshot instead:
+# MAGIC * `build_rlib_snapshot()` packs a version of the central library into one zstd compressed tar archive, split into parts, next to a `manifest.json` (packages, parts and their sha256 hashes) under `snapshots/<R version>/<snapshot id>`. `LATEST` points to the most recent snapshot.
+# MAGIC * Building a snapshot reads the whole library, so it only runs when you ask for it: set `rlib_build_snapshot = True`, or call `build_rlib_snapshot()` after installing packages. It is skipped when the library did not change since the `LATEST` snapshot (the same `.generation`), unless you pass `force=True`. Old snapshots are not removed, delete the ones no cluster pins anymore.
+# MAGIC * The snapshot init script copies the parts of the snapshot (`LATEST` or a pinned snapshot id) to local disk in parallel streams, verifies them and unpacks them into the local mirror of step 5, once per node. It also installs `hydrate.sh`, so `setUserLibPath()` can catch up with packages installed after the snapshot was built. As long as no snapshot was built, the init script runs `hydrate.sh` in the background instead, like the mirror init script of step 5 in `"lazy"` mode.
+
+# COMMAND ----------
+
+import hashlib
+import json
+import shlex
+import shutil
+
+rlib_snapshot_path = rstudio_home_path + "/snapshots"
+rlib_snapshot_parts = 16                        # Number of parts, which are also the number of download streams
+rlib_snapshot_id = "LATEST"                     # Snapshot used by the init script: "LATEST" or a snapshot id to pin
+rlib_build_snapshot = False                     # Build a snapshot of the central library when this notebook runs
+rlib_snapshot_init_script_location = "dbfs:/tmp/{0}/init/rlib_snapshot_init_script.sh".format(username)
+
+# COMMAND ----------
+
+def sha256_file(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def current_r_version():
+    return subprocess.run(["Rscript", "--vanilla", "-e", "cat(as.character(getRversion()))"],
+                          check=True, capture_output=True, text=True).stdout.strip()
+
+
+def read_latest_rlib_snapshot(r_version=None):
+    """Returns the manifest of the LATEST snapshot of an R version, or None when there is no snapshot yet."""
+    snapshot_root = "/dbfs" + rlib_snapshot_path + "/" + (r_version or current_r_version())
+    if not os.path.exists(os.path.join(snapshot_root, "LATEST")):
+        return None
+    with open(os.path.join(snapshot_root, "LATEST")) as f:
+        snapshot_id = f.read().strip()
+    with open(os.path.join(snapshot_root, snapshot_id, "manifest.json")) as f:
+        return json.load(f)
+
+
+def build_rlib_snapshot(r_version=None, parts=rlib_snapshot_parts, level=10, force=False):
+    """Packs the central library of an R version into a zstd compressed snapshot on DBFS. Returns the snapshot manifest,
+    the manifest of the LATEST snapshot when the library did not change since, or None when the library is empty."""
+    r_version = r_version or current_r_version()
+    usr_lib_path = current_rlib_path(r_version)
+    packages = sorted(pkg for pkg in os.listdir(usr_lib_path) if not pkg.startswith(".")) if os.path.isdir(usr_lib_path) else []
+    if not packages:
+        print("The central library {0} has no packages yet, there is nothing to snapshot".format(usr_lib_path))
+        return None
+
+    # Read the generation first: if the library changes while it is packed, mirrors see the snapshot as stale
+    generation_file = os.path.join(usr_lib_path, ".generation")
+    generation = open(generation_file).read().strip() if os.path.exists(generation_file) else "none"
+    latest = read_latest_rlib_snapshot(r_version)
+    if latest is not None and generation != "none" and latest["generation"] == generation and not force:
+        print("Snapshot {0} is up to date with the central library".format(latest["snapshot_id"]))
+        return latest
+    if shutil.which("zstd") is None:
+        raise RuntimeError("zstd is not installed, run `apt-get install -y zstd` on the driver first")
+
+    snapshot_id = time.strftime("%Y%m%d-%H%M%S")
+    os.makedirs("/local_disk0/tmp", exist_ok=True)
+    build_dir = tempfile.mkdtemp(prefix="rlib_snapshot", dir="/local_disk0/tmp")
+    archive = os.path.join(build_dir, "rlib.tar.zst")
+    # With pipefail a tar error, e.g. a package removed while it is packed, fails the build instead of publishing a truncated archive
+    command = "tar -C {0} -cf - -- {1} | zstd -T0 -{2} -q -o {3}".format(
+        shlex.quote(usr_lib_path), " ".join(shlex.quote(pkg) for pkg in packages), level, shlex.quote(archive))
+    try:
+        subprocess.run(["bash", "-o", "pipefail", "-c", command], check=True)
+    except subprocess.CalledProcessError:
+        shutil.rmtree(build_dir)
+        raise
+    part_size = os.path.getsize(archive) // parts + 1
+    subprocess.run(["split", "-a", "3", "-d", "-b", str(part_size), archive, os.path.join(build_dir, "part-")], check=True)
+    part_names = sorted(name for name in os.listdir(build_dir) if name.startswith("part-"))
+
+    snapshot_dir = "/dbfs" + rlib_snapshot_path + "/" + r_version + "/" + snapshot_id
+    os.makedirs(snapshot_dir)
+    with ThreadPoolExecutor(max_workers=parts) as pool:
+        list(pool.map(lambda name: shutil.copyfile(os.path.join(build_dir, name), os.path.join(snapshot_dir, name)), part_names))
+
+    manifest = {
+        "snapshot_id": snapshot_id,
+        "r_version": r_version,
+        "generation": generation,
+        "archive_sha256": sha256_file(archive),
+        "archive_size": os.path.getsize(archive),
+        "packages": {pkg: re.search(r"^Version:\s*(\S+)", open(os.path.join(usr_lib_path, pkg, "DESCRIPTION")).read(), re.M).group(1)
+                     for pkg in packages if os.path.exists(os.path.join(usr_lib_path, pkg, "DESCRIPTION"))},
+        "parts": [{"name": name, "size": os.path.getsize(os.path.join(build_dir, name)),
+                   "sha256": sha256_file(os.path.join(build_dir, name))} for name in part_names],
+    }
+    with open(os.path.join(snapshot_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    # Plain text copies of the manifest for the init script, which has no JSON parser
+    with open(os.path.join(snapshot_dir, "GENERATION"), "w") as f:
+        f.write(generation + "\n")
+    with open(os.path.join(snapshot_dir, "parts.sha256"), "w") as f:
+        f.writelines("{0}  {1}\n".format(part["sha256"], part["name"]) for part in manifest["parts"])
+    # Publish the snapshot last, so the init script never picks up a snapshot that is still being written
+    with open(os.path.join(os.path.dirname(snapshot_dir), "LATEST"), "w") as f:
+        f.write(snapshot_id + "\n")
+
+    shutil.rmtree(build_dir)
+    print("Snapshot {0}: {1} packages, {2:.0f} MB in {3} parts".format(
+        snapshot_id, len(packages), manifest["archive_size"] / 1e6, len(part_names)))
+    return manifest
+
+# COMMAND ----------
+
+if rlib_build_snapshot:
+    build_rlib_snapshot()
+
+# COMMAND ----------
+
+# Unpacks the snapshot in $SNAPSHOT_DIR into $LOCAL_LIB, once per node. Shared by the driver and worker init scripts
+rlib_snapshot_unpack_script = render_template("""
+  if [[ -f "$LOCAL_LIB/.snapshot" ]] && [[ "$(cat $LOCAL_LIB/.snapshot)" = "$SNAPSHOT_ID" ]]; then
+    exit 0
+  fi
+  command -v zstd || (apt-get update -qq && apt-get install -y -qq zstd)
+
+  mkdir -p /local_disk0/tmp
+  DOWNLOAD_DIR=$(mktemp -d -p /local_disk0/tmp)
+  awk '{print $2}' "$SNAPSHOT_DIR/parts.sha256" | xargs -P {{ parts }} -I PART cp "$SNAPSHOT_DIR/PART" "$DOWNLOAD_DIR/PART"
+  (cd "$DOWNLOAD_DIR" && sha256sum --quiet -c "$SNAPSHOT_DIR/parts.sha256")
+
+  rm -rf "$LOCAL_LIB.unpack"
+  mkdir -p "$LOCAL_LIB.unpack"
+  cat "$DOWNLOAD_DIR"/part-* | zstd -d -T0 | tar -x -C "$LOCAL_LIB.unpack"
+  cp "$SNAPSHOT_DIR/GENERATION" "$LOCAL_LIB.unpack/.generation"
+  echo "$SNAPSHOT_ID" > "$LOCAL_LIB.unpack/.snapshot"
+  chmod -R a+rwX "$LOCAL_LIB.unpack"
+  rm -rf "$LOCAL_LIB" "$DOWNLOAD_DIR"
+  mv "$LOCAL_LIB.unpack" "$LOCAL_LIB"
+""", parts=rlib_snapshot_parts).strip()
+
+# COMMAND ----------
+
+rlib_snapshot_init_script = render_template("""
+#!/bin/bash
+set -euxo pipefail
+
+if [[ $DB_IS_DRIVER = "TRUE" ]]; then
+  R_VERSION=$(Rscript --vanilla -e 'cat(as.character(getRversion()))')
+  SNAPSHOT_ROOT="{{ snapshot_root }}/$R_VERSION"
+  SNAPSHOT_ID="{{ snapshot_id }}"
+  LOCAL_LIB="{{ local_rlib_path }}/$R_VERSION"
+
+  mkdir -p {{ local_rlib_path }}
+  chmod 777 {{ local_rlib_path }}
+  cat > {{ local_rlib_path }}/hydrate.sh <<'EOF'
+{{ hydrate_script }}EOF
+  chmod 755 {{ local_rlib_path }}/hydrate.sh
+
+  if [[ "$SNAPSHOT_ID" = "LATEST" ]]; then
+    if [[ ! -f "$SNAPSHOT_ROOT/LATEST" ]]; then
+      # no snapshot was built yet: mirror the central library package by package in the background
+      nohup {{ local_rlib_path }}/hydrate.sh > {{ local_rlib_path }}/hydrate.log 2>&1 &
+      exit 0
+    fi
+    SNAPSHOT_ID=$(cat "$SNAPSHOT_ROOT/LATEST")
+  fi
+  SNAPSHOT_DIR="$SNAPSHOT_ROOT/$SNAPSHOT_ID"
+
+  # unpack once per node
+  {{ unpack_script }}
+fi
+""", snapshot_root="/dbfs" + rlib_snapshot_path, local_rlib_path=local_rlib_path,
+   snapshot_id=rlib_snapshot_id, hydrate_script=rlib_hydrate_script, unpack_script=rlib_snapshot_unpack_script)
+publish_artefacts({rlib_snapshot_init_script_location: rlib_snapshot_init_script}, publish_backends)
+
+# COMMAND ----------
+
+# Add below path to init scripts when configuring your RStudio cluster, instead of the mirror init script of step 5!
+rlib_snapshot_init_script_location
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC #### 7. Distributing the library to the workers
+# MAGIC The init scripts above only run on the driver, so packages installed with `databricks.install.packages` are not available to UDFs (`gapply`, `dapply`, `spark.lapply`, `spark_apply`), which run R on the workers. The worker init script below unpacks a pinned snapshot of step 6 on every worker instead:
+# MAGIC * All workers run it at the same time while the cluster starts, and each copies the parts of the snapshot to its local disk in parallel streams, verifies and unpacks them. This is the same code as the snapshot init script of the driver.
+# MAGIC * SparkR and `sparklyr` start the R processes of the workers with `--vanilla`, which skips `Rprofile.site` and `.Rprofile`. The init script therefore adds the unpacked library to `R_LIBS` in `/databricks/spark/conf/spark-env.sh`, which R still reads, so UDFs find the packages without shipping them with every job (e.g. `spark_apply(..., packages = FALSE)`).
+# MAGIC * The snapshot is pinned, so all workers of a cluster, including those added by autoscaling and those of restarted clusters, see exactly the same packages. The pin is `rlib_worker_snapshot_id`. When it is `None`, running this notebook keeps the snapshot of the published worker init script, and only the first time pins the `LATEST` snapshot. To update the workers, build a new snapshot (step 6) and set `rlib_worker_snapshot_id` to its id.
+
+# COMMAND ----------
+
+rlib_worker_snapshot_id = None                  # Snapshot id pinned for the workers, None keeps the published pin (see above)
+rlib_worker_init_script_location = "dbfs:/databricks/init/rstudio/rlib_worker_init_script.sh" # Must be located in root bucket
+
+# COMMAND ----------
+
+def published_worker_snapshot_id(location=rlib_worker_init_script_location):
+    """Returns the snapshot id pinned by the published worker init script, or None when it is not published yet."""
+    path = "/dbfs" + location[len("dbfs:"):]
+    if not os.path.exists(path):
+        return None
+    match = re.search(r'^\s*SNAPSHOT_ID="([^"]+)"', open(path).read(), re.M)
+    return match.group(1) if match else None
+
+
+if rlib_worker_snapshot_id is None:
+    rlib_worker_snapshot_id = published_worker_snapshot_id()
+if rlib_worker_snapshot_id is None:
+    latest_snapshot = read_latest_rlib_snapshot()
+    rlib_worker_snapshot_id = latest_snapshot["snapshot_id"] if latest_snapshot else None
+print("Workers are pinned to snapshot {0}".format(rlib_worker_snapshot_id))
+
+# COMMAND ----------
+
+rlib_worker_init_script = render_template("""
+#!/bin/bash
+set -euxo pipefail
+
+if [[ $DB_IS_DRIVER != "TRUE" ]]; then
+  R_VERSION=$(Rscript --vanilla -e 'cat(as.character(getRversion()))')
+  SNAPSHOT_ID="{{ snapshot_id }}"
+  SNAPSHOT_DIR="{{ snapshot_root }}/$R_VERSION/$SNAPSHOT_ID"
+  LOCAL_LIB="{{ local_rlib_path }}/$R_VERSION"
+
+  # R processes of UDFs run with --vanilla, which still reads R_LIBS
+  if ! grep -qxF "export R_LIBS=$LOCAL_LIB" /databricks/spark/conf/spark-env.sh; then
+    echo "export R_LIBS=$LOCAL_LIB" >> /databricks/spark/conf/spark-env.sh
+  fi
+
+  mkdir -p {{ local_rlib_path }}
+  chmod 777 {{ local_rlib_path }}
+
+  # unpack once per node
+  {{ unpack_script }}
+fi
+""", snapshot_root="/dbfs" + rlib_snapshot_path, local_rlib_path=local_rlib_path,
+   snapshot_id=rlib_worker_snapshot_id, unpack_script=rlib_snapshot_unpack_script)
+if rlib_worker_snapshot_id is None:
+    print("There is no snapshot to pin yet, build one in step 6 first")
+else:
+    publish_artefacts({rlib_worker_init_script_location: rlib_worker_init_script}, publish_backends)
+
+# COMMAND ----------
+
+# Add below path to init scripts when configuring your RStudio cluster, next to the driver init scripts!
+rlib_worker_init_script_location
\ No newline at end of file
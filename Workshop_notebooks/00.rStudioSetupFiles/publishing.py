@@ -0,0 +1,126 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC #### Publishing the generated R and shell scripts
+# MAGIC The setup notebook (`2.rSetup.py`) collects all rendered scripts and runs this notebook with `%run ./publishing` (after `%run ./templating`, which defines `content_hash`) to write them in one batch:
+# MAGIC * `publish_artefacts` writes all files to all backends concurrently. A file is skipped when its content hash matches the file that is already there, retried with exponential backoff when writing fails, and read back to verify it.
+# MAGIC * `DbfsBackend` writes to DBFS of the current workspace with `dbutils.fs.put`. `DbfsRestBackend` writes to DBFS of another workspace through the REST API, so many workspaces can be provisioned in one run. `LocalBackend` writes to a local directory, which makes it possible to test the generated scripts off-cluster.
+
+# COMMAND ----------
+
+import base64
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class LocalBackend:
+    """Publishes dbfs:/<path> to <root>/<path> on the local file system."""
+
+    def __init__(self, root):
+        self.name = "local:" + root
+        self.root = root
+
+    def _local_path(self, path):
+        return os.path.join(self.root, path[len("dbfs:"):].lstrip("/"))
+
+    def read(self, path):
+        try:
+            with open(self._local_path(path), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, path, content):
+        local_path = self._local_path(path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with open(local_path + ".part", "w") as f:
+            f.write(content)
+        os.replace(local_path + ".part", local_path)
+
+
+class DbfsBackend:
+    """Publishes to DBFS of the current workspace: writes with dbutils.fs.put and reads through the /dbfs fusion mount."""
+
+    name = "dbfs"
+
+    def read(self, path):
+        return LocalBackend("/dbfs").read(path)
+
+    def write(self, path, content):
+        dbutils.fs.put(path, content, True)
+
+
+class DbfsRestBackend:
+    """Publishes to DBFS of any workspace through the DBFS REST API."""
+
+    def __init__(self, host, token):
+        import requests
+        self.name = host
+        self.host = host.rstrip("/")
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = "Bearer " + token
+
+    def read(self, path, block_size=1 << 20):
+        content, offset = b"", 0
+        while True:
+            res = self.session.get(self.host + "/api/2.0/dbfs/read",
+                                   params={"path": path[len("dbfs:"):], "offset": offset, "length": block_size})
+            if res.status_code == 404:
+                return None
+            res.raise_for_status()
+            block = res.json()
+            if not block.get("bytes_read"):
+                return content
+            content += base64.b64decode(block["data"])
+            offset += block["bytes_read"]
+
+    def write(self, path, content):
+        res = self.session.post(self.host + "/api/2.0/dbfs/put",
+                                json={"path": path[len("dbfs:"):], "overwrite": True,
+                                      "contents": base64.b64encode(content.encode("utf-8")).decode("ascii")})
+        res.raise_for_status()
+
+
+def publish_artefact(backend, path, content, retries=3, backoff=1.0):
+    """Writes a single file unless it is unchanged. Returns "unchanged" or "written", raises when all attempts failed."""
+    expected = content_hash(content)
+    try:
+        existing = backend.read(path)
+    except Exception:
+        existing = None
+    if existing is not None and content_hash(existing) == expected:
+        return "unchanged"
+
+    for attempt in range(retries):
+        try:
+            backend.write(path, content)
+            written = backend.read(path)
+            if written is not None and content_hash(written) == expected:
+                return "written"
+            error = IOError("Content of {0} does not match after writing".format(path))
+        except Exception as e:
+            error = e
+        if attempt + 1 < retries:
+            time.sleep(backoff * 2 ** attempt)
+    raise error
+
+
+def publish_artefacts(files, backends=None, max_workers=16, retries=3):
+    """Publishes {dbfs:/path: content} to every backend concurrently. Returns {(backend name, path): status}."""
+    backends = backends or [DbfsBackend()]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {(backend.name, path): pool.submit(publish_artefact, backend, path, content, retries)
+                   for backend in backends for path, content in files.items()}
+    results, failed = {}, {}
+    for key, future in futures.items():
+        try:
+            results[key] = future.result()
+        except Exception as e:
+            failed[key] = e
+
+    print("Published {0} files to {1} backend(s): {2} written, {3} unchanged, {4} failed".format(
+        len(files), len(backends), sum(status == "written" for status in results.values()),
+        sum(status == "unchanged" for status in results.values()), len(failed)))
+    if failed:
+        raise IOError("Failed to publish: " + "; ".join("{0} {1}: {2}".format(name, path, e) for (name, path), e in failed.items()))
+    return results
@@ -0,0 +1,32 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC #### Templating for the generated R and shell scripts
+# MAGIC The setup notebook (`2.rSetup.py`) generates R scripts and init scripts from templates, and runs this notebook with `%run ./templating` to get the functions below:
+# MAGIC * `render_template` fills in `{{ name }}` placeholders with named parameters. R and bash code use single braces everywhere, so templates need no escaping. Rendered scripts are cached, keyed by the hash of the template and the parameters.
+# MAGIC * `content_hash` is also used by the `publishing` notebook, which only uploads a rendered script when its hash differs from the file that is already there, so re-running the setup notebook is close to free.
+
+# COMMAND ----------
+
+import hashlib
+import re
+
+template_placeholder = re.compile(r"\{\{\s*(\w+)\s*\}\}")
+template_render_cache = {}
+
+
+def content_hash(content):
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
+
+
+def render_template(template, **params):
+    """Fills in the {{ name }} placeholders of a template. Raises a KeyError when a placeholder has no parameter."""
+    key = (content_hash(template), tuple(sorted((name, str(value)) for name, value in params.items())))
+    if key not in template_render_cache:
+        missing = set(template_placeholder.findall(template)) - set(params)
+        if missing:
+            raise KeyError("Missing template parameters: " + ", ".join(sorted(missing)))
+        template_render_cache[key] = template_placeholder.sub(lambda match: str(params[match.group(1)]), template)
+    return template_render_cache[key]
+
@@ -73,6 +73,10 @@ library(SparkR)
 
 # COMMAND ----------
 
+# MAGIC %run ./udf_helpers
+
+# COMMAND ----------
+
 # Define shema's
 sparkR_schema <- structType(
   structField("year", "integer"),
@@ -128,6 +132,24 @@ head(resultsDF)
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC Writing the schema by hand is not the only way to get the fast path. `cachedGapply` from the `udf_helpers` notebook runs the function once on a small sample in the driver, derives the schema from its output and caches it for the function and the input schema. The next call with the same function skips that step too.
+
+# COMMAND ----------
+
+resultsDF <- cachedGapply(airlinesDF,
+                          cols = "UniqueCarrier",
+                          function(key, e){
+                            data.frame(
+                              UniqueCarrier = unique(e$UniqueCarrier), 
+                              newcol = paste0(unique(e$UniqueCarrier), "_new")
+                            )
+                          })
+
+head(resultsDF)
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ___
 # MAGIC 
@@ -139,6 +161,8 @@ head(resultsDF)
 # MAGIC * Load the entire library - `library(broom)`
 # MAGIC * Reference a specific function from the library namespace - `broom::tidy()`
 # MAGIC 
+# MAGIC Packages installed in the central library with `databricks.install.packages` (see `00.rStudioSetupFiles/2.rSetup`) are only on the driver. Add the worker init script of step 7 of that notebook to the cluster to unpack a pinned snapshot of the central library on every worker and put it on `R_LIBS`. UDFs then find these packages as well, without shipping them with every job.
+# MAGIC 
 # MAGIC In a less trivial example of `gapply`, we can train a model on each partition. We begin by grouping the input data by `Origin`, then specify our function to apply.  This will be a simple model where our dependent variable is Arrival Delay (`ArrDelay`) and our independent variable is Departure Delay (`DepDelay`) from the month of December.  Furthermore, we can use the `broom` package to tidy up the output of our linear model.  The results will be a Spark DataFrame with different coefficients for each group.
 # MAGIC 
 # MAGIC **Note:** Make sure you attach the `broom` package to your cluster before you run the next cell.
@@ -175,12 +199,44 @@ head(resultsDF)
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC A few hub airports have most of the flights, so a few R processes fit most of the models while the others are idle. `skewAwareGapply` from the `udf_helpers` notebook is a drop-in replacement for `gapply` that counts the rows per key first and balances the groups over the partitions, with the heaviest airports in a partition of their own. With `timing = TRUE` it adds the time every model took in the column `udf_elapsed_s`.
+
+# COMMAND ----------
+
+balancedResultsDF <- skewAwareGapply(featuresDF,
+                                     cols = "Origin",
+                                     function(key, e){
+                                       e$ArrDelay <- as.numeric(e$ArrDelay)
+                                       e$DepDelay <- as.numeric(e$DepDelay)
+                                       output_df <- broom::tidy(lm(ArrDelay ~ DepDelay, data = e))
+                                       output_df$origin <- key[[1]]
+                                       output_df
+                                     },
+                                     schema = result_schema,
+                                     timing = TRUE)
+
+head(arrange(balancedResultsDF, desc(balancedResultsDF$udf_elapsed_s)))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC For a simple linear regression, the models don't have to be fitted one group at a time at all. `batchedGroupLm` fits the models of all groups in a partition at once with grouped sums and returns the same columns as `broom::tidy`, followed by the group column.
+
+# COMMAND ----------
+
+batchedResultsDF <- batchedGroupLm(featuresDF, cols = "Origin", ArrDelay ~ DepDelay)
+
+head(batchedResultsDF)
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC #### UDFs with Sparklyr
 # MAGIC 
 # MAGIC In the below example, we'll use **`spark_apply()`**, which is essentially the `sparklyr` version of `gapply` and `dapply`
 # MAGIC 
-# MAGIC `spark_apply` takes a Spark DataFrame as input and must return a Spark DataFrame as well.  By default it will execute the function against each partition of the data, but we will change this by specifying a 'group by' column in the function call.  `spark_apply()` will also distribute all of the contents of your local `.libPaths()` to each worker when you call it for the first time unless you set the `packages` parameter to `FALSE`.  For more details see the [Official Documentation](https://spark.rstudio.com/guides/distributed-r/).  Let's test this by loading some airlines data into Spark and creating a new column for each Unique Carrier inside the R process on the workers:
+# MAGIC `spark_apply` takes a Spark DataFrame as input and must return a Spark DataFrame as well.  By default it will execute the function against each partition of the data, but we will change this by specifying a 'group by' column in the function call.  `spark_apply()` will also distribute all of the contents of your local `.libPaths()` to each worker when you call it for the first time unless you set the `packages` parameter to `FALSE`. With the worker init script of `00.rStudioSetupFiles/2.rSetup` the packages are already on the workers, so `packages = FALSE` is all you need. Without it, `databricks.spark_apply()` from the same notebook takes the same arguments as `spark_apply()`, but only ships the packages your function references and their dependencies, as a bundle that is built once and cached.  For more details see the [Official Documentation](https://spark.rstudio.com/guides/distributed-r/).  Let's test this by loading some airlines data into Spark and creating a new column for each Unique Carrier inside the R process on the workers:
 # MAGIC 
 # MAGIC **Note:** To get the best performance, we specify the schema of the expected output DataFrame to `spark_apply`.  This is optional, but if we don't supply the schema Spark will need to sample the output to infer it.  This can be quite costly on longer running UDFs.
 
@@ -260,6 +316,8 @@ bench::press(rows = c(10^5, 10^6), {
 # MAGIC %md
 # MAGIC You can see the massive speedup from the common in memory data format.  Ser/de overhead begone!
 # MAGIC 
+# MAGIC To compare all UDFs of this notebook across data sizes, Arrow on and off, and explicit and inferred schemas, and to track their performance across runtime versions, see the `2. Benchmarking UDFs` notebook.
+# MAGIC 
 # MAGIC ___
 # MAGIC 
 # MAGIC ### Additional UDF Examples
@@ -298,6 +356,18 @@ cat(c("\nClass of result from dapply():", class(jitteredDF)))
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC `dapply` turns every partition into one data.frame before `jitter` runs. Elementwise transforms like this one can stream through R instead: `vectorisedApply` from the `udf_helpers` notebook hands the function one Arrow record batch at a time and adds the columns it returns, so the R process never holds a whole partition. The `2. Benchmarking UDFs` notebook compares both paths.
+
+# COMMAND ----------
+
+jitteredTbl <- dplyr::select(sparklyAirlines, DepDelay) %>%
+  dplyr::filter(!is.na(DepDelay)) %>%
+  vectorisedApply(function(batch) list(jitteredDelay = jitter(as.numeric(batch$DepDelay))))
+head(jitteredTbl)
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC **`dapplyCollect()`**
 # MAGIC 
@@ -324,6 +394,14 @@ cat(c("\n\nNumber of partitions in depDelayDF:", getNumPartitions(depDelayDF)))
 # MAGIC %md
 # MAGIC Notice that we have one result for each partition, because the function was applied to each partition.
 # MAGIC 
+# MAGIC When the output of all partitions together may not fit in the driver, use `streamingDapplyCollect` from the `udf_helpers` notebook. It brings the output to the driver in Arrow batches and spills them to Parquet on local disk once they take more than `memoryBudget` bytes, or hands every batch to a `callback` so only one batch is in memory at a time:
+# MAGIC 
+# MAGIC ```
+# MAGIC firstRows <- streamingDapplyCollect(dplyr::select(sparklyAirlines, DepDelay),
+# MAGIC                                     function(x) data.frame(DepDelay = x$DepDelay[1], jittered = jitter(x$DepDelay[1])),
+# MAGIC                                     memoryBudget = 256 * 1024^2)
+# MAGIC ```
+# MAGIC 
 # MAGIC ##### `spark.lapply` : Using a list as input
 # MAGIC 
 # MAGIC This function is also from SparkR.  It accepts a list and then uses Spark to apply R code to each element in the list across the cluster.  As [the docs](https://spark.apache.org/docs/latest/api/R/spark.lapply.html) state, it is conceptually similar to `lapply` in base R, so it will return a **list** back to the driver.  
@@ -351,6 +429,21 @@ display(tidied)
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC Every element of the list became a Spark task, which is fine for 20 carriers but not for a parameter sweep with 10^5 elements. `batchedSparkLapply` from the `udf_helpers` notebook runs one task per chunk of elements, and combines the data.frames into one, column by column, instead of the `t(sapply(...))` step above.
+
+# COMMAND ----------
+
+tidied <- batchedSparkLapply(carriers,
+                             function(e) {
+                               data.frame(UniqueCarrier = e,
+                                          newcol = paste0(e, "_new"))
+                             })
+
+display(tidied)
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ___
 # MAGIC 
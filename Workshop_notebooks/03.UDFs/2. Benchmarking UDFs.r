@@ -0,0 +1,333 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC ## Benchmarking Distributed R UDFs
+# MAGIC
+# MAGIC The UDF notebook compares `spark_apply` with and without Arrow in a single `bench::press` call. This notebook runs all of its workloads across a grid of data sizes and settings, stores every timing in a Delta table and flags regressions between Databricks Runtime versions:
+# MAGIC
+# MAGIC * **Workloads:** `gapply` per carrier, `gapply` with `broom::tidy(lm())` per origin, `dapply` jitter, `dapplyCollect`, `spark.lapply` and `spark_apply`, the same functions as in the UDF notebook. The jitter also runs through `vectorisedApply` of the `udf_helpers` notebook, which only applies with Arrow on.
+# MAGIC * **Grid:** number of rows, number of groups (the cardinality of the key) and schema (`narrow` or `wide`, with 20 extra columns), each with Arrow on and off and with an explicit or inferred output schema. `dapplyCollect` and `spark.lapply` do not take a schema, so they only run with `explicit`.
+# MAGIC * **Regressions:** the median time of every configuration is compared with the median of the most recent other runtime version in the results table.
+# MAGIC
+# MAGIC The notebook source is a plain R script as well. To run it against a local Spark, e.g. in CI, run `UDF_BENCH_PROFILE=ci Rscript "2. Benchmarking UDFs.r"`, which uses a small grid and writes the results as parquet to `UDF_BENCH_PATH` (default `/tmp/udf_benchmarks`).
+
+# COMMAND ----------
+
+library(magrittr)
+library(SparkR)
+
+# COMMAND ----------
+
+# MAGIC %run ./udf_helpers
+
+# COMMAND ----------
+
+if (!exists("vectorisedApply")) {
+  source("udf_helpers.r")   # %run is a comment when the notebook runs as an R script
+}
+
+onDatabricks <- nzchar(Sys.getenv("DATABRICKS_RUNTIME_VERSION"))
+benchProfile <- Sys.getenv("UDF_BENCH_PROFILE", if (onDatabricks) "full" else "ci")
+
+if (onDatabricks) {
+  sparkR.session()
+  sc <- sparklyr::spark_connect(method = "databricks")
+} else {
+  sparkR.session(master = "local[*]", sparkConfig = list(spark.sql.shuffle.partitions = "4"))
+  sc <- sparklyr::spark_connect(master = "local")
+}
+runtimeVersion <- Sys.getenv("DATABRICKS_RUNTIME_VERSION", paste0("local-spark-", sparkR.version()))
+
+# COMMAND ----------
+
+## Grid of data sizes and settings
+if (benchProfile == "ci") {
+  benchGrid <- expand.grid(rows = 10^3, groups = 10, schema = c("narrow", "wide"),
+                           arrow = c(TRUE, FALSE), schema_mode = c("explicit", "inferred"),
+                           stringsAsFactors = FALSE)
+  benchIterations <- 1
+} else {
+  benchGrid <- expand.grid(rows = c(10^4, 10^5, 10^6), groups = c(10, 1000), schema = c("narrow", "wide"),
+                           arrow = c(TRUE, FALSE), schema_mode = c("explicit", "inferred"),
+                           stringsAsFactors = FALSE)
+  benchIterations <- 3
+}
+
+## Where results are stored
+benchTable <- "udf_benchmarks"
+benchPath <- Sys.getenv("UDF_BENCH_PATH", if (onDatabricks) "/ml/udf_benchmarks" else "/tmp/udf_benchmarks")
+benchFormat <- if (onDatabricks) "delta" else "parquet"
+regressionThreshold <- 1.2   # flag configurations that got more than 20% slower
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ##### Input data
+# MAGIC The input data is generated by Spark, so the benchmark does not depend on a dataset. It has the columns of the airlines data that the UDF notebook uses: a key (`UniqueCarrier`, `Origin`), `DepDelay` and `ArrDelay`. The `wide` schema adds 20 columns that the UDFs do not use, but that still have to be sent to R.
+
+# COMMAND ----------
+
+benchData <- function(rows, groups, schema) {
+  # Generates the input data of one configuration of the grid, for SparkR and for
+  # sparklyr (which may run in a different Spark session)
+  #
+  # Args:
+  #   rows:  Number of rows
+  #   groups:  Number of distinct keys
+  #   schema:  "narrow" or "wide"
+  #
+  # Return:
+  #   list with the cached SparkDataFrame (sparkr) and tbl_spark (sparklyr)
+  extraCols <- if (schema == "wide") paste0(", rand(", 1:20, ") AS extra", 1:20, collapse = "") else ""
+  query <- sprintf(paste("SELECT concat('C', id %% %d) AS UniqueCarrier, concat('O', id %% %d) AS Origin,",
+                         "cast(rand(1) * 60 AS int) AS DepDelay, cast(rand(2) * 60 AS int) AS ArrDelay%s FROM range(%d)"),
+                   groups, groups, extraCols, rows)
+  df <- cache(sql(query))
+  count(df)   # materialize the caches, so generating the data is not part of the timings
+  sdf <- sparklyr::sdf_register(dplyr::tbl(sc, dplyr::sql(query)), "udf_bench_input")
+  sparklyr::tbl_cache(sc, "udf_bench_input")
+  list(sparkr = df, sparklyr = sdf)
+}
+
+inferSchema <- function(df, f, key = NULL) {
+  # Infers the output schema of a UDF by running it on a sample of the input,
+  # which is what users do when they do not write the schema themselves
+  #
+  # Args:
+  #   df:  Input SparkDataFrame
+  #   f:  UDF, function(key, e) with a key, function(e) without
+  #   key:  Optional. Group column of gapply
+  #
+  # Return:
+  #   structType of the output
+  sample <- collect(limit(df, 1000))
+  out <- if (is.null(key)) f(sample) else f(list(sample[[key]][1]), sample[sample[[key]] == sample[[key]][1], ])
+  schema(createDataFrame(out))
+}
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ##### Workloads
+# MAGIC Every workload takes the input data (see `benchData`) and the configuration, and returns a function that runs it once, including the Spark action that forces the UDF to run, or `NULL` when it does not apply to the configuration.
+
+# COMMAND ----------
+
+carrierUdf <- function(key, e) {
+  data.frame(UniqueCarrier = key[[1]], newcol = paste0(key[[1]], "_new"))
+}
+carrierSchema <- structType(structField("UniqueCarrier", "string"), structField("newcol", "string"))
+
+lmUdf <- function(key, e) {
+  e$ArrDelay <- as.numeric(e$ArrDelay)
+  e$DepDelay <- as.numeric(e$DepDelay)
+  output_df <- broom::tidy(lm(ArrDelay ~ DepDelay, data = e))
+  output_df$origin <- key[[1]]
+  output_df
+}
+lmSchema <- structType(
+  structField("term", "string"),
+  structField("estimate", "double"),
+  structField("std_error", "double"),
+  structField("statistic", "double"),
+  structField("p_value", "double"),
+  structField("origin", "string")
+)
+
+jitterUdf <- function(x) {
+  cbind(x, jitteredDelay = jitter(as.numeric(x$DepDelay)))
+}
+jitterSchema <- structType(structField("DepDelay", "integer"), structField("jitteredDelay", "double"))
+
+benchWorkloads <- list(
+  gapply_carrier = function(data, cfg) {
+    df <- data$sparkr
+    function() {
+      schema <- if (cfg$schema_mode == "explicit") carrierSchema else inferSchema(df, carrierUdf, "UniqueCarrier")
+      count(gapply(df, "UniqueCarrier", carrierUdf, schema))
+    }
+  },
+  gapply_lm = function(data, cfg) {
+    df <- data$sparkr
+    function() {
+      features <- select(df, "Origin", "DepDelay", "ArrDelay")
+      schema <- if (cfg$schema_mode == "explicit") lmSchema else inferSchema(features, lmUdf, "Origin")
+      count(gapply(features, "Origin", lmUdf, schema))
+    }
+  },
+  dapply_jitter = function(data, cfg) {
+    df <- data$sparkr
+    function() {
+      depDelayDF <- select(df, "DepDelay")
+      schema <- if (cfg$schema_mode == "explicit") jitterSchema else inferSchema(depDelayDF, jitterUdf)
+      count(dapply(depDelayDF, jitterUdf, schema))
+    }
+  },
+  dapplyCollect = function(data, cfg) {
+    df <- data$sparkr
+    if (cfg$schema_mode != "explicit") {
+      return(NULL)
+    }
+    function() {
+      nrow(dapplyCollect(select(df, "DepDelay"), function(x) {
+        data.frame(DepDelay = x$DepDelay[1], jittered = jitter(x$DepDelay[1]))
+      }))
+    }
+  },
+  spark.lapply = function(data, cfg) {
+    if (cfg$schema_mode != "explicit") {
+      return(NULL)
+    }
+    function() {
+      length(spark.lapply(paste0("C", seq_len(cfg$groups)), function(e) {
+        data.frame(UniqueCarrier = e, newcol = paste0(e, "_new"))
+      }))
+    }
+  },
+  spark_apply = function(data, cfg) {
+    sdf <- data$sparklyr
+    function() {
+      columns <- if (cfg$schema_mode == "explicit") list(UniqueCarrier = "character", newcol = "character") else NULL
+      sparklyr::spark_apply(sdf, function(e) data.frame(newcol = paste0(unique(e$UniqueCarrier), "_new")),
+                            group_by = "UniqueCarrier", columns = columns, packages = FALSE) %>%
+        dplyr::count() %>% dplyr::collect()
+    }
+  },
+  vectorised_jitter = function(data, cfg) {
+    if (!cfg$arrow) {
+      return(NULL)
+    }
+    sdf <- dplyr::select(data$sparklyr, DepDelay)
+    function() {
+      columns <- if (cfg$schema_mode == "explicit") list(DepDelay = "integer", jitteredDelay = "double") else NULL
+      vectorisedApply(sdf, function(batch) list(jitteredDelay = jitter(as.numeric(batch$DepDelay))), columns = columns) %>%
+        dplyr::count() %>% dplyr::collect()
+    }
+  }
+)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ##### Running the grid
+
+# COMMAND ----------
+
+setArrow <- function(enabled) {
+  # Switches Arrow on or off: SparkR uses it when it is enabled in the Spark
+  # configuration, sparklyr when the arrow package is attached
+  sql(paste0("SET spark.sql.execution.arrow.sparkr.enabled=", tolower(enabled)))
+  if (enabled) {
+    suppressMessages(library(arrow))
+  } else if ("arrow" %in% .packages()) {
+    detach("package:arrow")
+  }
+}
+
+runBenchmarks <- function(grid, workloads, iterations) {
+  # Runs every workload on every configuration of the grid
+  #
+  # Args:
+  #   grid:  data.frame with the columns rows, groups, schema, arrow and schema_mode
+  #   workloads:  Named list of workloads, see benchWorkloads
+  #   iterations:  Number of times every configuration is timed
+  #
+  # Return:
+  #   data.frame with one row per workload, configuration and iteration
+  hasBroom <- requireNamespace("broom", quietly = TRUE)
+  hasArrow <- requireNamespace("arrow", quietly = TRUE)
+  results <- list()
+  for (dataCfg in split(grid, grid[c("rows", "groups", "schema")], drop = TRUE)) {
+    data <- benchData(dataCfg$rows[1], dataCfg$groups[1], dataCfg$schema[1])
+    for (i in seq_len(nrow(dataCfg))) {
+      cfg <- dataCfg[i, ]
+      if (cfg$arrow && !hasArrow) {
+        next
+      }
+      setArrow(cfg$arrow)
+      for (workload in names(workloads)) {
+        if (workload == "gapply_lm" && !hasBroom) {
+          next
+        }
+        run <- workloads[[workload]](data, cfg)
+        if (is.null(run)) {
+          next
+        }
+        for (iteration in seq_len(iterations)) {
+          elapsed <- system.time(run())[["elapsed"]]
+          results[[length(results) + 1]] <- data.frame(cfg, workload = workload, iteration = iteration,
+                                                       elapsed_s = elapsed, stringsAsFactors = FALSE)
+        }
+      }
+    }
+    unpersist(data$sparkr)
+    sparklyr::tbl_uncache(sc, "udf_bench_input")
+  }
+  do.call(rbind, results)
+}
+
+benchResults <- runBenchmarks(benchGrid, benchWorkloads, benchIterations)
+benchResults$run_id <- format(Sys.time(), "%Y%m%d-%H%M%S")
+benchResults$run_time <- Sys.time()
+benchResults$runtime_version <- runtimeVersion
+benchResults$spark_version <- sparkR.version()
+benchResults$r_version <- as.character(getRversion())
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ##### Storing the results
+# MAGIC Every run is appended to the results table, so the history of all runtime versions is kept.
+
+# COMMAND ----------
+
+write.df(createDataFrame(benchResults), path = benchPath, source = benchFormat, mode = "append")
+if (onDatabricks) {
+  sql(sprintf("CREATE TABLE IF NOT EXISTS %s USING delta LOCATION '%s'", benchTable, benchPath))
+}
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ##### Flagging regressions
+# MAGIC For every configuration, the median time on this runtime version is compared with the median on the most recent other runtime version. Configurations that got slower by more than `regressionThreshold` are flagged.
+
+# COMMAND ----------
+
+flagRegressions <- function(results, runtimeVersion, threshold) {
+  # Compares the median time of every configuration with the previous runtime version
+  #
+  # Args:
+  #   results:  data.frame with all stored benchmark results
+  #   runtimeVersion:  Runtime version to check
+  #   threshold:  Ratio of the medians above which a configuration is a regression
+  #
+  # Return:
+  #   data.frame with the medians, their ratio and a regression flag per configuration
+  others <- results[results$runtime_version != runtimeVersion, ]
+  if (nrow(others) == 0) {
+    message("No results of other runtime versions to compare with")
+    return(NULL)
+  }
+  baselineVersion <- others$runtime_version[which.max(others$run_time)]
+  keys <- c("workload", "rows", "groups", "schema", "arrow", "schema_mode")
+  medians <- function(version) {
+    aggregate(elapsed_s ~ ., data = results[results$runtime_version == version, c(keys, "elapsed_s")], FUN = median)
+  }
+  comparison <- merge(medians(baselineVersion), medians(runtimeVersion), by = keys, suffixes = c("_baseline", "_current"))
+  comparison$baseline_version <- baselineVersion
+  comparison$ratio <- comparison$elapsed_s_current / comparison$elapsed_s_baseline
+  comparison$regression <- comparison$ratio > threshold
+  comparison[order(-comparison$ratio), ]
+}
+
+allResults <- collect(read.df(benchPath, source = benchFormat))
+regressions <- flagRegressions(allResults, runtimeVersion, regressionThreshold)
+
+if (onDatabricks) {
+  display(if (is.null(regressions)) createDataFrame(benchResults) else createDataFrame(regressions))
+} else {
+  print(if (is.null(regressions)) benchResults else regressions)
+}
+if (!is.null(regressions) && any(regressions$regression)) {
+  warning(sum(regressions$regression), " configuration(s) regressed compared with runtime ", regressions$baseline_version[1])
+}
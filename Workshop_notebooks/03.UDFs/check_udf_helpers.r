@@ -0,0 +1,65 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC #### Checking the UDF helpers locally
+# MAGIC This notebook checks the parts of the `udf_helpers` notebook that run in the R processes of the UDFs, on local data.frames and without a cluster:
+# MAGIC * `applyByGroup`, which `skewAwareGapply` runs on every partition, and `sampleUdfOutput`, which derives the output schemas
+# MAGIC * `fitGroupLm`, which `batchedGroupLm` runs on every partition, against `lm()` per group, and the formulas `batchedGroupLm` accepts
+# MAGIC
+# MAGIC The notebook source is a plain R script as well. Run it from this folder with `Rscript check_udf_helpers.r`: every check stops with an error when it fails.
+
+# COMMAND ----------
+
+# MAGIC %run ./udf_helpers
+
+# COMMAND ----------
+
+if (!exists("applyByGroup")) {
+  source("udf_helpers.r")   # %run is a comment when the notebook runs as an R script
+}
+
+flights <- data.frame(Origin = c("SFO", NA, "JFK", NA, "SFO", "JFK"),
+                      Dest = c("JFK", "SFO", NA, "SFO", "JFK", NA),
+                      DepDelay = c(1, 2, 3, 4, 5, 6),
+                      ArrDelay = c(2, 1, 7, 9, 8, 11),
+                      stringsAsFactors = FALSE)
+
+# COMMAND ----------
+
+# Rows with an NA key form a group of their own, like in gapply, instead of being dropped
+countRows <- function(key, x) data.frame(Origin = key[[1]], n = nrow(x), total = sum(x$DepDelay), stringsAsFactors = FALSE)
+counted <- applyByGroup(flights, "Origin", countRows)
+stopifnot(nrow(counted) == 3, sum(counted$n) == nrow(flights),
+          counted$total[is.na(counted$Origin)] == 6, counted$total[counted$Origin %in% "SFO"] == 6)
+
+pairs <- applyByGroup(flights, c("Origin", "Dest"), function(key, x) data.frame(n = nrow(x)))
+stopifnot(nrow(pairs) == 3, sum(pairs$n) == nrow(flights))
+
+timed <- applyByGroup(flights, "Origin", countRows, timing = TRUE)
+stopifnot(identical(timed[names(counted)], counted), all(timed$udf_elapsed_s >= 0))
+
+sampled <- sampleUdfOutput(flights, countRows, cols = "Origin", groups = 3)
+stopifnot(nrow(sampled) == 3, any(is.na(sampled$Origin)))
+
+# COMMAND ----------
+
+# The grouped fit matches lm() per group, also for the group with an NA key
+set.seed(42)
+delays <- data.frame(Origin = rep(c("SFO", "JFK", NA), each = 6), DepDelay = stats::rnorm(18), stringsAsFactors = FALSE)
+delays$ArrDelay <- 2 * delays$DepDelay + stats::rnorm(18)
+fitted <- fitGroupLm(delays, "Origin", "ArrDelay", "DepDelay")
+stopifnot(nrow(fitted) == 6, sum(is.na(fitted$Origin)) == 2)
+for (origin in list("SFO", "JFK", NA)) {
+  expected <- summary(stats::lm(ArrDelay ~ DepDelay, delays[delays$Origin %in% origin, ]))$coefficients
+  got <- fitted[fitted$Origin %in% origin, ]
+  stopifnot(identical(got$term, c("(Intercept)", "DepDelay")),
+            isTRUE(all.equal(got$estimate, unname(expected[, 1]))),
+            isTRUE(all.equal(got$std_error, unname(expected[, 2]))),
+            isTRUE(all.equal(got$p_value, unname(expected[, 4]))))
+}
+
+# Formulas that are not a simple linear regression with an intercept are rejected instead of fitted as y ~ x
+for (formula in list(log(ArrDelay) ~ DepDelay, ArrDelay ~ DepDelay + I(DepDelay^2), ArrDelay ~ DepDelay - 1,
+                     ArrDelay ~ 0 + DepDelay, ~ DepDelay, ArrDelay ~ ArrDelay)) {
+  rejected <- tryCatch(batchedGroupLm(NULL, "Origin", formula), error = conditionMessage)
+  stopifnot(grepl("simple linear regressions", rejected))
+}
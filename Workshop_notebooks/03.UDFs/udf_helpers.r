@@ -0,0 +1,571 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC ## Helper functions for Distributed R UDFs
+# MAGIC Run this notebook with `%run ./udf_helpers` to get the functions below.
+# MAGIC
+# MAGIC #### Output schema inference cache
+# MAGIC Without a `schema`, Spark samples the output of a UDF to infer it, which is costly on longer running UDFs. Writing the schema by hand is error prone. `cachedGapply`, `cachedDapply` and `cachedSparkApply` take the same arguments as `gapply`, `dapply` and `sparklyr::spark_apply`, but derive the schema themselves when it is not given:
+# MAGIC * The UDF runs once in the driver's R session on a small sample of the input (a few groups for `gapply` and grouped `spark_apply`), and the schema is taken from its output.
+# MAGIC * The schema is cached, keyed by the hash of the function and of the input schema. Later calls with the same function and input take the explicit-schema path right away. Set `options(databricks.udf.schema_cache = "/dbfs/<path>")` to keep the cache across sessions and jobs.
+# MAGIC * Columns that are `NA` in the whole sample are inferred as `boolean`. Pass the schema explicitly for UDFs like that.
+
+# COMMAND ----------
+
+.udfSchemaCache <- new.env()
+
+hashUdf <- function(...) {
+  # Hashes the source of a UDF together with other values that determine its output schema
+  #
+  # Args:
+  #   ...:  Functions and other values to hash
+  #
+  # Return:
+  #   md5 hash
+  keyFile <- tempfile()
+  on.exit(unlink(keyFile))
+  writeLines(unlist(lapply(list(...), deparse)), keyFile)
+  unname(tools::md5sum(keyFile))
+}
+
+getCachedUdfSchema <- function(key, derive) {
+  # Gets an output schema from the cache, or derives and caches it
+  #
+  # Args:
+  #   key:  Cache key, see hashUdf()
+  #   derive:  Function that derives the schema, as a data.frame with the columns name and type
+  #
+  # Return:
+  #   data.frame with the name and type of every output column
+  if (exists(key, envir = .udfSchemaCache, inherits = FALSE)) {
+    return(get(key, envir = .udfSchemaCache))
+  }
+  cacheDir <- getOption("databricks.udf.schema_cache")
+  cacheFile <- if (!is.null(cacheDir)) file.path(cacheDir, paste0(key, ".rds"))
+  if (!is.null(cacheFile) && file.exists(cacheFile)) {
+    fields <- readRDS(cacheFile)
+  } else {
+    fields <- derive()
+    if (!is.null(cacheFile)) {
+      dir.create(cacheDir, recursive = TRUE, showWarnings = FALSE)
+      partFile <- paste0(cacheFile, ".part", Sys.getpid())
+      saveRDS(fields, partFile)
+      file.rename(partFile, cacheFile)
+    }
+  }
+  assign(key, fields, envir = .udfSchemaCache)
+  fields
+}
+
+clearUdfSchemaCache <- function() {
+  # Removes all schemas from the in-memory cache of this session
+  rm(list = ls(.udfSchemaCache, all.names = TRUE), envir = .udfSchemaCache)
+}
+
+sampleUdfOutput <- function(sample, func, cols = NULL, groups = 3) {
+  # Runs a UDF on a local sample of its input
+  #
+  # Args:
+  #   sample:  data.frame with a sample of the input
+  #   func:  UDF, function(key, x) when grouped by cols, function(x) otherwise
+  #   cols:  Optional. Group columns
+  #   groups:  Optional. Number of groups the UDF runs on
+  #
+  # Return:
+  #   data.frame with the combined output
+  if (is.null(cols)) {
+    return(as.data.frame(func(sample)))
+  }
+  sampleGroups <- head(split(sample, lapply(sample[cols], addNA), drop = TRUE), groups)
+  do.call(rbind, lapply(sampleGroups, function(g) as.data.frame(func(unname(as.list(g[1, cols, drop = FALSE])), g))))
+}
+
+# COMMAND ----------
+
+deriveSparkRSchema <- function(x, func, cols = NULL, sampleSize = 1000) {
+  # Derives the output schema of a SparkR UDF from its output on a sample of x
+  #
+  # Return:
+  #   data.frame with the name and Spark type of every output column
+  sample <- SparkR::collect(SparkR::limit(x, sampleSize))
+  out <- sampleUdfOutput(sample, func, cols)
+  types <- SparkR::dtypes(SparkR::createDataFrame(head(out, 10)))
+  data.frame(name = vapply(types, `[`, "", 1), type = vapply(types, `[`, "", 2), stringsAsFactors = FALSE)
+}
+
+toStructType <- function(fields) {
+  # Builds a SparkR structType from a data.frame with the columns name and type
+  do.call(SparkR::structType, lapply(seq_len(nrow(fields)), function(i) SparkR::structField(fields$name[i], fields$type[i])))
+}
+
+cachedGapply <- function(x, cols, func, schema = NULL, sampleSize = 1000) {
+  # SparkR::gapply() that derives and caches the output schema when it is not given
+  #
+  # Args:
+  #   x:  SparkDataFrame
+  #   cols:  Group columns
+  #   func:  function(key, x) applied to every group
+  #   schema:  Optional. Output schema, derived from a sample when NULL
+  #   sampleSize:  Optional. Number of rows of x the schema is derived from
+  #
+  # Return:
+  #   SparkDataFrame
+  if (is.null(schema)) {
+    key <- hashUdf("gapply", func, cols, SparkR::dtypes(x))
+    schema <- toStructType(getCachedUdfSchema(key, function() deriveSparkRSchema(x, func, cols, sampleSize)))
+  }
+  SparkR::gapply(x, cols, func, schema)
+}
+
+cachedDapply <- function(x, func, schema = NULL, sampleSize = 1000) {
+  # SparkR::dapply() that derives and caches the output schema when it is not given
+  #
+  # Args:
+  #   x:  SparkDataFrame
+  #   func:  function(x) applied to every partition
+  #   schema:  Optional. Output schema, derived from a sample when NULL
+  #   sampleSize:  Optional. Number of rows of x the schema is derived from
+  #
+  # Return:
+  #   SparkDataFrame
+  if (is.null(schema)) {
+    key <- hashUdf("dapply", func, SparkR::dtypes(x))
+    schema <- toStructType(getCachedUdfSchema(key, function() deriveSparkRSchema(x, func, NULL, sampleSize)))
+  }
+  SparkR::dapply(x, func, schema)
+}
+
+# COMMAND ----------
+
+toSparklyrType <- function(column) {
+  # Maps an R column to the type name used in the columns argument of spark_apply()
+  switch(class(column)[1],
+         factor = "character",
+         numeric = "double",
+         Date = "date",
+         POSIXct = "timestamp",
+         class(column)[1])
+}
+
+cachedSparkApply <- function(x, f, columns = NULL, group_by = NULL, ..., sampleSize = 1000) {
+  # sparklyr::spark_apply() that derives and caches the output columns when they are not given
+  #
+  # Args:
+  #   x:  tbl_spark
+  #   f:  function(df) applied to every partition, or to every group with group_by
+  #   columns:  Optional. Named list with the type of every output column, derived from a sample when NULL
+  #   group_by:  Optional. Group columns
+  #   ...:  Other arguments of sparklyr::spark_apply()
+  #   sampleSize:  Optional. Number of rows of x the columns are derived from
+  #
+  # Return:
+  #   tbl_spark
+  if (is.null(columns)) {
+    key <- hashUdf("spark_apply", f, group_by, sparklyr::sdf_schema(x))
+    fields <- getCachedUdfSchema(key, function() {
+      sample <- as.data.frame(dplyr::collect(head(x, sampleSize)))
+      out <- sampleUdfOutput(sample, if (is.null(group_by)) f else function(groupKey, g) f(g), group_by)
+      # spark_apply() puts the group columns in front of the output of f
+      out <- c(as.list(sample[0, group_by, drop = FALSE]), as.list(out))
+      data.frame(name = names(out), type = vapply(out, toSparklyrType, ""), stringsAsFactors = FALSE)
+    })
+    columns <- as.list(setNames(fields$type, fields$name))
+  }
+  sparklyr::spark_apply(x, f, columns = columns, group_by = group_by, ...)
+}
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC #### Skew-aware gapply
+# MAGIC `gapply` hashes every group to a partition. When a few keys carry most rows (e.g. hub airports for `Origin`), the R processes of a few partitions dominate the wall-clock time. `skewAwareGapply` takes the same arguments as `gapply`, but plans which groups run in which partition:
+# MAGIC * It counts the rows per key on a sample of the input, and packs the groups into `numPartitions` bins, heaviest first into the least loaded bin. Heavy keys end up alone, light keys share a bin.
+# MAGIC * Every bin becomes exactly one partition, and `dapply` runs the function on every group of a partition with `applyByGroup`. Keys that were not in the sample are spread by hash. Like in `gapply`, rows with an `NA` key form a group of their own.
+# MAGIC * With `timing = TRUE`, the output gets an extra column `udf_elapsed_s` with the time the function took for each group.
+
+# COMMAND ----------
+
+planSkewBins <- function(counts, numBins) {
+  # Packs groups into bins, heaviest group first into the least loaded bin
+  #
+  # Args:
+  #   counts:  data.frame with the key columns and the number of rows per key (count)
+  #   numBins:  Number of bins
+  #
+  # Return:
+  #   counts with the bin (1..numBins) of every key
+  counts <- counts[order(-counts$count), , drop = FALSE]
+  loads <- numeric(numBins)
+  bins <- integer(nrow(counts))
+  for (i in seq_len(nrow(counts))) {
+    bin <- which.min(loads)
+    bins[i] <- bin
+    loads[bin] <- loads[bin] + counts$count[i]
+  }
+  counts$bin <- bins
+  counts
+}
+
+skewPartition <- function(x, cols, numPartitions = NULL, sampleFraction = 0.1) {
+  # Repartitions x so that all rows of a group are in one partition, and the
+  # partitions get about the same number of rows (see planSkewBins())
+  #
+  # Args:
+  #   x:  SparkDataFrame
+  #   cols:  Group columns
+  #   numPartitions:  Optional. Number of partitions, spark.sql.shuffle.partitions by default
+  #   sampleFraction:  Optional. Fraction of the rows the key frequencies are counted on
+  #
+  # Return:
+  #   SparkDataFrame
+  if (is.null(numPartitions)) {
+    numPartitions <- as.integer(SparkR::sparkR.conf("spark.sql.shuffle.partitions")[[1]])
+  }
+
+  # plan the bins from the key frequencies in a sample
+  sampled <- if (sampleFraction < 1) SparkR::sample(x, withReplacement = FALSE, fraction = sampleFraction) else x
+  counts <- SparkR::collect(SparkR::count(do.call(SparkR::groupBy, c(list(sampled), as.list(cols)))))
+  plan <- planSkewBins(counts, numPartitions)
+  loads <- tapply(plan$count, factor(plan$bin, levels = seq_len(numPartitions)), sum, default = 0)
+  message(sprintf("Planned %d groups into %d partitions, largest partition %.0f%% of the average",
+                  nrow(plan), numPartitions, 100 * max(loads) / mean(loads)))
+
+  # repartition() hashes its column, so every bin gets a label that hashes to the partition of the bin
+  labels <- SparkR::collect(SparkR::sql(sprintf(
+    "SELECT pmod(hash(id), %d) + 1 AS bin, min(id) AS label FROM range(%d) GROUP BY 1", numPartitions, numPartitions * 64)))
+  plan$skew_bin <- labels$label[match(plan$bin, labels$bin)]
+
+  viewId <- paste0(base::sample(letters, 12, replace = TRUE), collapse = "")
+  SparkR::createOrReplaceTempView(x, paste0("skew_input_", viewId))
+  SparkR::createOrReplaceTempView(SparkR::createDataFrame(plan[c(cols, "skew_bin")]), paste0("skew_plan_", viewId))
+  quoted <- paste0("`", cols, "`")
+  joined <- SparkR::sql(sprintf(
+    "SELECT /*+ BROADCAST(p) */ i.*, cast(coalesce(p.skew_bin, hash(%s)) AS bigint) AS skew_bin FROM skew_input_%s i LEFT JOIN skew_plan_%s p ON %s",
+    paste0("i.", quoted, collapse = ", "), viewId, viewId,
+    paste0("i.", quoted, " <=> p.", quoted, collapse = " AND ")))
+  SparkR::drop(SparkR::repartition(joined, numPartitions = numPartitions, col = joined$skew_bin), "skew_bin")
+}
+
+applyByGroup <- function(part, cols, func, timing = FALSE) {
+  # Applies a UDF to every group of a data.frame like gapply() does, where the rows
+  # with an NA key form a group of their own
+  #
+  # Args:
+  #   part:  data.frame, e.g. a partition in dapply()
+  #   cols:  Group columns
+  #   func:  function(key, x) applied to every group
+  #   timing:  Optional. Add the time the function took per group as column udf_elapsed_s
+  #
+  # Return:
+  #   data.frame with the combined output
+  groups <- split(part, lapply(part[cols], addNA), drop = TRUE)
+  do.call(rbind, lapply(groups, function(g) {
+    start <- proc.time()[["elapsed"]]
+    out <- as.data.frame(func(unname(as.list(g[1, cols, drop = FALSE])), g))
+    if (timing) {
+      out$udf_elapsed_s <- rep(proc.time()[["elapsed"]] - start, nrow(out))
+    }
+    out
+  }))
+}
+
+skewAwareGapply <- function(x, cols, func, schema = NULL, numPartitions = NULL, sampleFraction = 0.1, timing = FALSE) {
+  # Drop-in replacement for SparkR::gapply() that balances the groups over the partitions
+  #
+  # Args:
+  #   x:  SparkDataFrame
+  #   cols:  Group columns
+  #   func:  function(key, x) applied to every group
+  #   schema:  Optional. Output schema, derived from a sample when NULL (see cachedGapply())
+  #   numPartitions:  Optional. Number of partitions, spark.sql.shuffle.partitions by default
+  #   sampleFraction:  Optional. Fraction of the rows the key frequencies are counted on
+  #   timing:  Optional. Add the time the function took per group as column udf_elapsed_s
+  #
+  # Return:
+  #   SparkDataFrame
+  if (is.null(schema)) {
+    key <- hashUdf("gapply", func, cols, SparkR::dtypes(x))
+    schema <- toStructType(getCachedUdfSchema(key, function() deriveSparkRSchema(x, func, cols)))
+  }
+  partitioned <- skewPartition(x, cols, numPartitions, sampleFraction)
+
+  outSchema <- if (timing) do.call(SparkR::structType, c(schema$fields(), list(SparkR::structField("udf_elapsed_s", "double")))) else schema
+  outNames <- vapply(outSchema$fields(), function(field) field$name(), "")
+  SparkR::dapply(partitioned, function(part) {
+    if (nrow(part) == 0) {
+      return(as.data.frame(setNames(replicate(length(outNames), logical(0), simplify = FALSE), outNames)))
+    }
+    applyByGroup(part, cols, func, timing)
+  }, outSchema)
+}
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC #### Batched linear models per group
+# MAGIC Fitting `lm(y ~ x)` per group with `gapply` starts an R evaluation per group and serialises a small `broom::tidy` data.frame for every one of them. With thousands of groups that overhead dominates. `batchedGroupLm` fits all simple linear regressions of a partition at once instead:
+# MAGIC * The groups are balanced over the partitions with `skewPartition` (see skew-aware gapply above), and `dapply` hands every R process a whole partition.
+# MAGIC * Within a partition, all models are fitted in closed form with grouped sums (`rowsum`), without a loop over the groups. Every partition returns one data.frame, which is a single Arrow batch when Arrow is enabled.
+# MAGIC * The output has the columns of `broom::tidy(lm(y ~ x))` (`term`, `estimate`, `std_error`, `statistic`, `p_value`) followed by the group columns, with the same values as the per-group path up to floating point rounding.
+
+# COMMAND ----------
+
+fitGroupLm <- function(df, cols, yvar, xvar) {
+  # Fits lm(yvar ~ xvar) for every group of df at once, with grouped sums
+  #
+  # Args:
+  #   df:  data.frame
+  #   cols:  Group columns
+  #   yvar:  Response column
+  #   xvar:  Predictor column
+  #
+  # Return:
+  #   data.frame with the columns of broom::tidy() and the group columns, two rows per group
+  df <- df[stats::complete.cases(df[c(yvar, xvar)]), , drop = FALSE]
+  if (nrow(df) == 0) {
+    return(cbind(data.frame(term = character(0), estimate = numeric(0), std_error = numeric(0),
+                            statistic = numeric(0), p_value = numeric(0), stringsAsFactors = FALSE),
+                 df[0, cols, drop = FALSE]))
+  }
+  # rows with an NA key are a group of their own, as in gapply()
+  group <- interaction(lapply(df[cols], addNA), drop = TRUE, lex.order = TRUE)
+  g <- as.integer(group)
+  keys <- df[match(seq_len(nlevels(group)), g), cols, drop = FALSE]
+  y <- as.numeric(df[[yvar]])
+  x <- as.numeric(df[[xvar]])
+
+  # centre per group first, which is as accurate as the QR decomposition of lm()
+  n <- tabulate(g, nlevels(group))
+  xbar <- as.vector(rowsum(x, g)) / n
+  ybar <- as.vector(rowsum(y, g)) / n
+  dx <- x - xbar[g]
+  dy <- y - ybar[g]
+  ssxx <- as.vector(rowsum(dx * dx, g))
+  ssxy <- as.vector(rowsum(dx * dy, g))
+
+  # lm() reports an NA slope when the predictor is constant within a group
+  aliased <- !(ssxx > 0)
+  slope <- ifelse(aliased, NA_real_, ssxy / ssxx)
+  intercept <- ifelse(aliased, ybar, ybar - slope * xbar)
+  dfResidual <- n - 2 + aliased
+  rss <- as.vector(rowsum((dy - ifelse(aliased, 0, slope)[g] * dx)^2, g))
+  sigma2 <- ifelse(dfResidual > 0, rss / dfResidual, NaN)
+  seSlope <- sqrt(sigma2 / ssxx)
+  seIntercept <- ifelse(aliased, sqrt(sigma2 / n), sqrt(sigma2 * (1 / n + xbar^2 / ssxx)))
+
+  estimate <- c(rbind(intercept, slope))
+  stdError <- c(rbind(seIntercept, ifelse(aliased, NA_real_, seSlope)))
+  statistic <- estimate / stdError
+  out <- data.frame(term = rep(c("(Intercept)", xvar), length(n)),
+                    estimate = estimate,
+                    std_error = stdError,
+                    statistic = statistic,
+                    p_value = 2 * stats::pt(abs(statistic), rep(dfResidual, each = 2), lower.tail = FALSE),
+                    stringsAsFactors = FALSE)
+  cbind(out, keys[rep(seq_len(nrow(keys)), each = 2), , drop = FALSE], row.names = NULL)
+}
+
+batchedGroupLm <- function(x, cols, formula, numPartitions = NULL, sampleFraction = 0.1) {
+  # Fits a simple linear regression per group, all groups of a partition at once
+  #
+  # Args:
+  #   x:  SparkDataFrame
+  #   cols:  Group columns
+  #   formula:  Model formula with one response and one predictor column, e.g. ArrDelay ~ DepDelay
+  #   numPartitions:  Optional. Number of partitions, see skewPartition()
+  #   sampleFraction:  Optional. Fraction of the rows the key frequencies are counted on
+  #
+  # Return:
+  #   SparkDataFrame with the columns of broom::tidy() and the group columns
+  # A single column on either side, so no transformations, extra terms or a removed intercept (- 1, 0 +)
+  if (length(formula) != 3 || !is.name(formula[[2]]) || !is.name(formula[[3]]) || identical(formula[[2]], formula[[3]])) {
+    stop("batchedGroupLm fits simple linear regressions with an intercept, y ~ x, not ", deparse(formula), call. = FALSE)
+  }
+  yvar <- as.character(formula[[2]])
+  xvar <- as.character(formula[[3]])
+  input <- do.call(SparkR::select, c(list(x), as.list(c(cols, yvar, xvar))))
+  partitioned <- skewPartition(input, cols, numPartitions, sampleFraction)
+
+  keyTypes <- setNames(vapply(SparkR::dtypes(x), `[`, "", 2), vapply(SparkR::dtypes(x), `[`, "", 1))[cols]
+  schema <- toStructType(data.frame(name = c("term", "estimate", "std_error", "statistic", "p_value", cols),
+                                    type = c("string", "double", "double", "double", "double", keyTypes),
+                                    stringsAsFactors = FALSE))
+  SparkR::dapply(partitioned, function(part) fitGroupLm(part, cols, yvar, xvar), schema)
+}
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC #### Vectorised elementwise transforms
+# MAGIC `dapply` converts a whole partition into one data.frame before the function runs, and converts the whole output back. For elementwise transforms like `jitter(x$DepDelay)`, `vectorisedApply` streams the partition through R instead:
+# MAGIC * It runs on `sparklyr::spark_apply` with Arrow, which hands the function one Arrow record batch of `batchSize` rows at a time, and writes every output batch back as Arrow. Peak memory of the R process is bounded by the batch size, not by the size of the partition.
+# MAGIC * The function gets a batch as data.frame and returns the new columns (a named list or data.frame) computed with vectorised R functions. They are added to the input columns.
+# MAGIC * The output columns are derived from a sample and cached, like `cachedSparkApply`, unless `columns` is given.
+
+# COMMAND ----------
+
+vectorisedApply <- function(x, f, columns = NULL, batchSize = 10000) {
+  # Adds the columns computed by a vectorised function to x, one Arrow record batch at a time
+  #
+  # Args:
+  #   x:  tbl_spark
+  #   f:  function(batch) returning a named list or data.frame with the new columns
+  #   columns:  Optional. Named list with the type of every output column, derived from a sample when NULL
+  #   batchSize:  Optional. Number of rows per Arrow record batch
+  #
+  # Return:
+  #   tbl_spark
+  if (!requireNamespace("arrow", quietly = TRUE)) {
+    stop("vectorisedApply needs the arrow package")
+  }
+  if (!"package:arrow" %in% search()) {
+    suppressMessages(library(arrow))   # sparklyr only uses Arrow when the package is attached
+  }
+  applyBatch <- function(batch, f) cbind(batch, as.data.frame(f(batch), stringsAsFactors = FALSE))
+  if (is.null(columns)) {
+    key <- hashUdf("vectorised", f, sparklyr::sdf_schema(x))
+    fields <- getCachedUdfSchema(key, function() {
+      out <- applyBatch(as.data.frame(dplyr::collect(head(x, 100))), f)
+      data.frame(name = names(out), type = vapply(out, toSparklyrType, ""), stringsAsFactors = FALSE)
+    })
+    columns <- as.list(setNames(fields$type, fields$name))
+  }
+  sparklyr::spark_apply(x, applyBatch, context = f, columns = columns, packages = FALSE,
+                        arrow_max_records_per_batch = batchSize)
+}
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC #### Streaming dapplyCollect
+# MAGIC `dapplyCollect` sends the output of all partitions to the driver at once, so it must fit in the driver's memory. `streamingDapplyCollect` applies the function to every partition like `dapplyCollect`, but brings the output to the driver incrementally, as Arrow batches:
+# MAGIC * With a `callback`, every batch is handed to `callback(batch, index)` and dropped afterwards, so the driver only ever holds one batch.
+# MAGIC * Without it, the batches are collected until they take more than `memoryBudget` bytes. From then on all batches are spilled to Parquet files in `spillDir` on local disk, and the result is an Arrow Dataset on those files (`arrow::open_dataset`), which can be queried with `dplyr` and collected in parts. Below the budget the result is a data.frame, as with `dapplyCollect`.
+
+# COMMAND ----------
+
+streamingDapplyCollect <- function(x, f, columns = NULL, callback = NULL, memoryBudget = 1024^3,
+                                   spillDir = file.path("/local_disk0/tmp", basename(tempfile("dapply_spill")))) {
+  # Applies a function to every partition of x and brings the output to the driver in Arrow batches
+  #
+  # Args:
+  #   x:  tbl_spark
+  #   f:  function(df) applied to every partition
+  #   columns:  Optional. Named list with the type of every output column, see cachedSparkApply()
+  #   callback:  Optional. function(batch, index) called for every batch of the output
+  #   memoryBudget:  Optional. Bytes of output kept in memory before it is spilled to spillDir
+  #   spillDir:  Optional. Local directory for the spilled Parquet files
+  #
+  # Return:
+  #   data.frame, an Arrow Dataset when the output was spilled, or the number of rows with a callback
+  if (!requireNamespace("arrow", quietly = TRUE)) {
+    stop("streamingDapplyCollect needs the arrow package")
+  }
+  if (!"package:arrow" %in% search()) {
+    suppressMessages(library(arrow))   # sparklyr only collects in batches when the package is attached
+  }
+  out <- cachedSparkApply(x, f, columns = columns, packages = FALSE)
+
+  batches <- list()
+  held <- 0
+  rows <- 0
+  spilled <- 0
+  spill <- function(batch) {
+    dir.create(spillDir, recursive = TRUE, showWarnings = FALSE)
+    spilled <<- spilled + 1
+    arrow::write_parquet(batch, file.path(spillDir, sprintf("part-%06d.parquet", spilled)))
+  }
+  sparklyr::sdf_collect(out, callback = function(batch, index) {
+    rows <<- rows + nrow(batch)
+    if (!is.null(callback)) {
+      callback(batch, index)
+    } else if (spilled > 0) {
+      spill(batch)
+    } else {
+      batches[[length(batches) + 1]] <<- batch
+      held <<- held + as.numeric(utils::object.size(batch))
+      if (held > memoryBudget) {
+        message(sprintf("Output exceeds the memory budget of %.0f MB, spilling to %s", memoryBudget / 1024^2, spillDir))
+        for (heldBatch in batches) {
+          spill(heldBatch)
+        }
+        batches <<- list()
+      }
+    }
+  })
+
+  if (!is.null(callback)) {
+    return(rows)
+  }
+  if (spilled > 0) {
+    return(arrow::open_dataset(spillDir))
+  }
+  do.call(rbind, batches)
+}
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC #### Batched spark.lapply
+# MAGIC `spark.lapply` runs one Spark task per list element. For parameter sweeps with many cheap elements, the overhead of a task and of starting R dominates. `batchedSparkLapply` takes the same arguments, but:
+# MAGIC * Splits the list into `numChunks` chunks (by default 4 per core of the cluster) and runs one task per chunk, which applies the function to all of its elements.
+# MAGIC * When the function returns data.frames (or named lists of columns of equal length) with the same columns, every task combines its results column by column, and the driver combines the chunks into one data.frame the same way, with one `c()` per column instead of an `rbind` of many small data.frames. Other results, e.g. numbers, are returned as a list, like `spark.lapply` does and like `combine = FALSE` always does.
+
+# COMMAND ----------
+
+canCombineColumns <- function(frames) {
+  # Checks whether combineColumns() can combine the results: all of them data.frames or
+  # named lists of columns of equal length, with the same column names
+  frames <- Filter(Negate(is.null), frames)
+  isColumnar <- function(x) {
+    is.data.frame(x) ||
+      (is.list(x) && length(x) > 0 && !is.null(names(x)) && all(nzchar(names(x))) &&
+         all(vapply(x, is.atomic, logical(1))) && length(unique(lengths(x))) == 1)
+  }
+  all(vapply(frames, function(x) isColumnar(x) && identical(names(x), names(frames[[1]])), logical(1)))
+}
+
+combineColumns <- function(frames) {
+  # Combines data.frames (or lists of columns) with the same columns into one data.frame, column by column
+  frames <- Filter(function(frame) length(frame) > 0, frames)   # NULL results and chunks without results
+  if (length(frames) == 0) {
+    return(data.frame())
+  }
+  columns <- lapply(setNames(names(frames[[1]]), names(frames[[1]])), function(col) {
+    do.call(c, unname(lapply(frames, `[[`, col)))
+  })
+  as.data.frame(columns, stringsAsFactors = FALSE, optional = TRUE)
+}
+
+batchedSparkLapply <- function(list, func, numChunks = NULL, combine = TRUE) {
+  # SparkR::spark.lapply() that applies func to chunks of elements instead of one element per task
+  #
+  # Args:
+  #   list:  List or vector of elements
+  #   func:  Function applied to every element
+  #   numChunks:  Optional. Number of chunks (Spark tasks), 4 per core by default
+  #   combine:  Optional. Combine data.frame results into one data.frame
+  #
+  # Return:
+  #   data.frame when combine is TRUE and all results can be combined (see canCombineColumns()),
+  #   a list with the result of every element otherwise
+  if (length(list) == 0) {
+    return(if (combine) data.frame() else list())
+  }
+  if (is.null(numChunks)) {
+    numChunks <- 4 * as.integer(SparkR::sparkR.conf("spark.default.parallelism", "50")[[1]])
+  }
+  numChunks <- max(1, min(numChunks, length(list)))
+  chunks <- unname(split(as.list(list), ceiling(seq_along(list) * numChunks / length(list))))
+  results <- SparkR::spark.lapply(chunks, function(chunk) {
+    out <- lapply(chunk, func)
+    if (combine && canCombineColumns(out)) list(combined = combineColumns(out)) else list(elements = out)
+  })
+  combined <- vapply(results, function(result) !is.null(result$combined), logical(1))
+  if (all(combined)) {
+    return(combineColumns(lapply(results, `[[`, "combined")))
+  }
+  if (any(combined)) {
+    stop("Only some results of func can be combined into a data.frame, use combine = FALSE", call. = FALSE)
+  }
+  do.call(c, lapply(results, `[[`, "elements"))
+}
@@ -215,6 +215,35 @@ head(beer_runs$response_tidy)
 ```
 
 
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC Both functions fetch all jobs of the workspace on every call, and `runs_list()` by name first has to find the job among them. When you look up jobs and runs often, e.g. in a dashboard, keep a local index of them with the `jobs_index` notebook instead. It only fetches what changed since the last sync and looks up job names in memory.
+# MAGIC 
+# MAGIC ``` r
+# MAGIC index <- open_jobs_index(databricks_client(workspace, token), "/local_disk0/jobs_index.sqlite")
+# MAGIC sync_jobs_index(index)
+# MAGIC #> Index has 629 jobs and 20480 runs, 20480 runs fetched
+# MAGIC 
+# MAGIC job_id <- job_id_by_name(index, "Lager Sales Forecasting Job")
+# MAGIC beer_runs <- runs_table(index, job_id)
+# MAGIC ```
+# MAGIC 
+# MAGIC Keep the index on local disk: the DBFS fusion mount (`/dbfs`) does not support the random writes and file locks SQLite needs, so an index opened there can fail or get corrupted. To keep it across clusters, copy the closed index to DBFS and back to local disk before opening it again:
+# MAGIC 
+# MAGIC ``` r
+# MAGIC close_jobs_index(index)
+# MAGIC file.copy("/local_disk0/jobs_index.sqlite", "/dbfs/tmp/jobs_index.sqlite", overwrite = TRUE)
+# MAGIC ```
+
+# COMMAND ----------
+
+# MAGIC %run ./rest_client
+
+# COMMAND ----------
+
+# MAGIC %run ./jobs_index
+
 # COMMAND ----------
 
 # MAGIC %md
@@ -0,0 +1,73 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC #### Importing a directory of R scripts
+# MAGIC `import_directory(client, dir, workspace_dir)` imports all R scripts in a local directory (and its subdirectories) as notebooks into a workspace folder. Run it after `%run ./rest_client`, which defines the `client`.
+# MAGIC * The MD5 hash of every script is compared with a manifest of the hashes that were last imported (by default `.databricks_manifest.json` in the directory), so only new and changed scripts are uploaded and a deploy takes as long as the diff, not the repository.
+# MAGIC * The uploads run concurrently with `databricks_concurrent`, with at most `max_concurrent` requests at a time over one pool of connections. Uploads that fail with `429`, a `5xx` error or a connection error are retried with the same backoff as `databricks_request`.
+# MAGIC * The manifest is updated with the scripts that were imported, also when others failed, so the next run only retries those.
+
+# COMMAND ----------
+
+read_manifest <- function(manifest) {
+  # Reads the hashes of the last import, named by workspace URL and notebook path
+  if (!file.exists(manifest)) {
+    return(character(0))
+  }
+  c(character(0), unlist(jsonlite::read_json(manifest)))
+}
+
+write_manifest <- function(deployed, manifest) {
+  # Replaces the manifest in one step, so an interrupted run never leaves half a manifest behind
+  part <- paste0(manifest, ".part")
+  jsonlite::write_json(as.list(deployed[order(names(deployed))]), part, auto_unbox = TRUE, pretty = TRUE)
+  file.rename(part, manifest)
+}
+
+# COMMAND ----------
+
+import_directory <- function(client, dir, workspace_dir, manifest = file.path(dir, ".databricks_manifest.json"),
+                             pattern = "\\.[Rr]$", max_concurrent = 8) {
+  # Imports the R scripts in a directory that changed since the last import as notebooks
+  #
+  # Args:
+  #   client:  Client, see databricks_client()
+  #   dir:  Local directory with the scripts
+  #   workspace_dir:  Workspace folder to import to, e.g. /Shared/scripts
+  #   manifest:  Optional. Path of the manifest with the hashes of the last import
+  #   pattern:  Optional. Regular expression of the script names; the match is removed from the notebook name
+  #   max_concurrent:  Optional. Maximum number of concurrent uploads
+  #
+  # Return:
+  #   data.frame with file, notebook path, status ("unchanged", "imported" or "failed") and HTTP status per script
+  files <- list.files(dir, pattern = pattern, recursive = TRUE)
+  paths <- paste0(sub("/+$", "", workspace_dir), "/", sub(pattern, "", files))
+  hashes <- unname(tools::md5sum(file.path(dir, files)))
+  keys <- paste0(client$workspace, paths)
+  deployed <- read_manifest(manifest)
+  changed <- which(is.na(deployed[keys]) | deployed[keys] != hashes)
+
+  result <- data.frame(file = files, path = paths, status = rep("unchanged", length(files)),
+                       http_status = rep(NA_integer_, length(files)), stringsAsFactors = FALSE)
+  if (length(changed) > 0) {
+    for (folder in unique(dirname(paths[changed]))) {
+      databricks_request(client, "POST", "/api/2.0/workspace/mkdirs", body = list(path = folder))
+    }
+    forms <- lapply(changed, function(i) {
+      list(path = paths[i], language = "R", overwrite = "true", content = curl::form_file(file.path(dir, files[i])))
+    })
+    result$http_status[changed] <- databricks_concurrent(client, "/api/2.0/workspace/import", forms, encode = "multipart",
+                                                         max_concurrent = max_concurrent)$status
+    result$status[changed] <- ifelse(result$http_status[changed] %in% 200, "imported", "failed")
+
+    imported <- changed[result$status[changed] == "imported"]
+    deployed[keys[imported]] <- hashes[imported]
+    write_manifest(deployed, manifest)
+  }
+
+  message(sprintf("Imported %d of %d scripts: %d unchanged, %d failed", sum(result$status == "imported"),
+                  nrow(result), sum(result$status == "unchanged"), sum(result$status == "failed")))
+  if (any(result$status == "failed")) {
+    stop("Failed to import: ", paste(result$file[result$status == "failed"], collapse = ", "), call. = FALSE)
+  }
+  result
+}
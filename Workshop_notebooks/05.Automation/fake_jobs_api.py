@@ -0,0 +1,137 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC #### Testing the run monitor against a fake Jobs API
+# MAGIC This notebook checks `monitor_runs` of the `run_monitor` notebook without a workspace. `FakeJobsApi` serves `/api/2.1/jobs/runs/get` locally for runs that wait in the queue, start a cluster and execute for given durations, in the format of single-task or of multi-task runs, and rate limits every few requests with `429` and a `Retry-After` header.
+# MAGIC
+# MAGIC The notebook source is a plain Python script as well: `python fake_jobs_api.py` runs the checks and fails with an `AssertionError` when one of them fails.
+
+# COMMAND ----------
+
+# MAGIC %run ./run_monitor
+
+# COMMAND ----------
+
+import os
+import random
+import time
+
+from aiohttp import web
+
+if "RunMonitor" not in globals():
+    # %run is a comment when the notebook runs as a Python script
+    exec(open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "run_monitor.py")).read())
+
+
+class FakeJobsApi:
+    """Serves /api/2.1/jobs/runs/get for runs {run_id: (queue_s, setup_s, execution_s, result_state)} that start when the API starts.
+
+    The runs in multi_task are reported like multi-task runs: with two tasks that run one after the other on a
+    shared cluster, durations per task and a run_duration, and zero setup and execution durations of the run.
+    """
+
+    def __init__(self, runs, token="dapi-test", rate_limit_every=0, multi_task=()):
+        self.runs = runs
+        self.multi_task = set(multi_task)
+        self.token = token
+        self.rate_limit_every = rate_limit_every
+        self.requests = 0
+        self.rate_limited = 0
+        self.url = None
+        self.started = None
+        self.runner = None
+
+    async def runs_get(self, request):
+        self.requests += 1
+        if request.headers.get("Authorization") != "Bearer " + self.token:
+            return web.json_response({"error_code": "UNAUTHENTICATED", "message": "Invalid access token"}, status=401)
+        if self.rate_limit_every and self.requests % self.rate_limit_every == 0:
+            self.rate_limited += 1
+            return web.json_response({"error_code": "REQUEST_LIMIT_EXCEEDED", "message": "Rate limited"},
+                                     status=429, headers={"Retry-After": "0"})
+        run_id = int(request.query["run_id"])
+        if run_id not in self.runs:
+            return web.json_response({"error_code": "INVALID_PARAMETER_VALUE", "message": "Run {0} does not exist".format(run_id)}, status=400)
+
+        queue_s, setup_s, execution_s, result_state = self.runs[run_id]
+        elapsed = time.time() - self.started
+        run = {"run_id": run_id, "job_id": run_id % 10, "start_time": int(self.started * 1000)}
+        if elapsed < queue_s:
+            run["state"] = {"life_cycle_state": "QUEUED"}
+        elif elapsed < queue_s + setup_s:
+            run["state"] = {"life_cycle_state": "PENDING"}
+        elif elapsed < queue_s + setup_s + execution_s:
+            run["state"] = {"life_cycle_state": "RUNNING"}
+        else:
+            run["state"] = {"life_cycle_state": "TERMINATED", "result_state": result_state}
+            run.update(queue_duration=int(queue_s * 1000), setup_duration=int(setup_s * 1000),
+                       execution_duration=int(execution_s * 1000),
+                       end_time=int((self.started + queue_s + setup_s + execution_s) * 1000))
+            if run_id in self.multi_task:
+                first_start = self.started + queue_s
+                second_start = first_start + setup_s + execution_s / 2
+                run.update(format="MULTI_TASK", setup_duration=0, execution_duration=0, cleanup_duration=0,
+                           run_duration=run["end_time"] - run["start_time"], tasks=[
+                               {"task_key": "first", "start_time": int(first_start * 1000),
+                                "setup_duration": int(setup_s * 1000), "execution_duration": int(execution_s / 2 * 1000),
+                                "end_time": int(second_start * 1000)},
+                               {"task_key": "second", "start_time": int(second_start * 1000),
+                                "setup_duration": 0, "execution_duration": int(execution_s / 2 * 1000),
+                                "end_time": run["end_time"]}])
+        return web.json_response(run)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/api/2.1/jobs/runs/get", self.runs_get)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.url = "http://127.0.0.1:{0}".format(self.runner.addresses[0][1])
+        self.started = time.time()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+# COMMAND ----------
+
+async def check_run_monitor(num_runs=200):
+    random.seed(42)
+    runs = {run_id: (random.uniform(0, 0.5), random.uniform(0, 1), random.uniform(0, 2), random.choice(["SUCCESS", "SUCCESS", "FAILED"]))
+            for run_id in range(1, num_runs + 1)}
+    multi_task = set(range(5, num_runs + 1, 5))
+    api = FakeJobsApi(runs, rate_limit_every=7, multi_task=multi_task)
+    await api.start()
+    events = []
+    try:
+        stats = await monitor_runs(api.url, "dapi-test", list(runs) + [num_runs + 1], on_complete=events.append,
+                                   min_interval=0.05, max_interval=0.5, max_concurrent=16, backoff=0.01)
+    finally:
+        await api.stop()
+
+    # Every run is reported once, as soon as it finished, with the timings of the API, also for multi-task runs
+    assert len(events) == num_runs + 1 and sorted(event["run_id"] for event in events) == list(range(1, num_runs + 2))
+    by_run = {event["run_id"]: event for event in stats}
+    for run_id, (queue_s, setup_s, execution_s, result_state) in runs.items():
+        assert by_run[run_id]["result_state"] == result_state
+        assert abs(by_run[run_id]["queue_s"] - queue_s) < 0.01 and abs(by_run[run_id]["cluster_start_s"] - setup_s) < 0.01
+        assert abs(by_run[run_id]["execution_s"] - execution_s) < 0.01
+        assert abs(by_run[run_id]["total_s"] - (queue_s + setup_s + execution_s)) < 0.01
+    assert all(by_run[run_id]["execution_s"] > 0 for run_id in multi_task)
+    durations = [sum(runs[event["run_id"]][:3]) for event in events if event["run_id"] in runs]
+    assert statistics.mean(durations[:20]) < statistics.mean(durations[-20:])
+
+    # A run that does not exist is reported as an error instead of stopping the others
+    assert by_run[num_runs + 1]["result_state"] == "MONITOR_ERROR" and "does not exist" in by_run[num_runs + 1]["error"]
+
+    # Rate limited requests were retried, and polling slowed down: polling every run every min_interval
+    # for the 3.5 seconds of the longest run would have taken 70 requests per run
+    assert api.rate_limited > 0
+    assert api.requests < num_runs * 35
+    print("Fake Jobs API served {0} requests, {1} rate limited".format(api.requests, api.rate_limited))
+    return stats
+
+
+# COMMAND ----------
+
+stats = run_async(check_run_monitor())
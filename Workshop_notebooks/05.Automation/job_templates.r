@@ -0,0 +1,127 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC #### Creating many jobs from a template
+# MAGIC `create_job` of the automation notebook creates one job with its own `new_cluster`, so every run of every small R job waits for a cluster to start. This notebook renders many job definitions from one template and creates them concurrently. Run it after `%run ./rest_client`, which defines the `client`.
+# MAGIC * `render_jobs(template, values)` replaces the `{{ name }}` placeholders of a job template (a list in the format of the Jobs API 2.1) with the values of every row of a data frame.
+# MAGIC * `job_cluster(...)` describes a cluster. With an `instance_pool_id` it takes its driver and workers from an [instance pool](https://docs.databricks.com/clusters/instance-pools/index.html), which keeps idle instances ready, so the clusters of the jobs start in seconds instead of minutes.
+# MAGIC * `share_job_cluster(jobs, cluster)` combines the notebook tasks of many jobs into jobs with at most `max_tasks` tasks that run on one shared job cluster, so they pay a single cluster start between them.
+# MAGIC * `create_jobs(client, jobs)` creates all jobs concurrently with `databricks_concurrent` and returns their ids. Creating a job is not idempotent, so only requests rejected with `429` are retried. After a `5xx` error or a connection error the job may exist anyway: it is looked up by name with `databricks_create_job` and only created again when it does not, so the names of the jobs must be unique.
+
+# COMMAND ----------
+
+render_template <- function(template, values) {
+  # Replaces the {{ name }} placeholders in all strings of a nested list by values[[name]]
+  if (is.list(template)) {
+    return(lapply(template, render_template, values = values))
+  }
+  if (!is.character(template)) {
+    return(template)
+  }
+  for (name in names(values)) {
+    template <- gsub(sprintf("{{ %s }}", name), as.character(values[[name]]), template, fixed = TRUE)
+  }
+  unresolved <- regmatches(template, regexpr("\\{\\{ *[^}]+ *\\}\\}", template))
+  if (length(unresolved) > 0) {
+    stop("No value for ", unresolved[1], call. = FALSE)
+  }
+  template
+}
+
+render_jobs <- function(template, values) {
+  # Renders a job definition per row of values
+  #
+  # Args:
+  #   template:  Job settings of the Jobs API 2.1 as a list, with {{ name }} placeholders
+  #   values:  data.frame with a column per placeholder
+  #
+  # Return:
+  #   list of job settings
+  lapply(seq_len(nrow(values)), function(i) render_template(template, as.list(values[i, , drop = FALSE])))
+}
+
+job_cluster <- function(spark_version = "7.3.x-scala2.12", node_type_id = "i3.xlarge", num_workers = 2,
+                        instance_pool_id = NULL, ...) {
+  # Describes a new cluster for a job
+  #
+  # Args:
+  #   spark_version:  Optional. Databricks Runtime version
+  #   node_type_id:  Optional. Instance type, ignored when the cluster takes its instances from a pool
+  #   num_workers:  Optional. Number of workers
+  #   instance_pool_id:  Optional. Id of an instance pool for the driver and the workers
+  #   ...:  Optional. Other fields of the cluster, e.g. spark_conf
+  #
+  # Return:
+  #   cluster as a list
+  cluster <- list(spark_version = spark_version, num_workers = num_workers, ...)
+  if (is.null(instance_pool_id)) {
+    cluster$node_type_id <- node_type_id
+  } else {
+    cluster$instance_pool_id <- instance_pool_id
+    cluster$driver_instance_pool_id <- instance_pool_id
+  }
+  cluster
+}
+
+# COMMAND ----------
+
+share_job_cluster <- function(jobs, cluster, name = "Shared cluster jobs", max_tasks = 100) {
+  # Combines the notebook tasks of jobs into jobs whose tasks all run on one shared job cluster
+  #
+  # Args:
+  #   jobs:  list of job settings with a name and a notebook_task, e.g. from render_jobs()
+  #   cluster:  Shared cluster, see job_cluster()
+  #   name:  Optional. Name of the combined jobs, numbered when there is more than one
+  #   max_tasks:  Optional. Maximum number of tasks per job (the Jobs API allows at most 100)
+  #
+  # Return:
+  #   list of job settings
+  chunks <- split(jobs, ceiling(seq_along(jobs) / max_tasks))
+  lapply(seq_along(chunks), function(i) {
+    tasks <- lapply(chunks[[i]], function(job) {
+      list(task_key = gsub("[^A-Za-z0-9_-]", "_", job$name),
+           job_cluster_key = "shared",
+           notebook_task = job$notebook_task)
+    })
+    keys <- vapply(tasks, function(task) task$task_key, character(1))
+    if (anyDuplicated(keys)) {
+      stop("Task keys must be unique, rename the jobs: ", paste(unique(keys[duplicated(keys)]), collapse = ", "), call. = FALSE)
+    }
+    list(name = if (length(chunks) > 1) sprintf("%s %d", name, i) else name,
+         job_clusters = list(list(job_cluster_key = "shared", new_cluster = cluster)),
+         tasks = unname(tasks),
+         format = "MULTI_TASK")
+  })
+}
+
+create_jobs <- function(client, jobs, max_concurrent = 8) {
+  # Creates jobs concurrently
+  #
+  # Args:
+  #   client:  Client, see databricks_client()
+  #   jobs:  list of job settings of the Jobs API 2.1
+  #   max_concurrent:  Optional. Maximum number of concurrent requests
+  #
+  # Return:
+  #   job ids, in the order of jobs
+  # A job whose response got lost is looked up by name, which is only unambiguous when the names are unique
+  names <- vapply(jobs, function(job) if (is.character(job$name)) job$name else NA_character_, character(1))
+  if (anyNA(names)) {
+    stop("Every job needs a name", call. = FALSE)
+  }
+  if (anyDuplicated(names)) {
+    stop("Job names must be unique, rename the jobs: ", paste(unique(names[duplicated(names)]), collapse = ", "), call. = FALSE)
+  }
+  since <- Sys.time()
+  res <- databricks_concurrent(client, "/api/2.1/jobs/create", jobs, max_concurrent = max_concurrent, idempotent = FALSE)
+  job_ids <- vapply(res$content, function(content) if (is.null(content)) NA_real_ else as.numeric(content$job_id), numeric(1))
+  for (i in which(ambiguous_status(res$status))) {
+    job_ids[i] <- tryCatch(as.numeric(databricks_create_job(client, jobs[[i]], since = since)),
+                           databricks_error = function(e) NA_real_)
+  }
+  failed <- which(is.na(job_ids))
+  if (length(failed) > 0) {
+    stop(sprintf("Failed to create %d of %d jobs: %s", length(failed), length(jobs),
+                 paste(vapply(jobs[failed], function(job) job$name, character(1)), collapse = ", ")), call. = FALSE)
+  }
+  job_ids
+}
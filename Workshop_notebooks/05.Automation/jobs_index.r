@@ -0,0 +1,186 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC #### A local index of jobs and runs
+# MAGIC Listing all jobs and scanning them for a name, as `jobs_list()` and `runs_list()` of bricksteR do, fetches every job of the workspace on every call. In a workspace with thousands of jobs that takes many requests and is easily rate limited. This notebook keeps a local SQLite index of the jobs and runs of a workspace instead. Run it after `%run ./rest_client`, which defines the `client`.
+# MAGIC * `open_jobs_index(client, path)` opens (or creates) the index and loads a dictionary from job names to job ids in memory. Keep the database on local disk (e.g. `/local_disk0`), not on `/dbfs`, whose fusion mount does not support the file locks of SQLite; copy it to DBFS after `close_jobs_index(index)` to keep it.
+# MAGIC * `sync_jobs_index(index)` brings it up to date. The jobs are listed with 100 per page, the maximum of the Jobs API, at most once every `max_age` seconds, since the Jobs API cannot filter them by change. The runs are synced incrementally: only runs that started after the last sync, or that were still active then, are fetched with the `start_time_from` filter.
+# MAGIC * `job_id_by_name(index, name)` looks up a job id in memory, and only asks the API when the name is not in the index yet. `jobs_table(index)` and `runs_table(index)` return the index as data frames, e.g. for dashboards.
+
+# COMMAND ----------
+
+index_field <- function(x, default = NA) {
+  # A field of an API response, or default when it is missing
+  if (is.null(x)) default else x
+}
+
+open_jobs_index <- function(client, path = "jobs_index.sqlite") {
+  # Opens the local index of the jobs and runs of a workspace
+  #
+  # Args:
+  #   client:  Client, see databricks_client()
+  #   path:  Optional. Path of the SQLite database on local disk, e.g. /local_disk0/jobs_index.sqlite.
+  #          Not on /dbfs: the fusion mount does not support the random writes and file locks of SQLite.
+  #          Copy the closed database to DBFS to keep it, and back to local disk before opening it
+  #
+  # Return:
+  #   index
+  con <- DBI::dbConnect(RSQLite::SQLite(), path, bigint = "numeric")
+  DBI::dbExecute(con, "CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY, name TEXT, creator_user_name TEXT, created_time INTEGER)")
+  DBI::dbExecute(con, "CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY, job_id INTEGER, run_name TEXT, life_cycle_state TEXT, result_state TEXT,
+    start_time INTEGER, setup_duration INTEGER, execution_duration INTEGER, end_time INTEGER, run_page_url TEXT)")
+  DBI::dbExecute(con, "CREATE INDEX IF NOT EXISTS runs_job_id ON runs (job_id, start_time)")
+  DBI::dbExecute(con, "CREATE TABLE IF NOT EXISTS sync_state (name TEXT PRIMARY KEY, value INTEGER)")
+
+  index <- new.env()
+  index$client <- client
+  index$con <- con
+  load_job_names(index)
+  index
+}
+
+load_job_names <- function(index) {
+  # Loads the dictionary from job names to job ids from the jobs table
+  jobs <- DBI::dbGetQuery(index$con, "SELECT job_id, name FROM jobs WHERE name IS NOT NULL AND name != ''")
+  index$job_ids <- list2env(split(jobs$job_id, jobs$name), hash = TRUE)
+}
+
+sync_state <- function(index, name, value) {
+  # Reads a value of the sync state, or writes it when value is given
+  if (missing(value)) {
+    return(DBI::dbGetQuery(index$con, "SELECT value FROM sync_state WHERE name = ?", params = list(name))$value[1])
+  }
+  DBI::dbExecute(index$con, "INSERT OR REPLACE INTO sync_state (name, value) VALUES (?, ?)", params = list(name, value))
+}
+
+# COMMAND ----------
+
+jobs_frame <- function(jobs) {
+  # Flattens jobs of the Jobs API into rows of the jobs table
+  data.frame(job_id = vapply(jobs, function(j) as.numeric(j$job_id), numeric(1)),
+             name = vapply(jobs, function(j) as.character(index_field(j$settings$name)), character(1)),
+             creator_user_name = vapply(jobs, function(j) as.character(index_field(j$creator_user_name)), character(1)),
+             created_time = vapply(jobs, function(j) as.numeric(index_field(j$created_time)), numeric(1)),
+             stringsAsFactors = FALSE)
+}
+
+runs_frame <- function(runs) {
+  # Flattens runs of the Jobs API into rows of the runs table
+  data.frame(run_id = vapply(runs, function(r) as.numeric(r$run_id), numeric(1)),
+             job_id = vapply(runs, function(r) as.numeric(index_field(r$job_id)), numeric(1)),
+             run_name = vapply(runs, function(r) as.character(index_field(r$run_name)), character(1)),
+             life_cycle_state = vapply(runs, function(r) as.character(index_field(r$state$life_cycle_state)), character(1)),
+             result_state = vapply(runs, function(r) as.character(index_field(r$state$result_state)), character(1)),
+             start_time = vapply(runs, function(r) as.numeric(index_field(r$start_time)), numeric(1)),
+             setup_duration = vapply(runs, function(r) as.numeric(index_field(r$setup_duration)), numeric(1)),
+             execution_duration = vapply(runs, function(r) as.numeric(index_field(r$execution_duration)), numeric(1)),
+             end_time = vapply(runs, function(r) as.numeric(index_field(r$end_time)), numeric(1)),
+             run_page_url = vapply(runs, function(r) as.character(index_field(r$run_page_url)), character(1)),
+             stringsAsFactors = FALSE)
+}
+
+upsert <- function(con, table, rows) {
+  # Inserts rows into a table, replacing the rows with the same primary key
+  if (nrow(rows) == 0) {
+    return(invisible(0))
+  }
+  DBI::dbWriteTable(con, "staged", rows, temporary = TRUE, overwrite = TRUE)
+  on.exit(DBI::dbRemoveTable(con, "staged"))
+  columns <- paste(names(rows), collapse = ", ")
+  DBI::dbExecute(con, sprintf("INSERT OR REPLACE INTO %s (%s) SELECT %s FROM staged", table, columns, columns))
+}
+
+# COMMAND ----------
+
+sync_jobs <- function(index, max_age = 600) {
+  # Replaces the jobs in the index with all jobs of the workspace, unless they were synced less than max_age seconds ago
+  now <- as.numeric(Sys.time())
+  synced_at <- sync_state(index, "jobs_synced_at")
+  if (!is.na(synced_at) && now - synced_at < max_age) {
+    return(invisible(FALSE))
+  }
+  jobs <- jobs_frame(databricks_list(index$client, "/api/2.1/jobs/list", "jobs", limit = 100))
+  DBI::dbWithTransaction(index$con, {
+    DBI::dbExecute(index$con, "DELETE FROM jobs")
+    upsert(index$con, "jobs", jobs)
+    sync_state(index, "jobs_synced_at", now)
+  })
+  load_job_names(index)
+  invisible(TRUE)
+}
+
+sync_runs <- function(index) {
+  # Fetches the runs that started since the watermark of the last sync and moves the watermark
+  #
+  # Return:
+  #   Number of runs fetched
+  watermark <- sync_state(index, "runs_watermark")
+  query <- if (is.na(watermark)) list() else list(start_time_from = format(watermark, scientific = FALSE))
+  runs <- runs_frame(databricks_list(index$client, "/api/2.1/jobs/runs/list", "runs", query = query))
+  DBI::dbWithTransaction(index$con, {
+    upsert(index$con, "runs", runs)
+    # Runs that were still active can still change, so the next sync starts at the oldest of them
+    watermark <- DBI::dbGetQuery(index$con, "SELECT COALESCE(
+      (SELECT MIN(start_time) FROM runs WHERE life_cycle_state IN ('PENDING', 'QUEUED', 'RUNNING', 'TERMINATING', 'BLOCKED', 'WAITING_FOR_RETRY')),
+      (SELECT MAX(start_time) FROM runs)) AS watermark")$watermark
+    if (!is.na(watermark)) {
+      sync_state(index, "runs_watermark", watermark)
+    }
+  })
+  nrow(runs)
+}
+
+sync_jobs_index <- function(index, max_age = 600) {
+  # Brings the jobs and runs of the index up to date
+  #
+  # Args:
+  #   index:  Index, see open_jobs_index()
+  #   max_age:  Optional. Seconds after which the jobs are listed again
+  sync_jobs(index, max_age)
+  fetched <- sync_runs(index)
+  message(sprintf("Index has %d jobs and %d runs, %d runs fetched",
+                  DBI::dbGetQuery(index$con, "SELECT COUNT(*) AS n FROM jobs")$n,
+                  DBI::dbGetQuery(index$con, "SELECT COUNT(*) AS n FROM runs")$n, fetched))
+  invisible(index)
+}
+
+# COMMAND ----------
+
+job_id_by_name <- function(index, name) {
+  # Looks up the id of a job by its name, in memory, and only asks the API when the name is unknown
+  #
+  # Return:
+  #   job_id, an error when no or more than one job has the name
+  job_ids <- index$job_ids[[name]]
+  if (is.null(job_ids)) {
+    jobs <- jobs_frame(databricks_list(index$client, "/api/2.1/jobs/list", "jobs", query = list(name = name), limit = 100))
+    upsert(index$con, "jobs", jobs)
+    job_ids <- jobs$job_id[jobs$name == name]
+    if (length(job_ids) > 0) {
+      assign(name, job_ids, envir = index$job_ids)
+    }
+  }
+  if (length(job_ids) != 1) {
+    stop(sprintf("%d jobs are named \"%s\", use the job id instead", length(job_ids), name), call. = FALSE)
+  }
+  job_ids
+}
+
+jobs_table <- function(index) {
+  # All jobs in the index
+  DBI::dbGetQuery(index$con, "SELECT * FROM jobs ORDER BY job_id")
+}
+
+runs_table <- function(index, job_id = NULL) {
+  # The runs in the index, of one job or of all jobs, latest first
+  if (is.null(job_id)) {
+    return(DBI::dbGetQuery(index$con, "SELECT * FROM runs ORDER BY start_time DESC"))
+  }
+  DBI::dbGetQuery(index$con, "SELECT * FROM runs WHERE job_id = ? ORDER BY start_time DESC", params = list(job_id))
+}
+
+close_jobs_index <- function(index) {
+  # Closes the connection to the database of the index
+  DBI::dbDisconnect(index$con)
+}
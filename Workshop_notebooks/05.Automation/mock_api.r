@@ -0,0 +1,365 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC #### Testing the REST client against a mock API
+# MAGIC This notebook tests the automation notebooks without a workspace:
+# MAGIC * `import_to_workspace`, `create_job` and `run_job` of the automation notebook
+# MAGIC * the client of the `rest_client` notebook: retries, errors, metrics and `databricks_create_job`
+# MAGIC * `import_directory` of the `bulk_import` notebook
+# MAGIC * the index of the `jobs_index` notebook
+# MAGIC * `render_jobs`, `share_job_cluster` and `create_jobs` of the `job_templates` notebook
+# MAGIC
+# MAGIC It starts a local mock of these endpoints with [webfakes](https://webfakes.r-lib.org/):
+# MAGIC * `/api/2.0/workspace/import` and `/api/2.0/workspace/mkdirs`
+# MAGIC * `/api/2.0/jobs/create` and `/api/2.1/jobs/create`, which can lose the response of the first jobs they create
+# MAGIC * `/api/2.0/jobs/run-now`, which starts one run per `idempotency_token`
+# MAGIC * `/api/2.1/jobs/list` and `/api/2.1/jobs/runs/list`, with pagination
+# MAGIC
+# MAGIC The mock rejects the first requests of every endpoint with `429` or `503` to check that the client retries them.
+# MAGIC
+# MAGIC The notebook source is a plain R script as well. Run it from this folder with `Rscript mock_api.r`: every check stops with an error when it fails.
+
+# COMMAND ----------
+
+# MAGIC %run ./rest_client
+
+# COMMAND ----------
+
+# MAGIC %run ./bulk_import
+
+# COMMAND ----------
+
+# MAGIC %run ./jobs_index
+
+# COMMAND ----------
+
+# MAGIC %run ./job_templates
+
+# COMMAND ----------
+
+if (!exists("databricks_client")) {
+  source("rest_client.r")   # %run is a comment when the notebook runs as an R script
+  source("bulk_import.r")
+  source("jobs_index.r")
+  source("job_templates.r")
+}
+
+# Take the functions under test from the automation notebook, without running its requests
+for (expr in parse("1. Automating R Jobs.r")) {
+  if (is.call(expr) && identical(expr[[1]], as.name("<-")) && is.name(expr[[2]]) &&
+      as.character(expr[[2]]) %in% c("import_to_workspace", "create_job", "run_job")) {
+    eval(expr)
+  }
+}
+
+# COMMAND ----------
+
+mock_databricks_app <- function(token = "dapi-test", failures = c(429L, 503L), retry_after = "0", lost_creates = 0) {
+  # Creates a mock of the Databricks REST API
+  #
+  # Args:
+  #   token:  Personal access token the mock accepts
+  #   failures:  Optional. Statuses of the first requests of every endpoint, before it succeeds
+  #   retry_after:  Optional. Retry-After header of the 429 responses
+  #   lost_creates:  Optional. Number of jobs that are created, but answered with 504 as if the response got lost
+  #
+  # Return:
+  #   webfakes app
+  app <- webfakes::new_app()
+  app$use(webfakes::mw_json())
+  app$use(webfakes::mw_multipart())
+  app$locals$calls <- list()
+  app$locals$requests <- list()
+  app$locals$jobs <- list()
+  app$locals$runs <- list()
+
+  # Checks the token and injects the failures; returns TRUE when the request was answered
+  reject <- function(req, res) {
+    locals <- req$app$locals
+    call <- sum(locals$calls[[req$path]], 1)
+    locals$calls[[req$path]] <- call
+    if (!identical(req$get_header("Authorization"), paste("Bearer", token))) {
+      res$set_status(401L)$send_json(list(error_code = "UNAUTHENTICATED", message = "Invalid access token"), auto_unbox = TRUE)
+      return(TRUE)
+    }
+    if (call <= length(failures)) {
+      if (failures[call] == 429L) {
+        res$set_header("Retry-After", retry_after)
+      }
+      res$set_status(failures[call])$send_json(list(error_code = "TEMPORARILY_UNAVAILABLE", message = "Injected failure"), auto_unbox = TRUE)
+      return(TRUE)
+    }
+    FALSE
+  }
+
+  multipart_value <- function(part) {
+    if (is.raw(part$value)) rawToChar(part$value) else part$value
+  }
+
+  app$post("/api/2.0/workspace/import", function(req, res) {
+    if (reject(req, res)) return()
+    path <- multipart_value(req$multipart$path)
+    if (is.null(path) || is.null(req$multipart$content)) {
+      return(res$set_status(400L)$send_json(list(error_code = "INVALID_PARAMETER_VALUE", message = "Missing path or content"), auto_unbox = TRUE))
+    }
+    locals <- req$app$locals
+    locals$requests[[length(locals$requests) + 1]] <- list(endpoint = req$path, path = path)
+    res$send_json(structure(list(), names = character(0)))
+  })
+
+  app$post("/api/2.0/workspace/mkdirs", function(req, res) {
+    if (reject(req, res)) return()
+    locals <- req$app$locals
+    locals$requests[[length(locals$requests) + 1]] <- list(endpoint = req$path, path = req$json$path)
+    res$send_json(structure(list(), names = character(0)))
+  })
+
+  create_job_handler <- function(req, res) {
+    if (reject(req, res)) return()
+    if (is.null(req$json$name)) {
+      return(res$set_status(400L)$send_json(list(error_code = "INVALID_PARAMETER_VALUE", message = "Missing name"), auto_unbox = TRUE))
+    }
+    locals <- req$app$locals
+    job_id <- length(locals$jobs) + 1
+    locals$jobs[[job_id]] <- list(job_id = job_id, settings = req$json, creator_user_name = "someone@example.com",
+                                  created_time = round(as.numeric(Sys.time()) * 1000))
+    locals$requests[[length(locals$requests) + 1]] <- list(endpoint = req$path, name = req$json$name)
+    if (job_id <= lost_creates) {
+      return(res$set_status(504L)$send_json(list(error_code = "TEMPORARILY_UNAVAILABLE", message = "Gateway timeout"), auto_unbox = TRUE))
+    }
+    res$send_json(list(job_id = job_id), auto_unbox = TRUE)
+  }
+  app$post("/api/2.0/jobs/create", create_job_handler)
+  app$post("/api/2.1/jobs/create", create_job_handler)
+
+  app$post("/api/2.0/jobs/run-now", function(req, res) {
+    if (reject(req, res)) return()
+    locals <- req$app$locals
+    if (!isTRUE(req$json$job_id %in% seq_along(locals$jobs))) {
+      return(res$set_status(400L)$send_json(list(error_code = "INVALID_PARAMETER_VALUE", message = "Job does not exist"), auto_unbox = TRUE))
+    }
+    # A request with the token of an earlier run returns that run instead of starting another one
+    token <- req$json$idempotency_token
+    for (run in locals$runs) {
+      if (!is.null(token) && identical(run$idempotency_token, token)) {
+        return(res$send_json(list(run_id = run$run_id, number_in_job = run$run_id), auto_unbox = TRUE))
+      }
+    }
+    run_id <- length(locals$runs) + 1
+    locals$runs[[run_id]] <- list(run_id = run_id, job_id = req$json$job_id, run_name = locals$jobs[[req$json$job_id]]$settings$name,
+                                  state = list(life_cycle_state = "RUNNING"), start_time = round(as.numeric(Sys.time()) * 1000) + run_id,
+                                  idempotency_token = token)
+    res$send_json(list(run_id = run_id, number_in_job = run_id), auto_unbox = TRUE)
+  })
+
+  # Paginates like the Jobs API 2.1, with limit and an offset as page token
+  send_page <- function(res, field, items, query) {
+    limit <- as.integer(if (is.null(query$limit)) 25 else query$limit)
+    offset <- as.integer(if (is.null(query$page_token)) 0 else query$page_token)
+    page <- items[seq_along(items) > offset & seq_along(items) <= offset + limit]
+    has_more <- offset + limit < length(items)
+    body <- structure(list(page, has_more), names = c(field, "has_more"))
+    if (has_more) {
+      body$next_page_token <- as.character(offset + limit)
+    }
+    res$send_json(body, auto_unbox = TRUE, digits = NA)   # times in milliseconds need all digits
+  }
+
+  app$get("/api/2.1/jobs/list", function(req, res) {
+    if (reject(req, res)) return()
+    jobs <- req$app$locals$jobs
+    if (!is.null(req$query$name)) {
+      jobs <- Filter(function(job) identical(job$settings$name, req$query$name), jobs)
+    }
+    send_page(res, "jobs", jobs, req$query)
+  })
+
+  app$get("/api/2.1/jobs/runs/list", function(req, res) {
+    if (reject(req, res)) return()
+    runs <- rev(req$app$locals$runs)   # latest first
+    if (!is.null(req$query$start_time_from)) {
+      runs <- Filter(function(run) run$start_time >= as.numeric(req$query$start_time_from), runs)
+    }
+    send_page(res, "runs", runs, req$query)
+  })
+
+  # Finishes all runs, as if the clusters completed them
+  app$post("/mock/runs/finish", function(req, res) {
+    locals <- req$app$locals
+    locals$runs <- lapply(locals$runs, function(run) {
+      run$state <- list(life_cycle_state = "TERMINATED", result_state = "SUCCESS")
+      run$end_time <- round(as.numeric(Sys.time()) * 1000)
+      run
+    })
+    res$send_json(structure(list(), names = character(0)))
+  })
+
+  # Everything the mock accepted, to check what the client sent
+  app$get("/mock/requests", function(req, res) {
+    res$send_json(req$app$locals$requests, auto_unbox = TRUE)
+  })
+
+  app
+}
+
+# COMMAND ----------
+
+mock <- webfakes::new_app_process(mock_databricks_app())
+client <- databricks_client(mock$url(), "dapi-test", backoff = 0.01)
+
+# COMMAND ----------
+
+# The import is retried after the injected 429 and 503 and succeeds on the third attempt
+script <- tempfile(fileext = ".R")
+writeLines("print('hello')", script)
+res <- import_to_workspace(script, "/Users/someone@example.com/exampleRscript", client)
+stopifnot(httr::status_code(res) == 200)
+
+# Creating the job is only retried after the 429. After the 503 the job is looked up by name first,
+# and created again because it does not exist
+job_config <- sprintf('{"name": "%s", "notebook_task": {"notebook_path": "%s"}}',
+                      "example_job", "/Users/someone@example.com/exampleRscript")
+job <- create_job(job_config, client)
+stopifnot(job$job_id == 1)
+
+accepted <- databricks_json(httr::GET(mock$url("/mock/requests")))
+stopifnot(accepted[[1]]$path == "/Users/someone@example.com/exampleRscript",
+          accepted[[2]]$name == "example_job", length(accepted) == 2)
+
+metrics_summary <- databricks_metrics_summary(client)
+metrics_summary
+summary_of <- function(endpoint) metrics_summary[metrics_summary$endpoint == endpoint, ]
+stopifnot(summary_of("/api/2.0/workspace/import")$requests == 1, summary_of("/api/2.0/workspace/import")$retries == 2,
+          summary_of("/api/2.0/jobs/create")$requests == 2, summary_of("/api/2.0/jobs/create")$retries == 1,
+          summary_of("/api/2.1/jobs/list")$requests == 1)
+
+# Run-now is retried with the same idempotency token, which starts a single run
+run <- databricks_json(run_job(1, client, idempotency_token = "nightly-1"))
+stopifnot(databricks_json(run_job(1, client, idempotency_token = "nightly-1"))$run_id == run$run_id,
+          databricks_json(run_job(1, client))$run_id != run$run_id)
+
+# A job whose response got lost is found by name instead of being created twice
+lossy <- webfakes::new_app_process(mock_databricks_app(failures = integer(0), lost_creates = 1))
+lossy_client <- databricks_client(lossy$url(), "dapi-test", backoff = 0.01)
+stopifnot(create_job(job_config, lossy_client)$job_id == 1,
+          length(databricks_list(lossy_client, "/api/2.1/jobs/list", "jobs")) == 1)
+lossy$stop()
+
+# COMMAND ----------
+
+# Errors that are not retried stop with the message of the API after a single attempt
+invalid <- tryCatch(create_job('{"notebook_task": {}}', client), error = function(e) conditionMessage(e))
+stopifnot(grepl("status 400", invalid), grepl("Missing name", invalid))
+
+unauthorised <- databricks_client(mock$url(), "dapi-wrong", backoff = 0.01)
+denied <- tryCatch(create_job(job_config, unauthorised), error = function(e) conditionMessage(e))
+stopifnot(grepl("status 401", denied), nrow(databricks_metrics(unauthorised)) == 1)
+
+# COMMAND ----------
+
+# Retries give up after max_retries, and connection errors are retried as well
+flaky <- webfakes::new_app_process(mock_databricks_app(failures = c(503L, 503L, 503L)))
+flaky_url <- flaky$url()
+impatient <- databricks_client(flaky_url, "dapi-test", max_retries = 1, backoff = 0.01)
+failed <- tryCatch(import_to_workspace(script, "/Shared/exampleRscript", impatient), error = function(e) conditionMessage(e))
+stopifnot(grepl("status 503", failed), nrow(databricks_metrics(impatient)) == 2)
+flaky$stop()
+
+unreachable <- databricks_client(flaky_url, "dapi-test", max_retries = 2, backoff = 0.01)
+stopifnot(inherits(tryCatch(import_to_workspace(script, "/Shared/exampleRscript", unreachable), error = function(e) e), "databricks_error"),
+          all(is.na(databricks_metrics(unreachable)$status)), nrow(databricks_metrics(unreachable)) == 3)
+
+# COMMAND ----------
+
+# A bulk import uploads all scripts once, concurrently and with retries, and afterwards only the changed ones
+bulk <- webfakes::new_app_process(mock_databricks_app())
+bulk_client <- databricks_client(bulk$url(), "dapi-test", backoff = 0.01)
+scripts <- file.path(tempfile(), "scripts")
+dir.create(file.path(scripts, "etl"), recursive = TRUE)
+for (name in c("a.R", "b.R", "etl/c.R")) {
+  writeLines(sprintf("print('%s')", name), file.path(scripts, name))
+}
+
+first <- import_directory(bulk_client, scripts, "/Shared/scripts", max_concurrent = 2)
+stopifnot(all(first$status == "imported"),
+          setequal(first$path, c("/Shared/scripts/a", "/Shared/scripts/b", "/Shared/scripts/etl/c")),
+          file.exists(file.path(scripts, ".databricks_manifest.json")))
+
+second <- import_directory(bulk_client, scripts, "/Shared/scripts", max_concurrent = 2)
+stopifnot(all(second$status == "unchanged"))
+
+writeLines("print('changed')", file.path(scripts, "b.R"))
+third <- import_directory(bulk_client, scripts, "/Shared/scripts", max_concurrent = 2)
+stopifnot(third$status[third$file == "b.R"] == "imported", sum(third$status == "imported") == 1)
+
+imports <- databricks_metrics(bulk_client)
+stopifnot(sum(imports$endpoint == "/api/2.0/workspace/import" & imports$status %in% 200) == 4)
+bulk$stop()
+
+# COMMAND ----------
+
+# The index syncs all pages once, only fetches new and active runs afterwards and looks up names in memory
+indexed <- webfakes::new_app_process(mock_databricks_app())
+index_client <- databricks_client(indexed$url(), "dapi-test", backoff = 0.01)
+for (name in c("etl", "report", "model", "report")) {
+  create_job(sprintf('{"name": "%s"}', name), index_client)
+}
+invisible(lapply(1:3, function(job_id) run_job(job_id, index_client)))
+
+index <- open_jobs_index(index_client, tempfile(fileext = ".sqlite"))
+sync_jobs_index(index)
+stopifnot(nrow(jobs_table(index)) == 4, nrow(runs_table(index)) == 3, nrow(runs_table(index, job_id = 1)) == 1)
+
+databricks_request(index_client, "POST", "/mock/runs/finish")
+run_job(4, index_client)
+list_calls <- function() sum(databricks_metrics(index_client)$endpoint == "/api/2.1/jobs/list")
+listed <- list_calls()
+stopifnot(sync_runs(index) == 4, list_calls() == listed)
+stopifnot(all(runs_table(index)$life_cycle_state[runs_table(index)$run_id <= 3] == "TERMINATED"))
+stopifnot(sync_runs(index) == 1)   # only the run that is still active
+
+stopifnot(job_id_by_name(index, "etl") == 1, list_calls() == listed)
+stopifnot(grepl("2 jobs", tryCatch(job_id_by_name(index, "report"), error = conditionMessage)))
+create_job('{"name": "new"}', index_client)
+stopifnot(job_id_by_name(index, "new") == 5, list_calls() == listed + 1)
+stopifnot(length(databricks_list(index_client, "/api/2.1/jobs/list", "jobs", limit = 2)) == 5, list_calls() == listed + 4)
+close_jobs_index(index)
+indexed$stop()
+
+# COMMAND ----------
+
+# Jobs rendered from a template are created concurrently, on an instance pool or as tasks on a shared job cluster
+batch <- webfakes::new_app_process(mock_databricks_app())
+batch_client <- databricks_client(batch$url(), "dapi-test", backoff = 0.01)
+template <- list(name = "Report {{ region }}",
+                 new_cluster = job_cluster(instance_pool_id = "pool-1"),
+                 notebook_task = list(notebook_path = "/Shared/reports/report",
+                                      base_parameters = list(region = "{{ region }}")))
+jobs <- render_jobs(template, data.frame(region = sprintf("region_%02d", 1:30)))
+stopifnot(jobs[[2]]$name == "Report region_02", jobs[[2]]$notebook_task$base_parameters$region == "region_02",
+          is.null(jobs[[2]]$new_cluster$node_type_id), jobs[[2]]$new_cluster$instance_pool_id == "pool-1")
+stopifnot(inherits(tryCatch(render_jobs(template, data.frame(other = 1)), error = identity), "error"))
+
+job_ids <- create_jobs(batch_client, jobs, max_concurrent = 4)
+stopifnot(setequal(job_ids, 1:30))
+
+shared <- share_job_cluster(jobs, job_cluster(num_workers = 4), name = "Reports", max_tasks = 25)
+stopifnot(length(shared) == 2, length(shared[[1]]$tasks) == 25, shared[[2]]$name == "Reports 2",
+          shared[[1]]$tasks[[1]]$job_cluster_key == shared[[1]]$job_clusters[[1]]$job_cluster_key)
+stopifnot(setequal(create_jobs(batch_client, shared), 31:32))
+batch$stop()
+
+# Creates that failed with a 5xx error are not sent again when the job was created anyway
+lossy <- webfakes::new_app_process(mock_databricks_app(failures = integer(0), lost_creates = 2))
+lossy_client <- databricks_client(lossy$url(), "dapi-test", backoff = 0.01)
+stopifnot(setequal(create_jobs(lossy_client, jobs[1:5], max_concurrent = 1), 1:5),
+          length(databricks_list(lossy_client, "/api/2.1/jobs/list", "jobs")) == 5)
+
+# Jobs with the same name are rejected before anything is created, since they could not be told apart by name
+duplicated_names <- tryCatch(create_jobs(lossy_client, jobs[c(1, 2, 1)]), error = conditionMessage)
+stopifnot(grepl("must be unique", duplicated_names), grepl("Report region_01", duplicated_names),
+          length(databricks_list(lossy_client, "/api/2.1/jobs/list", "jobs")) == 5)
+lossy$stop()
+
+# COMMAND ----------
+
+mock$stop()
@@ -0,0 +1,266 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC #### A client for the Databricks REST API
+# MAGIC The automation notebooks run this notebook with `%run ./rest_client` to get a shared client for the Databricks REST API:
+# MAGIC * `databricks_client(workspace, token)` keeps the headers and one connection handle per workspace, so all requests reuse the same (keep-alive) connections instead of opening a new one every call.
+# MAGIC * `databricks_request(client, method, endpoint, ...)` retries requests that fail with `429 Too Many Requests`, a `5xx` error or a connection error, with exponential backoff. When the API sends a `Retry-After` header, it waits as long as it asks. Other errors stop with the message of the API. Requests that are not idempotent, such as `jobs/create`, may have succeeded despite a `5xx` error or a connection error, so with `idempotent = FALSE` only `429` is retried.
+# MAGIC * `databricks_create_job(client, settings)` creates a job safely: after a `5xx` error or a connection error it looks up the job by name with `jobs/list` and only sends the request again when the job was not created.
+# MAGIC * `databricks_list(client, endpoint, field)` fetches all pages of a list endpoint such as `/api/2.1/jobs/list`.
+# MAGIC * `databricks_concurrent(client, endpoint, bodies)` sends many requests to one endpoint concurrently, over a bounded pool of connections and with the same retries, also with `idempotent = FALSE`.
+# MAGIC * Every attempt is timed. `databricks_metrics(client)` returns all timings, and `databricks_metrics_summary(client)` the number of calls, retries and the median and 95th percentile latency per endpoint.
+
+# COMMAND ----------
+
+databricks_client <- function(workspace, token, max_retries = 5, backoff = 1, timeout = 60) {
+  # Creates a client for the REST API of a workspace
+  #
+  # Args:
+  #   workspace:  URL of the workspace, e.g. https://mycompany.cloud.databricks.com
+  #   token:  Personal access token
+  #   max_retries:  Optional. Number of retries of a failed request
+  #   backoff:  Optional. Seconds to wait before the first retry, doubled on every retry
+  #   timeout:  Optional. Seconds after which a request times out
+  #
+  # Return:
+  #   client
+  workspace <- sub("/+$", "", workspace)
+  metrics <- new.env()
+  metrics$log <- list()
+  list(workspace = workspace,
+       headers = c(Authorization = paste("Bearer", token)),
+       handle = httr::handle(workspace),
+       max_retries = max_retries,
+       backoff = backoff,
+       timeout = timeout,
+       metrics = metrics)
+}
+
+retry_after <- function(res, attempt, backoff) {
+  # Seconds to wait before retrying: the Retry-After header of the response if
+  # there is one, exponential backoff with jitter otherwise
+  header <- if (inherits(res, "response")) httr::headers(res)[["retry-after"]] else NULL
+  if (!is.null(header) && !is.na(suppressWarnings(as.numeric(header)))) {
+    return(as.numeric(header))
+  }
+  backoff * 2^(attempt - 1) * stats::runif(1, 0.5, 1.5)
+}
+
+databricks_error <- function(message, status) {
+  # An error of a request, with the HTTP status of the response (NA after a connection error)
+  structure(class = c("databricks_error", "error", "condition"),
+            list(message = message, call = NULL, status = status))
+}
+
+ambiguous_status <- function(status) {
+  # Whether a request with this status may have taken effect although it failed
+  is.na(status) | status >= 500
+}
+
+databricks_request <- function(client, method, endpoint, body = NULL, encode = "json", query = NULL, idempotent = TRUE) {
+  # Sends a request to the REST API, retrying on 429, 5xx and connection errors
+  #
+  # Args:
+  #   client:  Client, see databricks_client()
+  #   method:  HTTP method, e.g. "GET" or "POST"
+  #   endpoint:  Path of the endpoint, e.g. "/api/2.0/jobs/create"
+  #   body:  Optional. Request body: a list, or a JSON string (with encode = "json")
+  #   encode:  Optional. "json", "multipart" or "form"
+  #   query:  Optional. List of query parameters
+  #   idempotent:  Optional. FALSE for requests that must not be sent twice, which are only retried on 429
+  #
+  # Return:
+  #   httr response; stops with a databricks_error otherwise
+  for (attempt in seq_len(client$max_retries + 1)) {
+    start <- Sys.time()
+    res <- tryCatch(
+      httr::VERB(method, url = paste0(client$workspace, endpoint), handle = client$handle,
+                 httr::add_headers(.headers = client$headers), httr::timeout(client$timeout),
+                 if (encode == "json") httr::content_type_json(),
+                 body = body, encode = encode, query = query),
+      error = function(e) e)
+    status <- if (inherits(res, "response")) httr::status_code(res) else NA_integer_
+    client$metrics$log[[length(client$metrics$log) + 1]] <- data.frame(
+      method = method, endpoint = endpoint, status = status, attempt = attempt,
+      elapsed_s = as.numeric(difftime(Sys.time(), start, units = "secs")), stringsAsFactors = FALSE)
+
+    retryable <- isTRUE(status == 429) || (idempotent && ambiguous_status(status))
+    if (!retryable || attempt > client$max_retries) {
+      break
+    }
+    Sys.sleep(retry_after(res, attempt, client$backoff))
+  }
+  if (!inherits(res, "response")) {
+    stop(databricks_error(sprintf("%s %s failed: %s", method, endpoint, conditionMessage(res)), NA_integer_))
+  }
+  if (httr::http_error(res)) {
+    stop(databricks_error(sprintf("%s %s failed with status %d: %s", method, endpoint, httr::status_code(res),
+                                  httr::content(res, as = "text", encoding = "UTF-8")), httr::status_code(res)))
+  }
+  res
+}
+
+databricks_json <- function(res) {
+  # Parses the JSON body of a response
+  jsonlite::fromJSON(httr::content(res, as = "text", encoding = "UTF-8"), simplifyVector = FALSE)
+}
+
+databricks_list <- function(client, endpoint, field, query = list(), limit = 25) {
+  # Fetches all pages of a list endpoint, e.g. /api/2.1/jobs/list
+  #
+  # Args:
+  #   client:  Client, see databricks_client()
+  #   endpoint:  Path of the endpoint
+  #   field:  Field of the response with the items, e.g. "jobs" or "runs"
+  #   query:  Optional. List of query parameters, e.g. filters
+  #   limit:  Optional. Number of items per page
+  #
+  # Return:
+  #   list of all items
+  items <- list()
+  page <- list(limit = limit, offset = 0)
+  repeat {
+    res <- databricks_json(databricks_request(client, "GET", endpoint, query = c(query, page)))
+    items <- c(items, res[[field]])
+    if (!isTRUE(res$has_more) || length(res[[field]]) == 0) {
+      break
+    }
+    # Newer endpoints page with a token, older ones with an offset
+    page <- if (!is.null(res$next_page_token)) list(limit = limit, page_token = res$next_page_token)
+            else list(limit = limit, offset = page$offset + length(res[[field]]))
+  }
+  items
+}
+
+databricks_create_job <- function(client, settings, endpoint = "/api/2.1/jobs/create", since = NULL, clock_skew = 60) {
+  # Creates a job. When a request fails with a 5xx error or a connection error, the job may have been created
+  # anyway, so before sending it again, it looks for a job with the same name created since the first attempt
+  #
+  # Args:
+  #   client:  Client, see databricks_client()
+  #   settings:  Job settings as a list, or as a JSON string
+  #   endpoint:  Optional. "/api/2.0/jobs/create" for settings in the format of the Jobs API 2.0
+  #   since:  Optional. Time of an earlier attempt that failed with a 5xx error or a connection error
+  #   clock_skew:  Optional. Seconds the clock of the workspace may be behind the local clock
+  #
+  # Return:
+  #   job id
+  name <- (if (is.character(settings)) jsonlite::fromJSON(settings) else settings)$name
+  for (attempt in seq_len(client$max_retries + 1)) {
+    if (!is.null(since)) {
+      jobs <- databricks_list(client, "/api/2.1/jobs/list", "jobs", query = list(name = name), limit = 100)
+      created <- Filter(function(job) job$created_time >= 1000 * (as.numeric(since) - clock_skew), jobs)
+      if (length(created) > 0) {
+        return(created[[length(created)]]$job_id)
+      }
+    } else {
+      since <- Sys.time()
+    }
+    res <- tryCatch(databricks_request(client, "POST", endpoint, body = settings, idempotent = FALSE),
+                    databricks_error = identity)
+    if (inherits(res, "response")) {
+      return(databricks_json(res)$job_id)
+    }
+    # Without a name the job cannot be looked up, and sending the request again could create it twice
+    if (!ambiguous_status(res$status) || is.null(name) || attempt > client$max_retries) {
+      stop(res)
+    }
+    Sys.sleep(retry_after(NULL, attempt, client$backoff))
+  }
+}
+
+databricks_concurrent <- function(client, endpoint, bodies, encode = "json", max_concurrent = 8, idempotent = TRUE) {
+  # Sends a POST request per body to an endpoint, with at most max_concurrent requests at a time
+  # over one pool of connections, retrying the requests that failed with 429, 5xx or a connection error in rounds
+  #
+  # Args:
+  #   client:  Client, see databricks_client()
+  #   endpoint:  Path of the endpoint, e.g. "/api/2.1/jobs/create"
+  #   bodies:  List of request bodies, each a list
+  #   encode:  Optional. "json" or "multipart"
+  #   max_concurrent:  Optional. Maximum number of concurrent requests
+  #   idempotent:  Optional. FALSE for requests that must not be sent twice, which are only retried on 429
+  #
+  # Return:
+  #   list with the HTTP status of the last attempt of every request (NA after a connection error)
+  #   and the parsed responses (NULL when the request failed)
+  status <- rep(NA_integer_, length(bodies))
+  content <- vector("list", length(bodies))
+  pending <- seq_along(bodies)
+  pool <- curl::new_pool(total_con = max_concurrent, host_con = max_concurrent)
+  for (attempt in seq_len(client$max_retries + 1)) {
+    wait <- NA
+    log_attempt <- function(code, elapsed) {
+      client$metrics$log[[length(client$metrics$log) + 1]] <- data.frame(
+        method = "POST", endpoint = endpoint, status = code, attempt = attempt,
+        elapsed_s = elapsed, stringsAsFactors = FALSE)
+    }
+    for (i in pending) {
+      local({
+        i <- i
+        start <- Sys.time()
+        handle <- curl::new_handle(url = paste0(client$workspace, endpoint), timeout = client$timeout)
+        curl::handle_setheaders(handle, .list = as.list(client$headers))
+        if (encode == "json") {
+          curl::handle_setheaders(handle, "Content-Type" = "application/json")
+          curl::handle_setopt(handle, copypostfields = jsonlite::toJSON(bodies[[i]], auto_unbox = TRUE, null = "null"))
+        } else {
+          curl::handle_setform(handle, .list = bodies[[i]])
+        }
+        curl::multi_add(handle, pool = pool,
+          done = function(res) {
+            status[i] <<- res$status_code
+            if (res$status_code < 300) {
+              content[[i]] <<- jsonlite::fromJSON(rawToChar(res$content), simplifyVector = FALSE)
+            }
+            log_attempt(res$status_code, unname(res$times["total"]))
+            header <- curl::parse_headers_list(res$headers)[["retry-after"]]
+            if (!is.null(header) && !is.na(suppressWarnings(as.numeric(header)))) {
+              wait <<- max(wait, as.numeric(header), na.rm = TRUE)
+            }
+          },
+          fail = function(message) {
+            status[i] <<- NA_integer_
+            log_attempt(NA_integer_, as.numeric(difftime(Sys.time(), start, units = "secs")))
+          })
+      })
+    }
+    curl::multi_run(pool = pool)
+
+    retry <- pending[status[pending] %in% 429 | (idempotent & ambiguous_status(status[pending]))]
+    if (length(retry) == 0 || attempt > client$max_retries) {
+      break
+    }
+    pending <- retry
+    Sys.sleep(if (is.na(wait)) client$backoff * 2^(attempt - 1) * stats::runif(1, 0.5, 1.5) else wait)
+  }
+  list(status = status, content = content)
+}
+
+# COMMAND ----------
+
+databricks_metrics <- function(client) {
+  # Returns the timing of every attempt of every request of a client
+  if (length(client$metrics$log) == 0) {
+    return(data.frame(method = character(0), endpoint = character(0), status = integer(0),
+                      attempt = integer(0), elapsed_s = numeric(0)))
+  }
+  do.call(rbind, client$metrics$log)
+}
+
+databricks_metrics_summary <- function(client) {
+  # Summarises the timings of a client per endpoint
+  #
+  # Return:
+  #   data.frame with the number of requests and retries, and the median and 95th percentile latency
+  metrics <- databricks_metrics(client)
+  if (nrow(metrics) == 0) {
+    return(metrics)
+  }
+  do.call(rbind, lapply(split(metrics, metrics[c("method", "endpoint")], drop = TRUE), function(m) {
+    data.frame(method = m$method[1], endpoint = m$endpoint[1],
+               requests = sum(m$attempt == 1), retries = sum(m$attempt > 1),
+               errors = sum(is.na(m$status) | m$status >= 400),
+               median_s = stats::median(m$elapsed_s), p95_s = unname(stats::quantile(m$elapsed_s, 0.95)),
+               stringsAsFactors = FALSE)
+  }))
+}
@@ -0,0 +1,169 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC #### Monitoring many job runs
+# MAGIC After `run_job` the automation notebooks only return the `run_id`, and the state of the run has to be checked by hand. This notebook tracks hundreds of runs concurrently with `asyncio` until they finish:
+# MAGIC * All runs share one `aiohttp` session, with at most `max_concurrent` connections to the workspace. Requests that fail with `429`, a `5xx` error or a connection error are retried with exponential backoff, or as long as the `Retry-After` header asks.
+# MAGIC * Every run is polled adaptively: right after its state changed after `min_interval` seconds, and then `growth` times slower for as long as it stays in the same state, up to `max_interval` seconds. Long running jobs therefore cost few requests, while short ones are still noticed quickly.
+# MAGIC * `monitor_runs` emits an event per run as soon as it finished, with its result and its queue time, cluster start time and execution time, and prints a summary at the end.
+# MAGIC
+# MAGIC ```python
+# MAGIC stats = run_async(monitor_runs(workspace, token, run_ids, on_complete=print))
+# MAGIC ```
+
+# COMMAND ----------
+
+import asyncio
+import random
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+TERMINAL_STATES = {"TERMINATED", "SKIPPED", "INTERNAL_ERROR"}
+
+
+def run_stats(run, polls):
+    """Returns the result and the timings (in seconds) of a finished run of /api/2.1/jobs/runs/get."""
+    state = run.get("state", {})
+    tasks = run.get("tasks") or []
+
+    def seconds(key, source=run):
+        return (source.get(key) or 0) / 1000.0
+
+    cluster_start_s, execution_s = seconds("setup_duration"), seconds("execution_duration")
+    if tasks and not cluster_start_s and not execution_s:
+        # Multi-task runs only report these durations per task. The tasks may run in parallel or one after the
+        # other on a shared cluster, so the cluster start is the longest setup of a task, and the execution the
+        # rest of the time from the start of the first task to the end of the last one
+        cluster_start_s = max(seconds("setup_duration", task) for task in tasks)
+        timed = [task for task in tasks if task.get("start_time") and task.get("end_time")]
+        if timed:
+            span = max(task["end_time"] for task in timed) - min(task["start_time"] for task in timed)
+            execution_s = max(span / 1000.0 - cluster_start_s, 0.0)
+        else:
+            execution_s = max(seconds("execution_duration", task) for task in tasks)
+
+    if run.get("end_time"):
+        total_s = (run["end_time"] - run["start_time"]) / 1000.0
+    else:
+        total_s = seconds("run_duration") or None
+
+    return {
+        "run_id": run["run_id"],
+        "job_id": run.get("job_id"),
+        "result_state": state.get("result_state", state.get("life_cycle_state")),
+        "queue_s": seconds("queue_duration"),
+        "cluster_start_s": cluster_start_s,
+        "execution_s": execution_s,
+        "total_s": total_s,
+        "polls": polls,
+    }
+
+
+class RunMonitor:
+    """Tracks job runs until they finished, with one shared HTTP session and adaptive polling intervals."""
+
+    def __init__(self, host, token, min_interval=5.0, max_interval=120.0, growth=1.5, max_concurrent=32,
+                 max_retries=5, backoff=1.0):
+        self.host = host.rstrip("/")
+        self.token = token
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.growth = growth
+        self.max_concurrent = max_concurrent
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.requests = 0
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            headers={"Authorization": "Bearer " + self.token},
+            connector=aiohttp.TCPConnector(limit=self.max_concurrent),
+            timeout=aiohttp.ClientTimeout(total=60))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def get_run(self, run_id):
+        """Fetches a run, retrying 429, 5xx and connection errors."""
+        for attempt in range(self.max_retries + 1):
+            delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            try:
+                async with self.session.get(self.host + "/api/2.1/jobs/runs/get", params={"run_id": run_id}) as res:
+                    self.requests += 1
+                    if res.status != 429 and res.status < 500:
+                        if res.status >= 400:
+                            raise IOError("runs/get of run {0} failed with status {1}: {2}".format(run_id, res.status, await res.text()))
+                        return await res.json()
+                    error = IOError("runs/get of run {0} failed with status {1}".format(run_id, res.status))
+                    if res.headers.get("Retry-After", "").isdigit():
+                        delay = float(res.headers["Retry-After"])
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                error = e
+            if attempt < self.max_retries:
+                await asyncio.sleep(delay)
+        raise error
+
+    async def track(self, run_id):
+        """Polls a run until it finished and returns its stats, see run_stats."""
+        interval, previous_state, polls = self.min_interval, None, 0
+        while True:
+            run = await self.get_run(run_id)
+            polls += 1
+            state = run["state"]["life_cycle_state"]
+            if state in TERMINAL_STATES:
+                return run_stats(run, polls)
+            # Poll soon after a change of state and slow down while the run stays in the same state,
+            # with some jitter so that the polls of runs started together spread out
+            interval = self.min_interval if state != previous_state else min(interval * self.growth, self.max_interval)
+            previous_state = state
+            await asyncio.sleep(interval * random.uniform(0.9, 1.1))
+
+    async def _track_or_error(self, run_id):
+        try:
+            return await self.track(run_id)
+        except Exception as e:
+            return {"run_id": run_id, "result_state": "MONITOR_ERROR", "error": str(e)}
+
+    async def watch(self, run_ids):
+        """Yields the stats of every run as soon as it finished, in the order in which the runs finish."""
+        tasks = [asyncio.ensure_future(self._track_or_error(run_id)) for run_id in run_ids]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                yield await finished
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+# COMMAND ----------
+
+async def monitor_runs(host, token, run_ids, on_complete=None, **options):
+    """Tracks runs concurrently and calls on_complete(stats) for every run when it finished. Returns the stats of all runs."""
+    results = []
+    async with RunMonitor(host, token, **options) as monitor:
+        async for stats in monitor.watch(run_ids):
+            results.append(stats)
+            if on_complete is not None:
+                on_complete(stats)
+        requests = monitor.requests
+
+    finished = [stats for stats in results if "error" not in stats]
+
+    def median(key):
+        return statistics.median(stats[key] for stats in finished) if finished else float("nan")
+
+    print("Tracked {0} runs with {1} requests: {2} succeeded, {3} failed, {4} not monitored. "
+          "Median queue time {5:.1f}s, cluster start {6:.1f}s, execution {7:.1f}s".format(
+              len(results), requests, sum(stats["result_state"] == "SUCCESS" for stats in finished),
+              sum(stats["result_state"] != "SUCCESS" for stats in finished), len(results) - len(finished),
+              median("queue_s"), median("cluster_start_s"), median("execution_s")))
+    return results
+
+
+def run_async(coroutine):
+    """Runs a coroutine to completion, also from a notebook whose event loop is already running."""
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, coroutine).result()